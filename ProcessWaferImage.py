@@ -1,22 +1,49 @@
-import tkinter as tk
-from tkinter import filedialog, messagebox
-from PIL import Image, ImageTk, ImageDraw, ImageFont 
+import time
+_IMPORT_START = time.perf_counter()
+
+from PIL import Image, ImageDraw, ImageFont, ImageFilter 
 import math
 import os 
 import logging 
+import zlib
+import csv
+import json
+import base64
+import io
+import threading
+import multiprocessing
+import argparse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 try:
     import numpy as np
-except ImportError:
-    print("NumPy is required for area calculation and linear algebra. Please install it using 'pip install numpy'.")
-    logging.error("NumPy import failed.")
-    exit()
+except ImportError as e:
+    raise ImportError("NumPy is required for area calculation and linear algebra. Please install it using 'pip install numpy'.") from e
 
 # --- Logging Configuration ---
-logging.basicConfig(level=logging.INFO, 
-                    format='%(asctime)s - %(levelname)s - %(funcName)s - %(message)s',
-                    datefmt='%S')
+# Handlers are only configured by the GUI entry point (main), so importing this module
+# from batch workers leaves the host application's logging untouched.
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(funcName)s - %(message)s'
 logger = logging.getLogger(__name__)
 
+# --- Lazy GUI Imports ---
+# tkinter and ImageTk are only needed by ImageAnnotator. They are bound on first use so the
+# geometry, mask and report functions below can be imported headless (e.g. by process-pool workers).
+tk = None
+filedialog = None
+messagebox = None
+ImageTk = None
+
+def _load_gui():
+    """Imports the Tk toolkit on first use and binds it to the module globals."""
+    global tk, filedialog, messagebox, ImageTk
+    if tk is None:
+        import tkinter
+        from tkinter import filedialog as tk_filedialog, messagebox as tk_messagebox
+        from PIL import ImageTk as pil_imagetk
+        tk, filedialog, messagebox, ImageTk = tkinter, tk_filedialog, tk_messagebox, pil_imagetk
+
 # --- Die Names and FFD Patch Size ---
 DIE_NAMES = [
     "0:No_NP", "1:MX_2x2", "2:MX_3x3", "3:MX_4x4", "4:32x16", " :Test1",
@@ -29,15 +56,2411 @@ NUM_ROWS = 6
 SCP_SIZE = 4 
 # --- END Die Names and FFD Size ---
 
-# Global font object (loaded once)
-try:
-    GLOBAL_FONT = ImageFont.truetype("arial.ttf", 14) 
-except Exception:
-    GLOBAL_FONT = ImageFont.load_default()
-    logger.warning("Using default font. Arial not found.")
+# --- Undo/Redo History ---
+MASK_TILE_SIZE = 256          # Mask edits are stored per tile of this size (px, multiple of 8)
+UNDO_MEMORY_LIMIT_MB = 256    # Oldest actions are evicted once the history exceeds this
+
+# --- Auto Mask ---
+MASK_COLOR = (0, 255, 0, 128)    # Translucent green overlay, rendered only for displayed regions
+AUTO_MASK_TILE_SIZE = 1024       # Full-resolution processing tile (px)
+AUTO_MASK_PREVIEW_SIZE = 900     # Longest side of the downsampled threshold preview (px)
+AUTO_MASK_WORKERS = os.cpu_count() or 4
+
+# --- Wafer Rotation ---
+STREET_ANGLE_SIZE = 1024         # Longest side of the downsampled copy used for street-angle detection (px)
+STREET_ANGLE_BINS = 720          # Angular histogram bins over the 90 degree period of the street grid
+STREET_ANGLE_MIN_STRENGTH = 3.0  # Histogram peak / mean below which no dominant street orientation is assumed
+STREET_ANGLE_REFINE_SPAN = 1.5   # Projection-profile search around the histogram peak (+- degrees)
+STREET_ANGLE_REFINE_STEP = 0.1   # Coarse step of that search (degrees), refined five times finer
+STREET_ANGLE_REFINE_STRIDE = 2   # Pixel subsampling of the thumbnail crop for the profiles
+
+# --- Street Snap ---
+SNAP_RADIUS_SCREEN = 15          # Streets are searched this far (screen px) around a dropped SCP's nearest die corner
+SNAP_MAX_PITCH_FRACTION = 0.3    # ... but never farther than this fraction of the die pitch
+SNAP_WINDOW_FRACTION = 0.15      # Half-width of the symmetry window across a street, as a fraction of the die pitch
+SNAP_PROFILE_SAMPLES = 256       # Samples along a street (over +-1 die pitch) averaged into its profile
+SNAP_MAX_OFFSETS = 128           # Candidate offsets across a street are subsampled beyond this many per side
+SNAP_MIN_SCORE = 0.3             # Weaker street responses leave the SCP where it was dropped
+
+# --- Display ---
+DISPLAY_REFINE_IDLE_MS = 200     # Interactive (fast filter) frames are redrawn with LANCZOS after this idle time
+DISPLAY_PYRAMID_MIN_SIZE = 1024  # Halved display copies are built down to this longest side (px)
+
+# --- Display Enhancement ---
+ENHANCE_TILE_SIZE = 512          # Enhanced display tiles are cached per pyramid level in tiles of this size (px)
+ENHANCE_CACHE_MB = 256
+ENHANCE_STATS_SIZE = 1024        # Longest side of the thumbnail the stretch percentiles and CLAHE LUTs come from
+ENHANCE_STRETCH_PERCENTILES = (1.0, 99.0)
+ENHANCE_CLAHE_GRID = 8           # CLAHE cells per image side
+ENHANCE_CLAHE_CLIP = 3.0         # Histogram clip limit, relative to a uniform histogram
+
+# --- Lot Navigation ---
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff')
+IMAGE_CACHE_LIMIT_MB = 2048      # Decoded images (with pyramids) kept for switching between wafers of a lot
+PREFETCH_RADIUS = 1              # Neighbouring images decoded ahead on each side of the current one
+
+# --- Working Copy ---
+WORKING_COPY_BUDGET_MB = 1024    # Larger scans are annotated on a downscaled copy that fits this budget
+WORKING_BYTES_PER_PIXEL = 4.5    # RGB, display pyramid, mask, circle stencil and undo tiles per working pixel
+DECODE_BAND_BYTES = 64 * 1024 * 1024  # Source rows per band when memory-mapped files are downscaled band by band
+
+# --- Job Server ---
+SERVER_PORT = 8765
+SERVER_WORKERS = 4
+SERVER_CACHE_ENTRIES = 64        # Die tables, masks and per-die statistics memoized by the job server
+
+# --- Sessions and Template Registration ---
+SESSION_VERSION = 1
+REGISTRATION_SIZE = 1024         # Longest side of the grayscale copies that are registered (px)
+REGISTRATION_MIN_RESPONSE = 0.1  # Phase-correlation peak below which a template match is reported as unreliable
+REGISTRATION_FLIP_MARGIN = 1.25  # A rotation beyond +-90 degrees is only taken if its peak is this much stronger
+
+# --- Mask Journal ---
+MASK_JOURNAL_VERSION = 1
+
+# --- Die Atlas Export ---
+ATLAS_GRID = 16                  # Dies per atlas side; each atlas PNG holds up to ATLAS_GRID**2 crops
+ATLAS_TILE_SIZE = 128            # Rectified crop size (px); 0 keeps the native axis-aligned crop of each die
+ATLAS_WORKERS = os.cpu_count() or 4
+ATLAS_PNG_COMPRESSION = 1        # zlib level of the atlas PNGs; higher levels are ~6x slower for little gain on die images
+
+# --- Rectified Export ---
+RECTIFY_TILE_SIZE = 1024         # Output tile size of the mesh-driven remap (px)
+RECTIFY_WORKERS = os.cpu_count() or 4
+
+# --- Session Diff ---
+DIE_STATUS_NOT_COUNTED = 0  # Outside, excluded or partial die
+DIE_STATUS_CLEAN = 1
+DIE_STATUS_MASKED = 2
+DIE_STATUS_NAMES = {DIE_STATUS_NOT_COUNTED: 'Not Counted', DIE_STATUS_CLEAN: 'Clean', DIE_STATUS_MASKED: 'Masked'}
+DIFF_NONE = 0
+DIFF_MASKED = 1     # Clean before, masked after
+DIFF_CLEARED = 2    # Masked before, clean after
+DIFF_ENTERED = 3    # Not counted before, counted after
+DIFF_LEFT = 4       # Counted before, not counted after
+DIFF_NEW = 5        # Counted die the first session's grid does not have
+DIFF_CHANGE_NAMES = {DIFF_NONE: 'Unchanged', DIFF_MASKED: 'Newly Masked', DIFF_CLEARED: 'Cleared', 
+                     DIFF_ENTERED: 'Entered', DIFF_LEFT: 'Left', DIFF_NEW: 'New'}
+DIFF_COLORS = {DIFF_MASKED: '#FF0000', DIFF_CLEARED: '#00FF00', DIFF_ENTERED: '#FFFF00', 
+               DIFF_LEFT: '#FF8000', DIFF_NEW: '#FF00FF'}
+_DIFF_TRANSITIONS = np.array([[DIFF_NONE, DIFF_ENTERED, DIFF_ENTERED],     # Indexed [before status, after status]
+                              [DIFF_LEFT, DIFF_NONE, DIFF_MASKED],
+                              [DIFF_LEFT, DIFF_CLEARED, DIFF_NONE]], dtype=np.int8)
+
+# --- Lasso and Flood Fill ---
+FILL_TOLERANCE = 30              # Default max per-channel color difference to the clicked pixel
+
+# --- Per-Die Statistics ---
+DIE_STATS_BAND_HEIGHT = 2048     # Label image is rasterized in horizontal bands of this height (px)
+DIE_STATS_FLAG_SIGMA = 4.0       # Robust z-score above which a die is flagged by appearance
+
+# --- Die Classification ---
+DIE_OUTSIDE = 0     # Does not touch the wafer circle
+DIE_EXCLUDED = 1    # Touches the wafer, but only inside the edge-exclusion ring
+DIE_PARTIAL = 2     # Crosses the boundary of the usable area
+DIE_FULL = 3        # All four corners inside the usable area (counted die)
+DIE_CLASS_NAMES = {DIE_OUTSIDE: 'Outside', DIE_EXCLUDED: 'Excluded', DIE_PARTIAL: 'Partial', DIE_FULL: 'Full'}
+
+# Global font object (loaded once, on first use)
+_GLOBAL_FONT = None
+
+def get_global_font():
+    global _GLOBAL_FONT
+    if _GLOBAL_FONT is None:
+        try:
+            _GLOBAL_FONT = ImageFont.truetype("arial.ttf", 14) 
+        except Exception:
+            _GLOBAL_FONT = ImageFont.load_default()
+            logger.warning("Using default font. Arial not found.")
+    return _GLOBAL_FONT
+
+# --- Wafer Geometry ---
+
+def circle_from_points(p1, p2, p3):
+    """Circumscribed circle of three points. Returns (center, radius), or None if collinear."""
+    ax, ay = p1
+    bx, by = p2 
+    cx, cy = p3
+    
+    d = 2 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
+    if abs(d) < 1e-10:
+        return None
+        
+    ux = ((ax**2 + ay**2) * (by - cy) + (bx**2 + by**2) * (cy - ay) + (cx**2 + cy**2) * (ay - by)) / d
+    uy = ((ax**2 + ay**2) * (cx - bx) + (bx**2 + by**2) * (ax - cx) + (cx**2 + cy**2) * (bx - ax)) / d
+    radius = math.sqrt((ax - ux)**2 + (ay - uy)**2)
+    return (ux, uy), radius
+
+def initial_scp_lattice(W_img, H_img, circle_geom, rectangle_geom, angle=0.0):
+    """
+    Places the SCP_SIZE x SCP_SIZE super-control points over the circle's working area,
+    rotated by angle (radians, image coordinates) about the circle center.
+    Returns (super_control_points, Max_C, Max_R).
+    """
+    # --- 1. Calculate Dynamic Margin based on Circle ---
+    R_circ = circle_geom['radius']
+    ux, uy = circle_geom['center']
+    
+    # Calculate the four distances from the circle's edge to the image edge
+    D_left = ux - R_circ
+    D_right = W_img - (ux + R_circ)
+    D_top = uy - R_circ
+    D_bottom = H_img - (uy + R_circ)
+    
+    # The FFD grid's outer boundary is offset by D_x, D_y
+    X_offset = max(0.0, D_left)
+    W_FFD_max = W_img - max(0.0, D_left) - max(0.0, D_right) 
+
+    Y_offset = max(0.0, D_top)
+    H_FFD_max = H_img - max(0.0, D_top) - max(0.0, D_bottom)
+    
+    # Fallback: Ensure minimum working area
+    DEFAULT_MARGIN = 0.05
+    if W_FFD_max < W_img * DEFAULT_MARGIN: 
+        W_FFD_max = W_img * (1.0 - 2*DEFAULT_MARGIN)
+    if H_FFD_max < H_img * DEFAULT_MARGIN: 
+        H_FFD_max = H_img * (1.0 - 2*DEFAULT_MARGIN)
+    
+    # --- 2. Calculate Die Grid Size for Interpolated Mesh (based on FFD Area) ---
+    x1, y1, x2, y2 = rectangle_geom
+    W_die, H_die = x2 - x1, y2 - y1
+    
+    # Use W_FFD_max/H_FFD_max instead of W_img/H_img ***
+    Max_C = math.ceil(W_FFD_max / W_die) 
+    Max_R = math.ceil(H_FFD_max / H_die) 
+    
+    # Ensure a minimum grid size of 1x1 if die is very large (Max_C/R should be >= 1)
+    Max_C = max(1, Max_C)
+    Max_R = max(1, Max_R)
+    
+    # --- 3. Place SCPs within the Dynamic Working Area (W_FFD_max x H_FFD_max) ---
+    super_control_points = {}
+    for C_s in range(SCP_SIZE):
+        for R_s in range(SCP_SIZE):
+            
+            # Normalized position (0.0 to 1.0) across the grid intervals
+            u_norm_grid = C_s / (SCP_SIZE - 1.0)
+            v_norm_grid = R_s / (SCP_SIZE - 1.0)
+
+            # Map to the dynamic working area, shifted inward by (D_left, D_top)
+            x = u_norm_grid * W_FFD_max + X_offset
+            y = v_norm_grid * H_FFD_max + Y_offset
+            
+            super_control_points[(C_s, R_s)] = (x, y)
+    
+    # --- 4. Rotate the lattice onto the street orientation ---
+    # The working area contains the circle's bounding box, so it still covers the circle when rotated about its center
+    if angle:
+        cos_a, sin_a = math.cos(angle), math.sin(angle)
+        for key, (x, y) in super_control_points.items():
+            dx, dy = x - ux, y - uy
+            super_control_points[key] = (ux + cos_a * dx - sin_a * dy, uy + sin_a * dx + cos_a * dy)
+            
+    return super_control_points, Max_C, Max_R
+
+def estimate_street_angle(image, circle_geom, size=STREET_ANGLE_SIZE, bins=STREET_ANGLE_BINS):
+    """
+    Dominant die-street orientation inside the wafer circle, from the angular distribution of
+    FFT energy of a downsampled copy (street grids concentrate it on two orthogonal lines). The
+    histogram peak is only good to about a degree (the low harmonics that dominate it are a few
+    FFT bins from the origin, and window leakage along the axes pulls small angles to 0), so a
+    strong peak is refined on the projection profiles, see _refine_street_angle.
+    Returns (angle, strength): angle in radians within [-pi/4, pi/4) in image coordinates, and
+    the histogram peak over its mean (about 1 for images without a regular street grid).
+    """
+    gray, scale = registration_thumbnail(image, size)
+    ux, uy = circle_geom['center']
+    half = int(circle_geom['radius'] * scale / math.sqrt(2)) # Inscribed square: no wafer edge in the spectrum
+    x0, y0 = max(0, int(ux * scale) - half), max(0, int(uy * scale) - half)
+    crop = gray[y0:int(uy * scale) + half, x0:int(ux * scale) + half]
+    if min(crop.shape) < 32:
+        return 0.0, 0.0
+    
+    h, w = crop.shape
+    window = np.outer(np.hanning(h), np.hanning(w))
+    power = np.abs(np.fft.fftshift(np.fft.fft2((crop - crop.mean()) * window))) ** 2
+    fy, fx = np.meshgrid(np.fft.fftshift(np.fft.fftfreq(h)), np.fft.fftshift(np.fft.fftfreq(w)), indexing='ij')
+    radius = np.hypot(fx, fy)
+    # Skip the lowest frequencies (illumination, wafer-scale shading) and the corners beyond Nyquist
+    band = (radius > 8.0 / min(h, w)) & (radius < 0.5)
+    theta = np.mod(np.arctan2(fy[band], fx[band]), np.pi / 2)
+    hist = np.bincount(np.minimum((theta / (np.pi / 2) * bins).astype(np.int64), bins - 1), 
+                       weights=power[band], minlength=bins)
+    hist = (np.roll(hist, 1) + hist + np.roll(hist, -1)) / 3
+    
+    peak = int(np.argmax(hist))
+    # Refine with the power-weighted mean angle of the frequencies within two bins of the peak
+    period = np.pi / 2
+    peak_angle = (peak + 0.5) * period / bins
+    diff = np.mod(theta - peak_angle + period / 2, period) - period / 2
+    near = np.abs(diff) < 2 * period / bins
+    weights = power[band][near]
+    angle = peak_angle + float(np.sum(diff[near] * weights) / np.sum(weights))
+    strength = float(hist[peak] / hist.mean())
+    if strength >= STREET_ANGLE_MIN_STRENGTH:
+        angle = _refine_street_angle(crop, angle)
+    angle = angle % period
+    if angle >= np.pi / 4:
+        angle -= np.pi / 2
+    return float(angle), strength
+
+def _street_profile_score(values, xs, ys, angle):
+    """Summed variance of the 1 px projection profiles of values along the two axes rotated by angle."""
+    cos_a, sin_a = math.cos(angle), math.sin(angle)
+    score = 0.0
+    for u in (xs * cos_a + ys * sin_a, ys * cos_a - xs * sin_a):
+        u = u - u.min()
+        idx = u.astype(np.int64)
+        frac = u - idx
+        n = int(idx.max()) + 2
+        # Linear binning: whole-pixel binning aliases at angles near 0
+        counts = np.bincount(idx, 1 - frac, n) + np.bincount(idx + 1, frac, n)
+        sums = np.bincount(idx, values * (1 - frac), n) + np.bincount(idx + 1, values * frac, n)
+        full = counts > counts.max() * 0.5 # Drop the short lines at the corners of the rotated crop
+        score += float(np.var(sums[full] / counts[full]))
+    return score
+
+def _refine_street_angle(crop, angle, span=STREET_ANGLE_REFINE_SPAN, step=STREET_ANGLE_REFINE_STEP, 
+                         stride=STREET_ANGLE_REFINE_STRIDE):
+    """
+    Street angle (radians) near angle that makes the projection profiles of crop sharpest: the
+    streets then line up with the projection and every harmonic adds to the profile variance.
+    Searched on a step grid, then five times finer around the best, with a final parabola fit.
+    """
+    values = crop[::stride, ::stride].astype(np.float64)
+    h, w = values.shape
+    ys, xs = np.mgrid[0:h, 0:w]
+    xs, ys = (xs.ravel() - w / 2) * stride, (ys.ravel() - h / 2) * stride
+    values = values.ravel()
+    span, step = math.radians(span), math.radians(step)
+    
+    n = int(round(span / step))
+    candidates = angle + step * np.arange(-n, n + 1)
+    scores = [_street_profile_score(values, xs, ys, a) for a in candidates]
+    step /= 5
+    candidates = candidates[int(np.argmax(scores))] + step * np.arange(-5, 6)
+    scores = [_street_profile_score(values, xs, ys, a) for a in candidates]
+    best = int(np.argmax(scores))
+    if 0 < best < len(scores) - 1:
+        s0, s1, s2 = scores[best - 1:best + 2]
+        curvature = s0 - 2 * s1 + s2
+        if curvature < 0:
+            return float(candidates[best] + 0.5 * (s0 - s2) / curvature * step)
+    return float(candidates[best])
+
+def _sample_street_strip(image, origin, across, along, t_max, t_step, s_max, s_samples=SNAP_PROFILE_SAMPLES):
+    """
+    Gray samples of image at origin + t * across + s * along (unit vectors) for t in [-t_max, t_max]
+    every t_step px and s_samples values of s in [-s_max, s_max], the s range clipped to the image.
+    Returns (values (n_s, n_t), t), or None when the strip does not fit the image.
+    """
+    W, H = image.size
+    s0, s1 = -s_max, s_max
+    for t in (-t_max, t_max):
+        for k, size in ((0, W), (1, H)):
+            base = origin[k] + t * across[k]
+            if abs(along[k]) < 1e-9:
+                if not 0 <= base <= size:
+                    return None
+                continue
+            lo, hi = sorted((-base / along[k], (size - base) / along[k]))
+            s0, s1 = max(s0, lo), min(s1, hi)
+    if s1 - s0 < 8:
+        return None
+    
+    n_t = int(round(2 * t_max / t_step)) + 1
+    s_step = (s1 - s0) / (s_samples - 1)
+    ends = [origin + t * across + s * along for t in (-t_max, t_max) for s in (s0, s1)]
+    bx0 = max(0, int(math.floor(min(x for x, _ in ends))) - 2)
+    by0 = max(0, int(math.floor(min(y for _, y in ends))) - 2)
+    bx1 = min(W, int(math.ceil(max(x for x, _ in ends))) + 2)
+    by1 = min(H, int(math.ceil(max(y for _, y in ends))) + 2)
+    crop = image.crop((bx0, by0, bx1, by1)).convert('L')
+    # Output pixel (i, j) is sampled at its center (i + 0.5, j + 0.5), as is every input pixel
+    a, b, d, e = t_step * across[0], s_step * along[0], t_step * across[1], s_step * along[1]
+    c = origin[0] - t_max * across[0] + s0 * along[0] - bx0 - 0.5 * (a + b)
+    f = origin[1] - t_max * across[1] + s0 * along[1] - by0 - 0.5 * (d + e)
+    strip = crop.transform((n_t, s_samples), Image.AFFINE, (a, b, c, d, e, f), resample=Image.BILINEAR)
+    return np.asarray(strip, dtype=np.float64), -t_max + t_step * np.arange(n_t)
+
+def _street_offset(values, t, radius, half_width):
+    """
+    Subpixel offset (in t) of the street running through a strip sampled across it, and its score.
+    The expected street pattern is a band that is uniform along its length and mirror symmetric
+    across it: the mean profile is cross-correlated with its own reflection in a window around
+    every candidate offset, weighted by how uniform that column is, and the peak is refined
+    with a parabola through its neighbours.
+    """
+    step = t[1] - t[0]
+    h = int(round(half_width / step))
+    candidates = np.nonzero(np.abs(t) <= radius)[0]
+    candidates = candidates[(candidates >= h) & (candidates + h < len(t))]
+    if len(candidates) < 3 or h < 1:
+        return 0.0, 0.0
+    profile = values.mean(axis=0)
+    spread = values.std(axis=0)
+    windows = np.lib.stride_tricks.sliding_window_view(profile, 2 * h + 1)[candidates - h]
+    windows = windows - windows.mean(axis=1, keepdims=True)
+    symmetry = (windows * windows[:, ::-1]).mean(axis=1) / max(profile.var(), 1e-9)
+    typical = max(np.median(spread), 1e-9)
+    scores = symmetry * np.clip((typical - spread[candidates]) / typical, 0.0, 1.0)
+    
+    k = int(np.argmax(scores))
+    offset = 0.0
+    if 0 < k < len(scores) - 1:
+        y0, y1, y2 = scores[k - 1:k + 2]
+        denominator = y0 - 2 * y1 + y2
+        if denominator < 0:
+            offset = 0.5 * (y0 - y2) / denominator
+    return float(t[candidates[k]] + offset * step), float(scores[k])
+
+def snap_to_street_intersection(image, corner, edge_x, edge_y, radius, min_score=SNAP_MIN_SCORE):
+    """
+    Street intersection within radius of a die corner of the mesh, to subpixel accuracy.
+    edge_x, edge_y are the mesh's die edges (one pitch) at the corner; the street along each is
+    found in a strip of +-1 pitch along it (see _street_offset), and the two offsets give the
+    intersection. Returns (x, y), or None when either street scores below min_score.
+    """
+    corner = np.asarray(corner, dtype=np.float64)
+    pitch_x, pitch_y = np.hypot(*edge_x), np.hypot(*edge_y)
+    if pitch_x < 4 or pitch_y < 4:
+        return None
+    unit_x, unit_y = np.asarray(edge_x) / pitch_x, np.asarray(edge_y) / pitch_y
+    
+    offsets = []
+    for across, along, pitch_across, pitch_along in ((unit_x, unit_y, pitch_x, pitch_y), (unit_y, unit_x, pitch_y, pitch_x)):
+        half_width = SNAP_WINDOW_FRACTION * pitch_across
+        t_max = radius + half_width
+        sampled = _sample_street_strip(image, corner, across, along, t_max, max(1.0, t_max / SNAP_MAX_OFFSETS), pitch_along)
+        if sampled is None:
+            return None
+        offset, score = _street_offset(*sampled, radius, half_width)
+        if score < min_score:
+            return None
+        offsets.append(offset)
+    # The street along edge_y is offset along unit_x and vice versa
+    x, y = corner + offsets[0] * unit_x + offsets[1] * unit_y
+    return float(x), float(y)
+
+def interpolate_ffd_mesh(super_control_points, Max_C, Max_R, W_img, H_img):
+    """Bilinear FFD interpolation of every die corner (C, R) from the SCP patches."""
+    interpolated_points = {}
+    if not super_control_points:
+        return interpolated_points
+    
+    num_patches_c = SCP_SIZE - 1
+    num_patches_r = SCP_SIZE - 1
+    
+    for C in range(Max_C + 1):
+        for R in range(Max_R + 1):
+            
+            u = C / Max_C if Max_C > 0 else 0
+            v = R / Max_R if Max_R > 0 else 0
+            
+            C_s_float = u * num_patches_c 
+            R_s_float = v * num_patches_r
+
+            C_s = min(num_patches_c - 1, int(C_s_float)) 
+            R_s = min(num_patches_r - 1, int(R_s_float)) 
+
+            if C == Max_C and Max_C > 0: 
+                C_s = num_patches_c - 1
+            if R == Max_R and Max_R > 0: 
+                R_s = num_patches_r - 1
+            
+            u_local = C_s_float - C_s
+            v_local = R_s_float - R_s
+            
+            if C == Max_C and Max_C > 0: 
+                u_local = 1.0
+            if R == Max_R and Max_R > 0: 
+                v_local = 1.0
+            
+            P00 = super_control_points.get((C_s, R_s), (0, 0)) 
+            P10 = super_control_points.get((C_s + 1, R_s), (W_img, 0)) 
+            P01 = super_control_points.get((C_s, R_s + 1), (0, H_img)) 
+            P11 = super_control_points.get((C_s + 1, R_s + 1), (W_img, H_img)) 
+            
+            P_u_top_x = (1 - u_local) * P00[0] + u_local * P10[0]
+            P_u_bottom_x = (1 - u_local) * P01[0] + u_local * P11[0]
+            
+            P_u_top_y = (1 - u_local) * P00[1] + u_local * P10[1]
+            P_u_bottom_y = (1 - u_local) * P01[1] + u_local * P11[1]
+            
+            x_interp = (1 - v_local) * P_u_top_x + v_local * P_u_bottom_x
+            y_interp = (1 - v_local) * P_u_top_y + v_local * P_u_bottom_y
+            
+            interpolated_points[(C, R)] = (x_interp, y_interp)
+    return interpolated_points
+
+def die_polygon_from_points(interpolated_points, C, R, Max_C, Max_R):
+    """Die (C, R) as [P_LL, P_LR, P_UR, P_UL], or None outside the grid."""
+    if C < 0 or C >= Max_C or R < 0 or R >= Max_R: 
+        return None
+    P_UL = interpolated_points.get((C, R), (0, 0))         
+    P_UR = interpolated_points.get((C + 1, R), (0, 0))     
+    P_LR = interpolated_points.get((C + 1, R + 1), (0, 0)) 
+    P_LL = interpolated_points.get((C, R + 1), (0, 0))     
+    return [P_LL, P_LR, P_UR, P_UL] 
+
+def build_die_info_cache(interpolated_points, Max_C, Max_R):
+    """Committed die data: {(C, R): {'center', 'polygon'}} for every die of the mesh."""
+    die_info_cache = {}
+    for C in range(Max_C):
+        for R in range(Max_R):
+            polygon = die_polygon_from_points(interpolated_points, C, R, Max_C, Max_R)
+            
+            P_LL, P_LR, P_UR, P_UL = polygon
+            center_x = (P_LL[0] + P_LR[0] + P_UR[0] + P_UL[0]) / 4.0
+            center_y = (P_LL[1] + P_LR[1] + P_UR[1] + P_UL[1]) / 4.0
+
+            die_info_cache[(C, R)] = {
+                'center': (center_x, center_y),
+                'polygon': polygon
+            }
+    return die_info_cache
+
+def get_die_name(C, R, die_origin_shift):
+    C_shift, R_shift = die_origin_shift
+    C_new = C - C_shift
+    R_new = R - R_shift
+
+    Die_C = C_new % NUM_COLS
+    
+    # Die_R: Reverse the vertical direction of the repeating pattern
+    Die_R_raw = R_new % NUM_ROWS
+    Die_R = NUM_ROWS - 1 - Die_R_raw 
+    
+    die_index = Die_C * NUM_ROWS + Die_R 
+    return DIE_NAMES[die_index % len(DIE_NAMES)]
+
+
+def _clip_bbox(bbox, W, H):
+    """Clips an (x0, y0, x1, y1) box to the image. Returns None if nothing is left."""
+    x0, y0, x1, y1 = bbox
+    x0, y0 = max(0, int(math.floor(x0))), max(0, int(math.floor(y0)))
+    x1, y1 = min(W, int(math.ceil(x1))), min(H, int(math.ceil(y1)))
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return (x0, y0, x1, y1)
+
+def _union_bbox(a, b):
+    if a is None: 
+        return b
+    if b is None: 
+        return a
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+def _iter_tiles(bbox, W, H, tile_size=MASK_TILE_SIZE):
+    """Yields ((tx, ty), tile_box) for every tile of the image grid overlapping bbox."""
+    x0, y0, x1, y1 = bbox
+    for ty in range(y0 // tile_size, (y1 - 1) // tile_size + 1):
+        for tx in range(x0 // tile_size, (x1 - 1) // tile_size + 1):
+            box = (tx * tile_size, ty * tile_size, 
+                   min(W, (tx + 1) * tile_size), min(H, (ty + 1) * tile_size))
+            yield (tx, ty), box
+
+
+# Number of set bits of every byte value, for popcount over packed masks
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+_BITMASK_BAND_ROWS = 1024
+
+def disk_region(box, center, radius):
+    """Boolean array of the pixels of box whose center lies inside the circle."""
+    x0, y0, x1, y1 = box
+    ux, uy = center
+    dx_sq = (np.arange(x0, x1) + 0.5 - ux) ** 2
+    dy_sq = (np.arange(y0, y1) + 0.5 - uy) ** 2
+    return (dy_sq[:, None] + dx_sq[None, :]) < radius ** 2
+
+
+class BitMask:
+    """
+    Binary image mask stored bit-packed: one bit per pixel, each row padded to whole bytes
+    (np.packbits order). Regions are unpacked only on demand, so a 40k x 40k mask takes
+    ~200 MB instead of the 6.4 GB of an RGBA layer.
+    """
+    def __init__(self, W, H):
+        self.size = (W, H)
+        self.bits = np.zeros((H, (W + 7) // 8), dtype=np.uint8)
+
+    @classmethod
+    def from_disk(cls, W, H, center, radius):
+        mask = cls(W, H)
+        bbox = _clip_bbox((center[0] - radius, center[1] - radius, center[0] + radius + 1, center[1] + radius + 1), W, H)
+        if bbox is not None:
+            for y0 in range(bbox[1], bbox[3], _BITMASK_BAND_ROWS):
+                y1 = min(bbox[3], y0 + _BITMASK_BAND_ROWS)
+                mask.bits[y0:y1] = np.packbits(disk_region((0, y0, W, y1), center, radius), axis=1)
+        return mask
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def region(self, box):
+        """Unpacked boolean array (y1 - y0, x1 - x0) of an (x0, y0, x1, y1) box."""
+        x0, y0, x1, y1 = box
+        b0, b1 = x0 >> 3, (x1 + 7) >> 3
+        block = np.unpackbits(self.bits[y0:y1, b0:b1], axis=1)
+        return block[:, x0 - b0 * 8:x1 - b0 * 8].view(bool)
+
+    def region_sampled(self, box, step):
+        """Every step-th pixel of region(box) in both directions, unpacking only the sampled rows."""
+        x0, y0, x1, y1 = box
+        b0, b1 = x0 >> 3, (x1 + 7) >> 3
+        block = np.unpackbits(self.bits[y0:y1:step, b0:b1], axis=1)
+        return block[:, x0 - b0 * 8:x1 - b0 * 8:step].view(bool)
+
+    def _write(self, box, values, op):
+        x0, y0, x1, y1 = box
+        b0, b1 = x0 >> 3, (x1 + 7) >> 3
+        block = np.unpackbits(self.bits[y0:y1, b0:b1], axis=1).view(bool)
+        target = block[:, x0 - b0 * 8:x1 - b0 * 8]
+        if op == 'or':
+            target |= values
+        elif op == 'clear':
+            target &= ~values
+        else:
+            target[...] = values
+        self.bits[y0:y1, b0:b1] = np.packbits(block, axis=1)
+
+    def or_region(self, box, values):
+        self._write(box, values, 'or')
+
+    def clear_region(self, box, values):
+        self._write(box, values, 'clear')
+
+    def set_region(self, box, values):
+        self._write(box, values, 'set')
+
+    def get(self, x, y):
+        return bool((self.bits[y, x >> 3] >> (7 - (x & 7))) & 1)
+
+    def clear(self):
+        self.bits[...] = 0
+
+    def getbbox(self):
+        """Bounding box of the set pixels (to byte granularity in x), or None if empty."""
+        rows = np.flatnonzero(self.bits.any(axis=1))
+        if rows.size == 0:
+            return None
+        cols = np.flatnonzero(self.bits[rows[0]:rows[-1] + 1].any(axis=0))
+        return (int(cols[0]) * 8, int(rows[0]), min(self.size[0], (int(cols[-1]) + 1) * 8), int(rows[-1]) + 1)
+
+    def count(self, other=None, box=None):
+        """
+        Popcount of the mask, or of (mask AND other) when another BitMask of the same size is given.
+        A box restricts the count to the bytes covering it (x is widened to whole bytes).
+        """
+        x0, y0, x1, y1 = box if box is not None else (0, 0) + self.size
+        cols = slice(x0 >> 3, (x1 + 7) >> 3)
+        total = 0
+        for b0 in range(y0, y1, _BITMASK_BAND_ROWS):
+            b1 = min(y1, b0 + _BITMASK_BAND_ROWS)
+            band = self.bits[b0:b1, cols]
+            if other is not None:
+                band = band & other.bits[b0:b1, cols]
+            if band.any():
+                total += int(_POPCOUNT[band].sum(dtype=np.int64))
+        return total
+
+    def resized(self, W, H):
+        """Nearest-neighbour copy of the mask at another size, built band by band."""
+        mask = BitMask(W, H)
+        src_W, src_H = self.size
+        xs = np.minimum(((np.arange(W) + 0.5) * src_W / W).astype(np.int64), src_W - 1)
+        for y0 in range(0, H, _BITMASK_BAND_ROWS):
+            y1 = min(H, y0 + _BITMASK_BAND_ROWS)
+            ys = np.minimum(((np.arange(y0, y1) + 0.5) * src_H / H).astype(np.int64), src_H - 1)
+            rows = self.region((0, int(ys[0]), src_W, int(ys[-1]) + 1))
+            mask.bits[y0:y1] = np.packbits(rows[ys - ys[0]][:, xs], axis=1)
+        return mask
+
+    def to_image(self, box, on_value=255):
+        """'L' image of a box: on_value where set, 0 elsewhere."""
+        return Image.fromarray(self.region(box).astype(np.uint8) * np.uint8(on_value))
+
+    def read_tile(self, box):
+        """Raw packed bytes of a byte-aligned box (see MASK_TILE_SIZE)."""
+        x0, y0, x1, y1 = box
+        return self.bits[y0:y1, x0 >> 3:(x1 + 7) >> 3].tobytes()
+
+    def write_tile(self, box, data):
+        x0, y0, x1, y1 = box
+        b0, b1 = x0 >> 3, (x1 + 7) >> 3
+        self.bits[y0:y1, b0:b1] = np.frombuffer(data, dtype=np.uint8).reshape(y1 - y0, b1 - b0)
+
+
+def build_display_pyramid(image, levels, min_size=DISPLAY_PYRAMID_MIN_SIZE):
+    """
+    Appends successively halved (box-filtered) copies of image to levels, where levels[0] is the
+    image itself. Level k has size ceil(size / 2**k). Meant to run on a background thread.
+    """
+    current = image
+    while max(current.size) > min_size:
+        current = current.reduce(2)
+        levels.append(current)
+
+
+# --- Display Enhancement ---
+
+def _clahe_luts(values, grid, clip_limit):
+    """
+    Contrast-limited equalization LUTs (grid_y, grid_x, 256) of an 8-bit image split into grid cells:
+    each cell histogram is clipped at clip_limit times the uniform bin count, the excess spread evenly.
+    """
+    H, W = values.shape
+    gy, gx = min(grid, H), min(grid, W)
+    luts = np.zeros((gy, gx, 256), dtype=np.uint8)
+    ys, xs = np.linspace(0, H, gy + 1).astype(int), np.linspace(0, W, gx + 1).astype(int)
+    for j in range(gy):
+        for i in range(gx):
+            cell = values[ys[j]:ys[j + 1], xs[i]:xs[i + 1]]
+            hist = np.bincount(cell.ravel(), minlength=256).astype(np.float64)
+            limit = max(1.0, clip_limit * cell.size / 256)
+            excess = np.maximum(hist - limit, 0).sum()
+            hist = np.minimum(hist, limit) + excess / 256
+            cdf = np.cumsum(hist)
+            luts[j, i] = np.round(255 * (cdf - cdf[0]) / max(cdf[-1] - cdf[0], 1e-9)).astype(np.uint8)
+    return luts
+
+class DisplayEnhancer:
+    """
+    Display-only contrast enhancement: channel select, percentile stretch, CLAHE and gamma.
+    Statistics (percentiles, CLAHE cell LUTs) come once from a thumbnail, so every pixel maps the
+    same way in every tile and pyramid level. Enhanced tiles are cached per (level, tile) and only
+    dropped when the parameters or the image change; the analysed pixels are never modified.
+    """
+    CHANNELS = {'RGB': None, 'Red': 0, 'Green': 1, 'Blue': 2, 'Gray': 'L'}
+
+    def __init__(self, tile_size=ENHANCE_TILE_SIZE, memory_limit_bytes=ENHANCE_CACHE_MB * 1024 * 1024):
+        self.tile_size = tile_size
+        self.memory_limit_bytes = memory_limit_bytes
+        self.params = {'channel': 'RGB', 'stretch': False, 'clahe': False, 'gamma': 1.0}
+        self.image = None
+        self.stats = None
+        self.tiles = OrderedDict()
+        self.memory_used = 0
+
+    @property
+    def active(self):
+        p = self.params
+        return p['channel'] != 'RGB' or p['stretch'] or p['clahe'] or p['gamma'] != 1.0
+
+    def set_image(self, image):
+        """Drops every cached tile; image is the full-resolution (level 0) source."""
+        self.image = image
+        self._invalidate()
+
+    def set_params(self, **params):
+        """Updates filter parameters. Returns True if anything changed (and the cache was dropped)."""
+        params = {key: value for key, value in params.items() if self.params.get(key) != value}
+        if not params:
+            return False
+        self.params.update(params)
+        self._invalidate()
+        return True
+
+    def region(self, source, level, box):
+        """Enhanced copy of box (in the level's pixels) of source, pyramid level `level` of the image."""
+        if self.stats is None:
+            self.stats = self._compute_stats()
+        x0, y0, x1, y1 = box
+        W, H = source.size
+        out = None
+        for (tx, ty), tile_box in _iter_tiles(box, W, H, self.tile_size):
+            key = (level, tx, ty)
+            tile = self.tiles.get(key)
+            if tile is None:
+                tile = self._enhance(source.crop(tile_box), tile_box, level)
+                self.tiles[key] = tile
+                self.memory_used += len(tile.mode) * tile.width * tile.height
+                self._evict()
+            else:
+                self.tiles.move_to_end(key)
+            if out is None:
+                out = Image.new(tile.mode, (x1 - x0, y1 - y0))
+            out.paste(tile, (tile_box[0] - x0, tile_box[1] - y0))
+        return out
+
+    # --- Internals ---
+    def _invalidate(self):
+        self.tiles.clear()
+        self.memory_used = 0
+        self.stats = None
+
+    def _evict(self):
+        while self.memory_used > self.memory_limit_bytes and len(self.tiles) > 1:
+            _, tile = self.tiles.popitem(last=False)
+            self.memory_used -= len(tile.mode) * tile.width * tile.height
+
+    def _values(self, image):
+        """uint8 array (h, w) of the selected channel, or (h, w, 3) for RGB."""
+        channel = self.CHANNELS[self.params['channel']]
+        if channel == 'L':
+            return np.asarray(image.convert('L'))
+        arr = np.asarray(image)
+        return arr if channel is None or arr.ndim == 2 else arr[..., channel]
+
+    def _compute_stats(self):
+        p = self.params
+        W, H = self.image.size
+        scale = min(1.0, ENHANCE_STATS_SIZE / max(W, H))
+        thumb = self.image.resize((max(1, round(W * scale)), max(1, round(H * scale))), Image.BILINEAR, reducing_gap=2.0)
+        intensity = self._values(thumb)
+        if intensity.ndim == 3:
+            intensity = np.asarray(thumb.convert('L'))
+        
+        lut = np.arange(256, dtype=np.float64)
+        if p['stretch']:
+            low, high = np.percentile(intensity, ENHANCE_STRETCH_PERCENTILES)
+            lut = np.clip((lut - low) * 255.0 / max(high - low, 1.0), 0, 255)
+        stats = {'pre': np.round(lut).astype(np.uint8), 'clahe': None}
+        if p['clahe']:
+            stats['clahe'] = _clahe_luts(stats['pre'][intensity], ENHANCE_CLAHE_GRID, ENHANCE_CLAHE_CLIP)
+            stats['cell'] = (W / stats['clahe'].shape[1], H / stats['clahe'].shape[0])
+        gamma = np.arange(256, dtype=np.float64)
+        if p['gamma'] != 1.0:
+            gamma = 255.0 * (gamma / 255.0) ** (1.0 / p['gamma'])
+        stats['post'] = np.round(gamma).astype(np.uint8)
+        return stats
+
+    def _enhance(self, tile, tile_box, level):
+        stats = self.stats
+        values = stats['pre'][self._values(tile)]
+        luts = stats['clahe']
+        if luts is not None:
+            # Bilinear blend of the LUTs of the four nearest CLAHE cells, positioned in level-0 pixels
+            step = 2 ** level
+            cell_w, cell_h = stats['cell']
+            gy, gx = luts.shape[:2]
+            fx = np.clip((np.arange(tile_box[0], tile_box[2]) + 0.5) * step / cell_w - 0.5, 0, gx - 1)
+            fy = np.clip((np.arange(tile_box[1], tile_box[3]) + 0.5) * step / cell_h - 0.5, 0, gy - 1)
+            i0, j0 = fx.astype(np.int64), fy.astype(np.int64)
+            i1, j1 = np.minimum(i0 + 1, gx - 1), np.minimum(j0 + 1, gy - 1)
+            wx, wy = fx - i0, fy - j0
+            if values.ndim == 3:
+                i0, i1, wx = i0[:, None], i1[:, None], wx[:, None]
+                j0, j1, wy = j0[:, None, None], j1[:, None, None], wy[:, None, None]
+            else:
+                j0, j1, wy = j0[:, None], j1[:, None], wy[:, None]
+            top = (1 - wx) * luts[j0, i0, values] + wx * luts[j0, i1, values]
+            bottom = (1 - wx) * luts[j1, i0, values] + wx * luts[j1, i1, values]
+            values = np.round((1 - wy) * top + wy * bottom).astype(np.uint8)
+        return Image.fromarray(stats['post'][values])
+
+
+class MaskHistory:
+    """
+    Undo/redo history for mask edits and SCP moves.
+    A mask action only keeps the zlib-compressed tiles it touched (captured before the
+    first write), so its cost scales with the stroke and not with the image size.
+    """
+    def __init__(self, memory_limit_bytes):
+        self.memory_limit_bytes = memory_limit_bytes
+        self.undo_stack = []
+        self.redo_stack = []
+        self.pending = None
+        self.memory_used = 0
+
+    def clear(self):
+        self.undo_stack = []
+        self.redo_stack = []
+        self.pending = None
+        self.memory_used = 0
+
+    def begin_mask_action(self):
+        self.pending = {'kind': 'mask', 'tiles': {}, 'bbox': None, 'size': 0}
+
+    def capture_tiles(self, layer, bbox):
+        """Stores the pre-edit content of every tile of a BitMask overlapping bbox, once per action."""
+        if self.pending is None or bbox is None:
+            return
+        W, H = layer.size
+        for key, box in _iter_tiles(bbox, W, H):
+            if key in self.pending['tiles']:
+                continue
+            data = zlib.compress(layer.read_tile(box), 1)
+            self.pending['tiles'][key] = (box, data)
+            self.pending['size'] += len(data)
+            self.pending['bbox'] = _union_bbox(self.pending['bbox'], box)
+
+    def end_mask_action(self):
+        action, self.pending = self.pending, None
+        if action is None or not action['tiles']:
+            return
+        self._push(self.undo_stack, action)
+        self._drop_redo()
+        self._enforce_limit()
+
+    def push_scp_action(self, points, max_c, max_r):
+        action = {'kind': 'scp', 'points': dict(points), 'max_c': max_c, 'max_r': max_r, 
+                  'size': 64 * len(points)}
+        self._push(self.undo_stack, action)
+        self._drop_redo()
+        self._enforce_limit()
+
+    def can_undo(self):
+        return bool(self.undo_stack)
+
+    def can_redo(self):
+        return bool(self.redo_stack)
+
+    def undo(self, annotator):
+        """Reverts the newest action on the annotator and returns the applied action."""
+        return self._step(self.undo_stack, self.redo_stack, annotator)
+
+    def redo(self, annotator):
+        return self._step(self.redo_stack, self.undo_stack, annotator)
+
+    # --- Internals ---
+    def _step(self, source, target, annotator):
+        if not source:
+            return None
+        action = source.pop()
+        self.memory_used -= action['size']
+        inverse = self._swap(action, annotator)
+        self._push(target, inverse)
+        self._enforce_limit()
+        return action
+
+    def _swap(self, action, annotator):
+        """Applies an action and returns the action that undoes it."""
+        if action['kind'] == 'scp':
+            inverse = {'kind': 'scp', 'points': dict(annotator.super_control_points), 
+                       'max_c': annotator.Max_C, 'max_r': annotator.Max_R, 'size': action['size']}
+            annotator.super_control_points = dict(action['points'])
+            annotator.Max_C, annotator.Max_R = action['max_c'], action['max_r']
+            return inverse
+        
+        layer = annotator.mask_paint_layer
+        inverse = {'kind': 'mask', 'tiles': {}, 'bbox': action['bbox'], 'size': 0}
+        area_before = annotator.live_counts.area_in(action['bbox'])
+        for key, (box, data) in action['tiles'].items():
+            current = zlib.compress(layer.read_tile(box), 1)
+            inverse['tiles'][key] = (box, current)
+            inverse['size'] += len(current)
+            layer.write_tile(box, zlib.decompress(data))
+        annotator.live_counts.mask_changed(action['bbox'], area_before)
+        return inverse
+
+    def _push(self, stack, action):
+        stack.append(action)
+        self.memory_used += action['size']
+
+    def _drop_redo(self):
+        for action in self.redo_stack:
+            self.memory_used -= action['size']
+        self.redo_stack = []
+
+    def _enforce_limit(self):
+        # Evict oldest-first; the redo side goes first since it is the least likely to be used.
+        while self.memory_used > self.memory_limit_bytes and self.redo_stack:
+            self.memory_used -= self.redo_stack.pop(0)['size']
+        while self.memory_used > self.memory_limit_bytes and len(self.undo_stack) > 1:
+            evicted = self.undo_stack.pop(0)
+            self.memory_used -= evicted['size']
+            logger.info(f"Undo history over {self.memory_limit_bytes / 2**20:.0f} MB, evicted oldest {evicted['kind']} action.")
+
+
+# --- Mask Journal ---
+
+def _encode_region(region):
+    return base64.b64encode(zlib.compress(np.packbits(region, axis=1).tobytes(), 6)).decode('ascii')
+
+def _decode_region(data, bbox):
+    w, h = bbox[2] - bbox[0], bbox[3] - bbox[1]
+    packed = np.frombuffer(zlib.decompress(base64.b64decode(data)), dtype=np.uint8).reshape(h, (w + 7) // 8)
+    return np.unpackbits(packed, axis=1)[:, :w].view(bool)
+
+class MaskJournal:
+    """
+    Append-only JSON-lines journal of the mask operations of one image, for crash recovery.
+    Brush strokes, lasso polygons, clears and the clipping circle are stored as vectors so they
+    can be replayed at any resolution; fills, auto masks and undo/redo results as compressed
+    bit regions. Records are buffered and written by flush() (on mouse-up and per action).
+    Every open writes an 'image' record with the size the following coordinates refer to.
+    The file is only opened by the first flush with an operation, so images that are merely
+    viewed leave no journal; without append, an existing journal is then kept as '<journal>.bak'
+    instead of being truncated. If the file cannot be written the journal turns itself off.
+    """
+    def __init__(self, filename, image_name, size, append=True):
+        self.filename = filename
+        self.append = append
+        self.file = None
+        self.failed = False
+        self.buffer = [{'op': 'image', 'version': MASK_JOURNAL_VERSION, 'image': image_name, 'size': list(size)}]
+
+    def record(self, op):
+        if not self.failed:
+            self.buffer.append(op)
+
+    def record_region(self, bbox, region, mode='or'):
+        if not self.failed:
+            self.record({'op': 'region', 'mode': mode, 'bbox': list(bbox), 'bits': _encode_region(region)})
+
+    def _open(self):
+        exists = os.path.exists(self.filename) and os.path.getsize(self.filename) > 0
+        if exists and not self.append:
+            os.replace(self.filename, self.filename + '.bak')
+            logger.info(f"Previous mask journal kept as {os.path.basename(self.filename)}.bak")
+            exists = False
+        self.file = open(self.filename, 'a' if exists else 'w')
+        if exists:
+            with open(self.filename, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self.file.write('\n') # Terminate a line cut off by a crash
+
+    def flush(self):
+        if self.failed or not self.buffer or (self.file is None and len(self.buffer) == 1):
+            return
+        try:
+            if self.file is None:
+                self._open()
+            self.file.write(''.join(json.dumps(op) + '\n' for op in self.buffer))
+            self.file.flush()
+        except OSError as e:
+            logger.warning(f"Mask journal disabled, crash recovery is off for this image: {e}")
+            self.failed = True
+        self.buffer = []
+
+    def ops(self):
+        """All operations so far (for a full-resolution replay), or None if the journal was not written."""
+        if self.failed:
+            return None
+        if self.file is None:
+            return list(self.buffer)
+        self.flush()
+        return None if self.failed else read_mask_journal(self.filename)
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+
+class _NullJournal:
+    """Stands in for MaskJournal when there is no image file to journal (placeholder image) or folder to write it to."""
+    def record(self, op):
+        pass
+
+    def ops(self):
+        return None
+
+    def record_region(self, bbox, region, mode='or'):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+def read_mask_journal(filename):
+    """Operations of a journal; a truncated last line (crash while writing) is ignored."""
+    ops = []
+    with open(filename) as f:
+        for line in f:
+            try:
+                ops.append(json.loads(line))
+            except ValueError:
+                logger.warning(f"Skipping unreadable journal line in {os.path.basename(filename)}.")
+    if not ops or ops[0].get('op') != 'image' or ops[0].get('version') != MASK_JOURNAL_VERSION:
+        raise ValueError("not a mask journal")
+    return ops
+
+def journal_has_mask_ops(filename):
+    """True if a journal exists and records anything beyond its header and circle."""
+    if not os.path.exists(filename):
+        return False
+    try:
+        return any(op['op'] not in ('image', 'circle') for op in read_mask_journal(filename))
+    except (OSError, ValueError, KeyError):
+        return False
+
+def replay_mask_journal(ops, size):
+    """
+    Rebuilds a mask of the given size from journal operations, rasterizing them at that resolution
+    (scaled from the image size of the preceding 'image' record, e.g. a working copy).
+    Returns (mask, circle_geom or None) in target pixels.
+    """
+    W, H = size
+    mask = BitMask(W, H)
+    stencil = None
+    circle = None
+    for op in ops:
+        kind = op['op']
+        if kind == 'image':
+            sx, sy = W / op['size'][0], H / op['size'][1]
+        elif kind == 'circle':
+            circle = {'center': (op['center'][0] * sx, op['center'][1] * sy), 'radius': op['radius'] * (sx + sy) / 2}
+            stencil = BitMask.from_disk(W, H, circle['center'], circle['radius'])
+        elif kind == 'clear':
+            mask.clear()
+        elif kind in ('brush', 'lasso') and stencil is not None:
+            points = [(x * sx, y * sy) for x, y in op['points']]
+            if kind == 'brush':
+                points = [(int(x), int(y)) for x, y in points]
+                brush_size = max(1, int(round(op['size'] * (sx + sy) / 2)))
+                bbox = brush_stroke_bbox(points, brush_size, W, H)
+                if bbox is not None:
+                    mask.or_region(bbox, brush_stroke_region(bbox, points, brush_size) & stencil.region(bbox))
+            elif len(points) >= 3:
+                xs, ys = [p[0] for p in points], [p[1] for p in points]
+                bbox = _clip_bbox((min(xs), min(ys), max(xs) + 1, max(ys) + 1), W, H)
+                if bbox is not None:
+                    mask.or_region(bbox, polygon_region(bbox, points) & stencil.region(bbox))
+        elif kind == 'region':
+            region = _decode_region(op['bits'], op['bbox'])
+            x0, y0, x1, y1 = op['bbox']
+            if (sx, sy) != (1.0, 1.0):
+                target = _clip_bbox((round(x0 * sx), round(y0 * sy), round(x1 * sx), round(y1 * sy)), W, H)
+                if target is None:
+                    continue
+                region_img = Image.fromarray(region.astype(np.uint8) * np.uint8(255))
+                region_img = region_img.resize((target[2] - target[0], target[3] - target[1]), Image.NEAREST)
+                region, (x0, y0, x1, y1) = np.asarray(region_img) > 0, target
+            if op['mode'] == 'set':
+                mask.set_region((x0, y0, x1, y1), region)
+            else:
+                mask.or_region((x0, y0, x1, y1), region)
+    return mask, circle
+
+
+# --- Automatic Mask Segmentation ---
+
+def estimate_wafer_color(rgb, stencil):
+    """Median RGB of the pixels inside the stencil; the 'normal' wafer surface color."""
+    inside = rgb[stencil]
+    if inside.size == 0:
+        return np.zeros(3, dtype=np.float32)
+    return np.median(inside, axis=0).astype(np.float32)
+
+def compute_anomaly_mask(rgb, stencil, method, threshold, morph_size, reference_color=None, contrast_radius=8):
+    """
+    Segments anomalous pixels of an RGB array (H, W, 3) inside a boolean stencil.
+    method 'color': Euclidean distance to reference_color above threshold.
+    method 'contrast': distance of the gray value to its local box mean above threshold.
+    The result is cleaned with a morphological opening then closing of size morph_size.
+    """
+    if method == 'contrast':
+        gray_img = Image.fromarray(rgb).convert('L')
+        local_mean = np.asarray(gray_img.filter(ImageFilter.BoxBlur(contrast_radius)), dtype=np.int16)
+        distance = np.abs(np.asarray(gray_img, dtype=np.int16) - local_mean)
+    else:
+        diff = rgb.astype(np.float32) - reference_color
+        distance = np.sqrt(np.einsum('ijk,ijk->ij', diff, diff))
+        
+    anomaly = (distance > threshold) & stencil
+    
+    if morph_size > 1:
+        k = int(morph_size) | 1 # Odd size keeps the structuring element centered
+        anomaly = _binary_dilate(_binary_erode(anomaly, k), k) # Opening: drop specks
+        anomaly = _binary_erode(_binary_dilate(anomaly, k), k) # Closing: fill pinholes
+        anomaly &= stencil
+    return anomaly
+
+def _box_count(mask, k):
+    """Number of set pixels in the k x k box around every pixel (separable cumulative sums)."""
+    r = k // 2
+    padded = np.pad(mask.astype(np.int32), r)
+    c = np.cumsum(padded, axis=0)
+    c = np.concatenate([np.zeros((1, c.shape[1]), np.int32), c], axis=0)
+    rows = c[k:] - c[:-k]
+    c = np.cumsum(rows, axis=1)
+    c = np.concatenate([np.zeros((c.shape[0], 1), np.int32), c], axis=1)
+    return c[:, k:] - c[:, :-k]
+
+def _binary_dilate(mask, k):
+    return _box_count(mask, k) > 0
+
+def _binary_erode(mask, k):
+    return _box_count(~mask, k) == 0
+
+def _anomaly_mask_tile(image, stencil_mask, tile_box, halo, params):
+    """Runs compute_anomaly_mask on one tile plus a halo, returns the tile's core result."""
+    W, H = image.size
+    x0, y0, x1, y1 = tile_box
+    hx0, hy0 = max(0, x0 - halo), max(0, y0 - halo)
+    hx1, hy1 = min(W, x1 + halo), min(H, y1 + halo)
+    stencil = stencil_mask.region((hx0, hy0, hx1, hy1))
+    if not stencil.any():
+        return tile_box, None
+    rgb = np.asarray(image.crop((hx0, hy0, hx1, hy1)))
+    anomaly = compute_anomaly_mask(rgb, stencil, **params)
+    core = anomaly[y0 - hy0:y1 - hy0, x0 - hx0:x1 - hx0]
+    return tile_box, (core if core.any() else None)
+
+def compute_anomaly_mask_tiled(image, stencil_mask, params, tile_size=AUTO_MASK_TILE_SIZE, workers=AUTO_MASK_WORKERS):
+    """
+    Full-resolution anomaly segmentation inside a BitMask stencil, processed tile-parallel on a
+    thread pool. Yields (tile_box, bool core array) for every tile that contains anomalous pixels.
+    """
+    W, H = image.size
+    halo = 2 * int(params.get('morph_size', 0)) + int(params.get('contrast_radius', 8)) + 2
+    bbox = stencil_mask.getbbox()
+    if bbox is None:
+        return
+    tiles = [box for _, box in _iter_tiles(bbox, W, H, tile_size)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for tile_box, core in pool.map(lambda box: _anomaly_mask_tile(image, stencil_mask, box, halo, params), tiles):
+            if core is not None:
+                yield tile_box, core
+
+
+# --- Lasso and Flood Fill ---
+
+def brush_stroke_bbox(points, brush_size, W, H):
+    r = brush_size / 2
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return _clip_bbox((min(xs) - r - 1, min(ys) - r - 1, max(xs) + r + 2, max(ys) + r + 2), W, H)
+
+def brush_stroke_region(bbox, points, brush_size):
+    """Boolean raster over bbox of a square-brush stroke through integer points."""
+    r = brush_size / 2
+    x0, y0 = bbox[:2]
+    local_points = [(x - x0, y - y0) for x, y in points]
+    stroke_img = Image.new('L', (bbox[2] - x0, bbox[3] - y0), 0)
+    stroke_draw = ImageDraw.Draw(stroke_img)
+    stroke_draw.line(local_points, fill=255, width=brush_size, joint='bevel')
+    for x, y in local_points[1:]:
+        bbox_cap = [x - r, y - r, x + r, y + r]
+        stroke_draw.rectangle(bbox_cap, fill=255)
+    return np.asarray(stroke_img) > 0
+
+def polygon_region(box, vertices, band_height=_BITMASK_BAND_ROWS):
+    """
+    Even-odd scanline rasterization of a polygon over an (x0, y0, x1, y1) box, using the same
+    pixel-center convention as disk_region. Every row's edge crossings toggle a parity array that
+    is resolved with one cumulative sum, so no per-pixel point-in-polygon test is needed.
+    """
+    x0, y0, x1, y1 = box
+    w, h = x1 - x0, y1 - y0
+    out = np.zeros((h, w), dtype=bool)
+    pts = np.asarray(vertices, dtype=np.float64)
+    if len(pts) < 3 or w <= 0 or h <= 0:
+        return out
+    ax, ay = pts[:, 0], pts[:, 1]
+    bx, by = np.roll(ax, -1), np.roll(ay, -1)
+    keep = ay != by # Horizontal edges never cross a scanline
+    ax, ay, bx, by = ax[keep], ay[keep], bx[keep], by[keep]
+    lo, hi = np.minimum(ay, by), np.maximum(ay, by)
+    
+    for r0 in range(0, h, band_height):
+        r1 = min(h, r0 + band_height)
+        yc = np.arange(y0 + r0, y0 + r1, dtype=np.float64)[:, None] + 0.5
+        hit = (yc >= lo) & (yc < hi)
+        rows, edges = np.nonzero(hit)
+        if rows.size == 0:
+            continue
+        t = (yc[rows, 0] - ay[edges]) / (by[edges] - ay[edges])
+        xc = ax[edges] + t * (bx[edges] - ax[edges])
+        # Pixel column c is inside once an odd number of crossings lie left of its center c + 0.5
+        cols = np.clip(np.ceil(xc - 0.5 - x0), 0, w).astype(np.int64)
+        toggles = np.zeros((r1 - r0, w + 1), dtype=np.uint8)
+        np.add.at(toggles, (rows, cols), 1)
+        # uint8 wrap-around keeps the parity, which is all that is needed
+        out[r0:r1] = (np.cumsum(toggles[:, :w], axis=1, dtype=np.uint8) & 1).astype(bool)
+    return out
+
+def _row_runs(row):
+    """(starts, ends) of the True runs of a boolean row, ends exclusive."""
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], row.view(np.int8), [0]))))
+    return edges[0::2], edges[1::2]
+
+def flood_fill_region(candidate, seed):
+    """
+    4-connected flood fill of a boolean candidate array from seed (x, y), run-based: each row is
+    split into runs once and the fill walks overlapping runs of neighbouring rows, so the work
+    scales with the number of runs rather than pixels.
+    """
+    h, w = candidate.shape
+    sx, sy = seed
+    out = np.zeros((h, w), dtype=bool)
+    if not (0 <= sx < w and 0 <= sy < h) or not candidate[sy, sx]:
+        return out
+    runs = {}
+    visited = {}
+    
+    def row_runs(y):
+        if y not in runs:
+            runs[y] = _row_runs(candidate[y])
+            visited[y] = np.zeros(len(runs[y][0]), dtype=bool)
+        return runs[y]
+    
+    starts, ends = row_runs(sy)
+    k = int(np.searchsorted(starts, sx, side='right')) - 1
+    stack = [(sy, k)]
+    visited[sy][k] = True
+    while stack:
+        y, k = stack.pop()
+        s, e = runs[y][0][k], runs[y][1][k]
+        out[y, s:e] = True
+        for ny in (y - 1, y + 1):
+            if not 0 <= ny < h:
+                continue
+            n_starts, n_ends = row_runs(ny)
+            # Runs of the neighbouring row that overlap [s, e)
+            first = int(np.searchsorted(n_ends, s, side='right'))
+            last = int(np.searchsorted(n_starts, e, side='left'))
+            for nk in range(first, last):
+                if not visited[ny][nk]:
+                    visited[ny][nk] = True
+                    stack.append((ny, nk))
+    return out
+
+
+# --- Per-Die Statistics ---
+
+def die_table_arrays(die_info_cache):
+    """Flattens die_info_cache into arrays: keys (N, 2) int, polygons (N, 4, 2) and centers (N, 2)."""
+    keys = list(die_info_cache.keys())
+    if not keys:
+        return np.zeros((0, 2), dtype=np.int64), np.zeros((0, 4, 2)), np.zeros((0, 2))
+    polygons = np.array([die_info_cache[k]['polygon'] for k in keys], dtype=np.float64)
+    centers = np.array([die_info_cache[k]['center'] for k in keys], dtype=np.float64)
+    return np.array(keys, dtype=np.int64), polygons, centers
+
+def _band_gray_and_edge(image, y0, y1):
+    """Pixels of rows y0..y1 as an (n, bands) array, and the squared gray gradient of every pixel."""
+    W, H = image.size
+    # One extra row below the band so the vertical gradient is continuous across bands
+    y1_ext = min(H, y1 + 1)
+    values_ext = np.asarray(image.crop((0, y0, W, y1_ext)), dtype=np.float64)
+    if values_ext.ndim == 2:
+        values_ext = values_ext[:, :, None]
+    gray_ext = values_ext.mean(axis=2)
+    grad_x = np.zeros_like(gray_ext)
+    grad_x[:, :-1] = np.diff(gray_ext, axis=1)
+    grad_y = np.zeros_like(gray_ext)
+    grad_y[:-1, :] = np.diff(gray_ext, axis=0)
+    edge = (grad_x ** 2 + grad_y ** 2)[:y1 - y0].ravel()
+    return values_ext[:y1 - y0].reshape(-1, values_ext.shape[2]), edge
+
+def _die_label_bands(polygons, W, H, band_height):
+    """Yields (y0, y1, labels) per band of rows holding dies: the flat label image, die i + 1 inside polygon i."""
+    y_min = polygons[:, :, 1].min(axis=1)
+    y_max = polygons[:, :, 1].max(axis=1)
+    for y0 in range(0, H, band_height):
+        y1 = min(H, y0 + band_height)
+        in_band = np.nonzero((y_max >= y0) & (y_min < y1))[0]
+        if in_band.size == 0:
+            continue
+        label_img = Image.new('I', (W, y1 - y0), 0)
+        label_draw = ImageDraw.Draw(label_img)
+        for idx in in_band:
+            label_draw.polygon([(x, y - y0) for x, y in polygons[idx]], fill=int(idx) + 1)
+        yield y0, y1, np.asarray(label_img, dtype=np.int64).ravel()
+
+def compute_die_statistics(image, masked_region, polygons, band_height=DIE_STATS_BAND_HEIGHT, layers=None):
+    """
+    Per-die features of an RGB image inside each die polygon (N, 4, 2).
+    The polygons are rasterized into a label image (band by band to bound memory) and all
+    features come from one bincount group-by per band, so the cost does not depend on N.
+    masked_region(box) must return the boolean mask for an (x0, y0, x1, y1) box.
+    layers optionally maps names to further images of the same wafer and size (see LayerStack),
+    or to anything with size and crop(box) such as LayerBands. They get gray-level mean, std and
+    edge energy per die, one layer per pass over the bands so that only one is read at a time;
+    a layer with a release() method is released after its pass.
+    Returns a dict of arrays: pixel_count, mean (N, 3), std (N, 3), edge_energy, masked_fraction,
+    and 'layers' ({name: {'mean', 'std', 'edge_energy'}}, empty without layers).
+    """
+    N = len(polygons)
+    W, H = image.size
+    layers = layers or {}
+    n_labels = N + 1 # Label 0 is background
+    count = np.zeros(n_labels)
+    sums = np.zeros((n_labels, 3))
+    sums_sq = np.zeros((n_labels, 3))
+    edge_sum = np.zeros(n_labels)
+    masked_sum = np.zeros(n_labels)
+    layer_sums = {name: np.zeros((3, n_labels)) for name in layers} # gray sum, gray sum of squares, edge sum
+    
+    if N > 0:
+        for y0, y1, labels in _die_label_bands(polygons, W, H, band_height):
+            rgb, edge = _band_gray_and_edge(image, y0, y1)
+            masked = masked_region((0, y0, W, y1)).ravel()
+            
+            count += np.bincount(labels, minlength=n_labels)
+            for ch in range(3):
+                sums[:, ch] += np.bincount(labels, weights=rgb[:, ch], minlength=n_labels)
+                sums_sq[:, ch] += np.bincount(labels, weights=rgb[:, ch] ** 2, minlength=n_labels)
+            edge_sum += np.bincount(labels, weights=edge, minlength=n_labels)
+            masked_sum += np.bincount(labels, weights=masked, minlength=n_labels)
+        for name, layer in layers.items():
+            for y0, y1, labels in _die_label_bands(polygons, W, H, band_height):
+                values, layer_edge = _band_gray_and_edge(layer, y0, y1)
+                gray = values.mean(axis=1)
+                layer_sums[name] += [np.bincount(labels, weights=gray, minlength=n_labels),
+                                     np.bincount(labels, weights=gray ** 2, minlength=n_labels),
+                                     np.bincount(labels, weights=layer_edge, minlength=n_labels)]
+            if hasattr(layer, 'release'):
+                layer.release()
+    
+    pixel_count = count[1:]
+    safe_count = np.maximum(pixel_count, 1)[:, None]
+    mean = sums[1:] / safe_count
+    std = np.sqrt(np.maximum(sums_sq[1:] / safe_count - mean ** 2, 0.0))
+    layer_stats = {}
+    for name, (gray_sum, gray_sq, layer_edge) in layer_sums.items():
+        layer_mean = gray_sum[1:] / safe_count[:, 0]
+        layer_stats[name] = {'mean': layer_mean, 
+                             'std': np.sqrt(np.maximum(gray_sq[1:] / safe_count[:, 0] - layer_mean ** 2, 0.0)),
+                             'edge_energy': layer_edge[1:] / safe_count[:, 0]}
+    return {
+        'pixel_count': pixel_count,
+        'mean': mean,
+        'std': std,
+        'edge_energy': edge_sum[1:] / safe_count[:, 0],
+        'masked_fraction': masked_sum[1:] / safe_count[:, 0],
+        'layers': layer_stats,
+    }
+
+def die_name_indices(keys, origin_shift):
+    """Vectorized _get_die_name: index into DIE_NAMES for every (C, R) row of keys."""
+    C_new = keys[:, 0] - origin_shift[0]
+    R_new = keys[:, 1] - origin_shift[1]
+    Die_C = C_new % NUM_COLS
+    Die_R = NUM_ROWS - 1 - (R_new % NUM_ROWS)
+    return (Die_C * NUM_ROWS + Die_R) % len(DIE_NAMES)
+
+def flag_die_outliers(stats, candidates, sigma=DIE_STATS_FLAG_SIGMA):
+    """
+    Flags dies whose mean gray level or edge energy is a robust (median/MAD) outlier
+    among the candidate dies. Returns a boolean array over all dies.
+    """
+    flagged = np.zeros(len(candidates), dtype=bool)
+    if candidates.sum() < 3:
+        return flagged
+    for feature in (stats['mean'].mean(axis=1), stats['edge_energy']):
+        values = feature[candidates]
+        median = np.median(values)
+        mad = np.median(np.abs(values - median)) * 1.4826
+        if mad <= 0:
+            continue
+        flagged |= candidates & (np.abs(feature - median) / mad > sigma)
+    return flagged
+
+
+# --- Die Classification ---
+
+def classify_dies(polygons, center, radius, edge_exclusion=0.0):
+    """
+    Classifies every die polygon (N, 4, 2) against the wafer circle in one vectorized pass.
+    The usable area is the circle shrunk by edge_exclusion. FULL dies have all four corners
+    in the usable area; PARTIAL dies overlap it without being contained; EXCLUDED dies touch
+    the wafer only inside the exclusion ring. Returns an int8 array of DIE_* classes.
+    """
+    classes = np.full(len(polygons), DIE_OUTSIDE, dtype=np.int8)
+    if len(polygons) == 0:
+        return classes
+    usable_sq = max(0.0, radius - edge_exclusion) ** 2
+    
+    rel = polygons - np.asarray(center, dtype=np.float64) # Corners relative to the circle center
+    max_corner_sq = (rel ** 2).sum(axis=2).max(axis=1)
+    
+    # Closest point of each polygon to the circle center: nearest point on the 4 edges,
+    # or the center itself when it lies inside the (convex) polygon.
+    start = rel
+    edge = np.roll(rel, -1, axis=1) - rel
+    edge_len_sq = np.maximum((edge ** 2).sum(axis=2), 1e-12)
+    t = np.clip(-(start * edge).sum(axis=2) / edge_len_sq, 0.0, 1.0)
+    closest = start + t[:, :, None] * edge
+    min_dist_sq = (closest ** 2).sum(axis=2).min(axis=1)
+    cross = start[:, :, 0] * edge[:, :, 1] - start[:, :, 1] * edge[:, :, 0]
+    contains_center = np.all(cross >= 0, axis=1) | np.all(cross <= 0, axis=1)
+    min_dist_sq[contains_center] = 0.0
+    
+    classes[min_dist_sq < radius ** 2] = DIE_EXCLUDED
+    classes[min_dist_sq < usable_sq] = DIE_PARTIAL
+    classes[(max_corner_sq <= usable_sq) & (usable_sq > 0)] = DIE_FULL
+    return classes
+
+def sample_mask_at_points(masked_region, points, W, H, band_height=DIE_STATS_BAND_HEIGHT):
+    """Masked state at each (x, y) point, reading the mask in row bands instead of per pixel."""
+    result = np.zeros(len(points), dtype=bool)
+    if len(points) == 0:
+        return result
+    ix = np.clip(points[:, 0].astype(np.int64), 0, W - 1)
+    iy = np.clip(points[:, 1].astype(np.int64), 0, H - 1)
+    x0, x1 = int(ix.min()), int(ix.max()) + 1
+    for y0 in range(int(iy.min()), int(iy.max()) + 1, band_height):
+        y1 = min(H, y0 + band_height)
+        in_band = np.nonzero((iy >= y0) & (iy < y1))[0]
+        if in_band.size == 0:
+            continue
+        band = masked_region((x0, y0, x1, y1))
+        result[in_band] = band[iy[in_band] - y0, ix[in_band] - x0]
+    return result
+
+def circle_mask_area(masked_region, W, H, center, radius, band_height=DIE_STATS_BAND_HEIGHT):
+    """Exact number of masked pixels whose center lies inside the circle."""
+    ux, uy = center
+    bbox = _clip_bbox((ux - radius, uy - radius, ux + radius + 1, uy + radius + 1), W, H)
+    if bbox is None:
+        return 0
+    x0, y0, x1, y1 = bbox
+    dx_sq = (np.arange(x0, x1) + 0.5 - ux) ** 2
+    area = 0
+    for by0 in range(y0, y1, band_height):
+        by1 = min(y1, by0 + band_height)
+        dy_sq = (np.arange(by0, by1) + 0.5 - uy) ** 2
+        disk = (dy_sq[:, None] + dx_sq[None, :]) < radius ** 2
+        area += int(np.count_nonzero(masked_region((x0, by0, x1, by1)) & disk))
+    return area
+
+
+# --- Live Die Counts ---
+
+class LiveDieCounts:
+    """
+    Die counts and masked area kept current while the mask and grid are edited, so the
+    statistics panel and the report read counters instead of recounting. A mask edit only
+    re-counts the bytes of its bounding box and re-samples the dies centered inside it.
+    """
+    def __init__(self):
+        self.mask = None
+        self.stencil = None
+        self.mask_area = 0
+        self.die_table = None
+        self.masked = np.zeros(0, dtype=bool)
+        self.center_px = np.zeros((0, 2), dtype=np.int64)
+        self.full = np.zeros(0, dtype=bool)
+        self.name_index = np.zeros(0, dtype=np.int64)
+        self.name_counts = np.zeros(len(DIE_NAMES), dtype=np.int64)
+        self.total_masked = 0
+        self.total_partial = 0
+        self.total_excluded = 0
+
+    def attach(self, mask, stencil):
+        """Sets the mask and circle stencil to track (full recount; on load and circle changes)."""
+        self.mask, self.stencil = mask, stencil
+        self.mask_area = mask.count(stencil) if mask is not None and stencil is not None else 0
+        self._resample(np.arange(len(self.masked)))
+
+    def set_dies(self, die_table, origin_shift):
+        """Re-samples every die of a new or re-classified die table."""
+        self.die_table = die_table
+        n = len(die_table['keys'])
+        self.masked = np.zeros(n, dtype=bool)
+        self.full = die_table['classes'] == DIE_FULL
+        self.total_partial = int((die_table['classes'] == DIE_PARTIAL).sum())
+        self.total_excluded = int((die_table['classes'] == DIE_EXCLUDED).sum())
+        if self.mask is not None and n:
+            W, H = self.mask.size
+            centers = die_table['centers']
+            self.center_px = np.stack([np.clip(centers[:, 0].astype(np.int64), 0, W - 1), 
+                                       np.clip(centers[:, 1].astype(np.int64), 0, H - 1)], axis=1)
+            self.masked = sample_mask_at_points(self.mask.region, centers, W, H)
+        else:
+            self.center_px = np.zeros((n, 2), dtype=np.int64)
+        self.set_origin(origin_shift)
+
+    def set_origin(self, origin_shift):
+        if self.die_table is None:
+            return
+        self.name_index = die_name_indices(self.die_table['keys'], origin_shift)
+        clean = self.full & ~self.masked
+        self.name_counts = np.bincount(self.name_index[clean], minlength=len(DIE_NAMES))
+        self.total_masked = int((self.full & self.masked).sum())
+
+    def area_in(self, bbox):
+        """Masked pixels inside the circle over the bytes covering bbox; pass it back to mask_changed."""
+        if self.stencil is None or bbox is None:
+            return 0
+        return self.mask.count(self.stencil, bbox)
+
+    def mask_changed(self, bbox, area_before):
+        """Updates the counters after the mask changed inside bbox."""
+        if bbox is None:
+            return
+        self.mask_area += self.area_in(bbox) - area_before
+        x0, y0, x1, y1 = bbox
+        px, py = self.center_px[:, 0], self.center_px[:, 1]
+        self._resample(np.flatnonzero((px >= x0) & (px < x1) & (py >= y0) & (py < y1)))
+
+    def _resample(self, idx):
+        if idx.size == 0 or self.mask is None:
+            return
+        W, H = self.mask.size
+        now = sample_mask_at_points(self.mask.region, self.center_px[idx], W, H)
+        changed = idx[(now != self.masked[idx]) & self.full[idx]]
+        self.masked[idx] = now
+        if changed.size:
+            became_masked = self.masked[changed]
+            np.subtract.at(self.name_counts, self.name_index[changed[became_masked]], 1)
+            np.add.at(self.name_counts, self.name_index[changed[~became_masked]], 1)
+            self.total_masked += int(became_masked.sum()) - int((~became_masked).sum())
+
+    def snapshot(self):
+        """Current counts as a dict (same keys as the corresponding compute_die_report entries)."""
+        total_in_circle = int(self.full.sum())
+        return {
+            'area_mask': self.mask_area,
+            'total_in_circle': total_in_circle,
+            'total_clean': total_in_circle - self.total_masked,
+            'total_masked': self.total_masked,
+            'total_partial': self.total_partial,
+            'total_excluded': self.total_excluded,
+            'die_counts_clean': {name: int(count) for name, count in zip(DIE_NAMES, self.name_counts)},
+        }
+
+
+# --- Report ---
+
+def compute_die_report(image, masked_region, die_table, masked, circle_geom, rectangle_geom, 
+                       die_origin_shift, edge_exclusion, mask_area=None, die_stats=None, layers=None):
+    """
+    Everything the die count report needs, without any GUI: area estimation, full/partial/excluded
+    counts, clean die counts per name and per-die appearance statistics.
+    masked is the per-die masked state aligned with die_table; die_stats may be passed in when
+    already computed for the same image, mask and polygons (and layers, the further channels
+    of the stack whose statistics are computed alongside).
+    """
+    x1, y1, x2, y2 = rectangle_geom
+    W_die_nominal, H_die_nominal = x2 - x1, y2 - y1
+    Area_Die_Nominal = W_die_nominal * H_die_nominal
+    
+    R_circ = circle_geom['radius']
+    Area_Circle = math.pi * R_circ**2
+    
+    if mask_area is None:
+        W, H = image.size
+        mask_area = circle_mask_area(masked_region, W, H, circle_geom['center'], R_circ)
+    Area_Clean = Area_Circle - mask_area
+    
+    keys, classes = die_table['keys'], die_table['classes']
+    in_circle = classes == DIE_FULL
+    clean = in_circle & ~masked
+    name_counts = np.bincount(die_name_indices(keys[clean], die_origin_shift), minlength=len(DIE_NAMES))
+    
+    if die_stats is None:
+        die_stats = compute_die_statistics(image, masked_region, die_table['polygons'], layers=layers)
+    flagged = flag_die_outliers(die_stats, clean)
+    
+    return {
+        'area_circle': Area_Circle,
+        'area_mask': mask_area,
+        'area_clean': Area_Clean,
+        'area_die_nominal': Area_Die_Nominal,
+        'estimated_dies': Area_Clean / Area_Die_Nominal,
+        'edge_exclusion': edge_exclusion,
+        'total_in_circle': int(in_circle.sum()),
+        'total_clean': int(clean.sum()),
+        'total_masked': int((in_circle & masked).sum()),
+        'total_partial': int((classes == DIE_PARTIAL).sum()),
+        'total_excluded': int((classes == DIE_EXCLUDED).sum()),
+        'die_counts_clean': {name: int(count) for name, count in zip(DIE_NAMES, name_counts)},
+        'die_origin_shift': die_origin_shift,
+        'die_table': die_table,
+        'masked': masked,
+        'in_circle': in_circle,
+        'die_stats': die_stats,
+        'flagged': flagged,
+    }
+
+def format_die_report(report, image_name, stats_name):
+    """Text of the die count report (as written to '<image>_Report.txt')."""
+    keys = report['die_table']['keys']
+    die_stats = report['die_stats']
+    flagged = report['flagged']
+    C_shift, R_shift = report['die_origin_shift']
+    
+    report_lines = []
+    report_lines.append("--- Die Count Report ---")
+    report_lines.append(f"Original Image: {image_name}")
+    report_lines.append("------------------------------------------------------")
+    report_lines.append("\n--- Area Ratio Estimation ---")
+    report_lines.append(f"Circle Area: {report['area_circle']:,.2f} px²")
+    report_lines.append(f"Mask Area (No dies, inside Circle): {report['area_mask']:,.0f} px²") 
+    report_lines.append(f"Non-masked Area (Dies, inside Circle): {report['area_clean']:,.2f} px²")
+    report_lines.append(f"Nominal Die Area (User selected): {report['area_die_nominal']:,.2f} px²")
+    report_lines.append(f"Estimated Total Dies: {report['estimated_dies']:.0f} dies") 
+    report_lines.append("------------------------------------------------------")
+    report_lines.append("\n--- Grid Die Counts ---")
+    report_lines.append(f"Edge Exclusion: {report['edge_exclusion']:g} px")
+    report_lines.append(f"Total Dies Defined by Mesh in Circle: {report['total_in_circle']}")
+    report_lines.append(f"Partial Dies (crossing the usable edge, not counted): {report['total_partial']}")
+    report_lines.append(f"Edge-Excluded Dies (not counted): {report['total_excluded']}")
+    report_lines.append(f"Total Dies in Masked Area (Removed dies): {report['total_masked']}") 
+    report_lines.append(f"Total Dies in Non-masked Area (Avilaable dies): {report['total_clean']}") 
+    report_lines.append("------------------------------------------------------")
+    report_lines.append("\n--- Detailed Die Counts (Clean/Unpainted Dies Only) ---")
+    report_lines.append("Die Type\t\tCount")
+    report_lines.append("-" * 49)
+    for name, count in report['die_counts_clean'].items():
+        report_lines.append(f"{name}:\t{count}")
+    report_lines.append("------------------------------------------------------")
+    report_lines.append("\n--- Die Appearance Statistics (Clean Dies in Circle) ---")
+    report_lines.append(f"Dies Analyzed: {report['total_clean']}")
+    report_lines.append(f"Dies Flagged by Appearance (>{DIE_STATS_FLAG_SIGMA:g} sigma): {int(flagged.sum())}")
+    for idx in np.nonzero(flagged)[0]:
+        C, R = keys[idx]
+        report_lines.append(f"  Die ({C - C_shift}, {R - R_shift}) {get_die_name(C, R, report['die_origin_shift'])}: "
+                            f"mean gray {die_stats['mean'][idx].mean():.1f}, edge energy {die_stats['edge_energy'][idx]:.1f}")
+    report_lines.append(f"Per-die statistics: {stats_name}")
+    return "\n".join(report_lines)
+
+def write_die_statistics_csv(filename, report):
+    """Writes one row of classification and appearance statistics per die."""
+    table = report['die_table']
+    stats = report['die_stats']
+    layer_stats = stats.get('layers', {})
+    C_shift, R_shift = report['die_origin_shift']
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['C', 'R', 'Die', 'Center_X', 'Center_Y', 'Class', 'In_Circle', 'Masked', 'Pixels',
+                         'Mean_R', 'Mean_G', 'Mean_B', 'Std_R', 'Std_G', 'Std_B', 
+                         'Edge_Energy', 'Masked_Fraction', 'Flagged']
+                        + [f"{name}_{column}" for name in layer_stats for column in ('Mean', 'Std', 'Edge_Energy')])
+        for idx, (C, R) in enumerate(table['keys']):
+            writer.writerow([C - C_shift, R - R_shift, get_die_name(C, R, report['die_origin_shift']),
+                             f"{table['centers'][idx][0]:.1f}", f"{table['centers'][idx][1]:.1f}",
+                             DIE_CLASS_NAMES[int(table['classes'][idx])],
+                             int(report['in_circle'][idx]), int(report['masked'][idx]), int(stats['pixel_count'][idx])]
+                            + [f"{v:.2f}" for v in stats['mean'][idx]]
+                            + [f"{v:.2f}" for v in stats['std'][idx]]
+                            + [f"{stats['edge_energy'][idx]:.2f}", f"{stats['masked_fraction'][idx]:.4f}", 
+                               int(report['flagged'][idx])]
+                            + [f"{layer[key][idx]:.2f}" for layer in layer_stats.values() 
+                               for key in ('mean', 'std', 'edge_energy')])
+
+
+# --- Die Atlas Export ---
+
+def _render_die_atlas(strip_mode, strip_size, strip_bytes, strip_origin, quads, cell_size, tile_size, grid, filename):
+    """
+    Process-pool worker: crops (or rectifies) each die of one atlas out of its source strip and
+    saves the atlas PNG. Returns the (x, y, w, h) cell of every die in atlas order.
+    """
+    strip = Image.frombytes(strip_mode, strip_size, strip_bytes)
+    cell_w, cell_h = cell_size
+    rows = -(-len(quads) // grid)
+    atlas = Image.new(strip_mode, (cell_w * min(grid, len(quads)), cell_h * rows))
+    ox, oy = strip_origin
+    cells = []
+    for i, quad in enumerate(quads):
+        P_LL, P_LR, P_UR, P_UL = [(x - ox, y - oy) for x, y in quad]
+        if tile_size:
+            crop = strip.transform(tile_size, Image.QUAD, data=P_UL + P_LL + P_LR + P_UR, resample=Image.BILINEAR)
+        else:
+            xs, ys = (P_LL[0], P_LR[0], P_UR[0], P_UL[0]), (P_LL[1], P_LR[1], P_UR[1], P_UL[1])
+            crop = strip.crop((max(int(math.floor(min(xs))), 0), max(int(math.floor(min(ys))), 0), 
+                               int(math.ceil(max(xs))), int(math.ceil(max(ys)))))
+        x, y = (i % grid) * cell_w, (i // grid) * cell_h
+        atlas.paste(crop, (x, y))
+        cells.append((x, y) + crop.size)
+    atlas.save(filename, compress_level=ATLAS_PNG_COMPRESSION)
+    return cells
+
+def extract_die_atlases(image, die_table, selection, die_origin_shift, out_dir, base_name, 
+                        tile_size=ATLAS_TILE_SIZE, grid=ATLAS_GRID, workers=ATLAS_WORKERS):
+    """
+    Writes the selected dies of die_table as crops into '<base>_Atlas_NNNN.png' files of up to
+    grid x grid cells, plus '<base>_Atlas_Index.csv' locating every die. tile_size > 0 rectifies
+    each die quad to a tile_size square, otherwise the axis-aligned bounding box is cropped.
+    Dies are taken in raster order, so each atlas is rendered from a narrow strip of the source
+    in a worker process, with at most 2 * workers strips in flight. Returns the index filename.
+    """
+    W, H = image.size
+    keys, polygons, centers = die_table['keys'], die_table['polygons'], die_table['centers']
+    indices = np.flatnonzero(selection)
+    order = indices[np.lexsort((keys[indices, 0], keys[indices, 1]))]
+    boxes = np.concatenate([np.floor(polygons[order].min(axis=1)), np.ceil(polygons[order].max(axis=1))], axis=1)
+    boxes = boxes.clip(0, [W, H, W, H]).astype(np.int64)
+    if tile_size:
+        cell_size = (int(tile_size), int(tile_size))
+    elif len(order):
+        cell_size = tuple(int(v) for v in (boxes[:, 2:] - boxes[:, :2]).max(axis=0))
+    else:
+        cell_size = (1, 1)
+    per_atlas = grid * grid
+    index_filename = os.path.join(out_dir, f"{base_name}_Atlas_Index.csv")
+    C_shift, R_shift = die_origin_shift
+    
+    # Spawned workers: the GUI and the job server are multi-threaded, and a forked child could
+    # inherit a lock (logging, caches) held by another thread and deadlock on it
+    with open(index_filename, 'w', newline='') as f, \
+         ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        writer = csv.writer(f)
+        writer.writerow(['C', 'R', 'Die', 'Center_X', 'Center_Y', 'Atlas', 'X', 'Y', 'W', 'H'])
+        pending = []
+        
+        def write_oldest():
+            future, chunk, atlas_name = pending.pop(0)
+            for idx, cell in zip(chunk, future.result()):
+                C, R = keys[idx]
+                writer.writerow([C - C_shift, R - R_shift, get_die_name(C, R, die_origin_shift),
+                                 f"{centers[idx][0]:.1f}", f"{centers[idx][1]:.1f}", atlas_name] + list(cell))
+        
+        for start in range(0, len(order), per_atlas):
+            chunk = order[start:start + per_atlas]
+            chunk_boxes = boxes[start:start + per_atlas]
+            strip_box = tuple(chunk_boxes[:, :2].min(axis=0).tolist() + chunk_boxes[:, 2:].max(axis=0).tolist())
+            strip = image.crop(strip_box)
+            atlas_name = f"{base_name}_Atlas_{start // per_atlas:04d}.png"
+            quads = [[tuple(p) for p in polygons[idx].tolist()] for idx in chunk]
+            future = pool.submit(_render_die_atlas, strip.mode, strip.size, strip.tobytes(), strip_box[:2], quads, 
+                                 cell_size, cell_size if tile_size else None, grid, os.path.join(out_dir, atlas_name))
+            pending.append((future, chunk, atlas_name))
+            if len(pending) >= 2 * workers:
+                write_oldest()
+        while pending:
+            write_oldest()
+    logger.info(f"Extracted {len(order)} dies into {-(-len(order) // per_atlas)} atlases: {index_filename}")
+    return index_filename
+
+
+# --- Rectified Export ---
+
+def mesh_corner_array(interpolated_points, Max_C, Max_R):
+    """Die corner positions of the FFD mesh as an array (Max_R + 1, Max_C + 1, 2), indexed [R, C]."""
+    corners = np.zeros((Max_R + 1, Max_C + 1, 2))
+    for (C, R), point in interpolated_points.items():
+        corners[R, C] = point
+    return corners
+
+def _rectify_tile(source, corners, pitch, out_box):
+    """Source pixels of an output tile (h, w, 3): bilinear within each die's mesh quad, bilinear sampling."""
+    pw, ph = pitch
+    x0, y0, x1, y1 = out_box
+    Max_R, Max_C = corners.shape[0] - 1, corners.shape[1] - 1
+    c = (np.arange(x0, x1) + 0.5) / pw
+    r = (np.arange(y0, y1) + 0.5) / ph
+    ci = np.minimum(c.astype(np.int64), Max_C - 1)
+    ri = np.minimum(r.astype(np.int64), Max_R - 1)
+    u, v = (c - ci)[None, :, None], (r - ri)[:, None, None]
+    ci, ri = ci[None, :], ri[:, None]
+    top = (1 - u) * corners[ri, ci] + u * corners[ri, ci + 1]
+    bottom = (1 - u) * corners[ri + 1, ci] + u * corners[ri + 1, ci + 1]
+    src = (1 - v) * top + v * bottom - 0.5 # Pixel centers sit at integer array indices
+    
+    W, H = source.size
+    bbox = _clip_bbox((src[..., 0].min(), src[..., 1].min(), src[..., 0].max() + 2, src[..., 1].max() + 2), W, H)
+    if bbox is None or bbox[2] - bbox[0] < 2 or bbox[3] - bbox[1] < 2:
+        return np.zeros((y1 - y0, x1 - x0, 3), dtype=np.uint8)
+    patch = np.asarray(source.crop(bbox), dtype=np.float32)
+    xs, ys = src[..., 0] - bbox[0], src[..., 1] - bbox[1]
+    inside = (xs >= -0.5) & (ys >= -0.5) & (xs <= patch.shape[1] - 0.5) & (ys <= patch.shape[0] - 0.5)
+    out = np.stack([_sample_bilinear(patch[..., k], xs, ys) for k in range(3)], axis=-1)
+    out[~inside] = 0
+    return np.clip(np.round(out), 0, 255).astype(np.uint8)
+
+def rectify_wafer_image(image, corners, pitch, tile_size=RECTIFY_TILE_SIZE, workers=RECTIFY_WORKERS):
+    """
+    Inverts the FFD mesh: resamples image so that die (C, R) lands exactly on
+    [R * ph:(R + 1) * ph, C * pw:(C + 1) * pw] of the result, for pitch (pw, ph) in px.
+    corners is the mesh_corner_array in image px. Output tiles are remapped on a thread pool.
+    """
+    pw, ph = pitch
+    W_out, H_out = (corners.shape[1] - 1) * pw, (corners.shape[0] - 1) * ph
+    out = np.zeros((H_out, W_out, 3), dtype=np.uint8)
+    
+    def render(box):
+        out[box[1]:box[3], box[0]:box[2]] = _rectify_tile(image, corners, pitch, box)
+    
+    tiles = [box for _, box in _iter_tiles((0, 0, W_out, H_out), W_out, H_out, tile_size)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(render, tiles))
+    return Image.fromarray(out)
+
+def write_rectified_image(filename, image, corners, pitch, die_origin_shift):
+    """Writes the rectified image and a '<name>.json' sidecar with the pitch and grid for slicing dies."""
+    rectified = rectify_wafer_image(image, corners, pitch)
+    rectified.save(filename)
+    with open(os.path.splitext(filename)[0] + '.json', 'w') as f:
+        json.dump({'die_pitch': list(pitch), 'max_c': corners.shape[1] - 1, 'max_r': corners.shape[0] - 1,
+                   'die_origin_shift': list(die_origin_shift)}, f, indent=1)
+    return rectified.size
+
+
+# --- Lot Navigation ---
+
+def working_copy_scale(size, budget_bytes):
+    """Downscale factor (<= 1) that fits an image of this size into the working copy budget."""
+    W, H = size
+    return min(1.0, math.sqrt(budget_bytes / (W * H * WORKING_BYTES_PER_PIXEL)))
+
+def _mapped_rows(image):
+    """
+    Pixel rows of an opened, not yet decoded image as a read-only memory map of shape (H, W) or
+    (H, W, bands), or None. Only uncompressed top-down 8-bit files (raw TIFF, PPM) map: Pillow
+    decodes PNG and compressed TIFF as a single stream, so those can only be decoded whole.
+    """
+    if not getattr(image, 'filename', None) or len(image.tile) != 1:
+        return None
+    codec, extents, offset, args = image.tile[0]
+    W, H = image.size
+    bands = {'L': 1, 'RGB': 3, 'RGBA': 4}.get(image.mode)
+    if codec != 'raw' or bands is None or tuple(extents) != (0, 0, W, H):
+        return None
+    rawmode, stride, orientation = (tuple(args) + (0, 1))[:3] if isinstance(args, tuple) else (args, 0, 1)
+    if rawmode != image.mode or stride not in (0, W * bands) or orientation != 1:
+        return None
+    try:
+        return np.memmap(image.filename, dtype=np.uint8, mode='r', offset=offset, 
+                         shape=(H, W) if bands == 1 else (H, W, bands))
+    except (OSError, ValueError):
+        return None
+
+def _decode_banded(rows, size, mode, band_bytes=DECODE_BAND_BYTES):
+    """
+    LANCZOS downscale of memory-mapped rows to size, one band of output rows at a time. Each band
+    is read with the filter support around it, so the bands join without seams.
+    """
+    H, W = rows.shape[:2]
+    width, height = size
+    row_scale = H / height
+    margin = int(math.ceil(3 * row_scale)) + 1 # LANCZOS support, in source rows
+    band_rows = max(1, int(band_bytes / (rows[0].nbytes * row_scale)))
+    result = Image.new(mode, size)
+    for y0 in range(0, height, band_rows):
+        y1 = min(height, y0 + band_rows)
+        top, bottom = y0 * row_scale, y1 * row_scale
+        c0, c1 = max(0, int(top) - margin), min(H, int(math.ceil(bottom)) + margin)
+        band = Image.fromarray(np.ascontiguousarray(rows[c0:c1]))
+        band = band.convert(mode) if band.mode != mode else band
+        result.paste(band.resize((width, y1 - y0), Image.LANCZOS, box=(0, top - c0, W, bottom - c0)), (0, y0))
+    return result
+
+def _decodes_whole(path, working_budget):
+    """Whether the working copy of path needs the full-resolution image decoded in memory first."""
+    with Image.open(path) as image:
+        return (working_copy_scale(image.size, working_budget) < 1.0 and image.format != 'JPEG' 
+                and _mapped_rows(image) is None)
+
+def _decode_working_copy(image, size, mode="RGB"):
+    """
+    Decodes an opened image in mode at size (downscaled with LANCZOS when smaller than the source).
+    Memory-mappable files are downscaled band by band and JPEG decodes at a reduced scale; other
+    formats are decoded at full resolution first.
+    """
+    if image.size != size:
+        rows = _mapped_rows(image)
+        if rows is not None:
+            return _decode_banded(rows, size, mode)
+        image.draft(mode, size) # JPEG decodes directly at a reduced scale
+    image = image.convert(mode) if image.mode != mode else image
+    if image.size != size:
+        image = image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+    image.load()
+    return image
+
+def _decode_image_entry(path, build_pyramid, working_budget=None):
+    """
+    Decoded image entry; with a working_budget (bytes) the image is a downscaled working copy
+    when the full resolution does not fit. 'full_size' keeps the size of the source image and
+    'mtime' the modification time of the file that was decoded.
+    """
+    mtime = os.path.getmtime(path)
+    with Image.open(path) as image:
+        full_size = image.size
+        scale = working_copy_scale(full_size, working_budget) if working_budget else 1.0
+        target = full_size
+        if scale < 1.0:
+            target = (max(1, round(full_size[0] * scale)), max(1, round(full_size[1] * scale)))
+        image = _decode_working_copy(image, target)
+    pyramid = [image]
+    if build_pyramid:
+        build_display_pyramid(image, pyramid)
+    return {'image': image, 'pyramid': pyramid, 'state': None, 'full_size': full_size, 'mtime': mtime}
+
+def _image_entry_size(entry):
+    size = 0
+    if entry['image'] is not None:
+        W, H = entry['image'].size
+        size += W * H * 4 # RGB plus up to 1/3 for the pyramid
+    state = entry['state']
+    if state is not None:
+        size += state['mask'].nbytes + state['history'].memory_used
+        if state['circle_stencil'] is not None:
+            size += state['circle_stencil'].nbytes
+    return size
+
+class DecodedImageCache:
+    """
+    Memory-bounded LRU of decoded lot images with their display pyramids and annotation state.
+    Neighbouring images are decoded ahead on a background thread. Eviction only drops the
+    decoded pixels: an entry's annotation state is kept, so no wafer's work is ever lost.
+    Decoded pixels of a file that was modified since are decoded again. Images whose working copy
+    needs a full-resolution decode (see _decodes_whole) are not prefetched, so at most one such
+    decode, the one on screen, is in memory at a time.
+    """
+    def __init__(self, memory_limit_bytes, working_budget=None):
+        self.memory_limit_bytes = memory_limit_bytes
+        self.working_budget = working_budget   # Bytes per image, see working_copy_scale; None decodes at full resolution
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.current = None         # Path of the image on screen, never evicted
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def load(self, path):
+        """Entry of path with a decoded image, decoding it now unless it is cached or being prefetched."""
+        with self.lock:
+            future = self.pending.get(path)
+        if future is not None:
+            future.result()
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                self.entries.move_to_end(path)
+                if self._is_current(path, entry):
+                    return entry
+        if entry is not None and entry['image'] is not None:
+            logger.info(f"{os.path.basename(path)} changed on disk since it was decoded, decoding it again.")
+        decoded = _decode_image_entry(path, build_pyramid=False, working_budget=self.working_budget)
+        if entry is not None:
+            decoded['state'] = entry['state']
+        self._insert(path, decoded)
+        return decoded
+
+    def prefetch(self, paths):
+        for path in paths:
+            with self.lock:
+                entry = self.entries.get(path)
+                if (entry is not None and self._is_current(path, entry)) or path in self.pending:
+                    continue
+                self.pending[path] = self.executor.submit(self._prefetch_one, path)
+
+    def get_entry(self, path):
+        with self.lock:
+            return self.entries.get(path)
+
+    def cached_paths(self):
+        """Paths whose decoded pixels are in memory, least recently used first."""
+        with self.lock:
+            return [path for path, entry in self.entries.items() if entry['image'] is not None]
+
+    @staticmethod
+    def _is_current(path, entry):
+        """Whether entry holds decoded pixels of the file as it is on disk now."""
+        if entry['image'] is None:
+            return False
+        try:
+            return entry.get('mtime') == os.path.getmtime(path)
+        except OSError:
+            return False
+
+    def resize(self):
+        """Re-applies the memory limit, e.g. after an entry's state changed."""
+        with self.lock:
+            self._evict(None)
+
+    def _prefetch_one(self, path):
+        try:
+            if self.working_budget and _decodes_whole(path, self.working_budget):
+                logger.debug(f"Not prefetching {os.path.basename(path)}: over budget and decoded whole.")
+                return
+            decoded = _decode_image_entry(path, build_pyramid=True, working_budget=self.working_budget)
+            with self.lock:
+                entry = self.entries.get(path)
+            if entry is not None:
+                decoded['state'] = entry['state']
+            self._insert(path, decoded)
+            logger.debug(f"Prefetched {os.path.basename(path)}.")
+        except Exception as e:
+            logger.warning(f"Prefetch of {os.path.basename(path)} failed: {e}")
+            raise
+        finally:
+            with self.lock:
+                self.pending.pop(path, None)
+
+    def _insert(self, path, entry):
+        with self.lock:
+            self.entries[path] = entry
+            self.entries.move_to_end(path)
+            self._evict(path)
+
+    def _evict(self, keep):
+        total = sum(_image_entry_size(entry) for entry in self.entries.values())
+        for path, entry in list(self.entries.items()):
+            if total <= self.memory_limit_bytes:
+                break
+            if path in (keep, self.current) or entry['image'] is None:
+                continue
+            total -= _image_entry_size(entry)
+            if entry['state'] is None:
+                del self.entries[path]
+            else:
+                self.entries[path] = {'image': None, 'pyramid': None, 'state': entry['state']}
+                total += _image_entry_size(self.entries[path])
+            logger.debug(f"Evicted decoded image {os.path.basename(path)} from the cache.")
+
+
+# --- Layer Stack ---
+
+def decode_layer_image(path, size):
+    """Decodes a stack layer at size; single-band scans (darkfield, IR) stay 8-bit gray."""
+    with Image.open(path) as image:
+        return _decode_working_copy(image, size, 'L' if len(image.getbands()) == 1 else 'RGB')
+
+class LayerBands:
+    """
+    A layer file at full resolution for compute_die_statistics, which only crops bands of rows from
+    it: memory-mappable files (see _mapped_rows) are read band by band, others are decoded whole on
+    the first crop and kept until release().
+    """
+    def __init__(self, path):
+        self.path = path
+        with Image.open(path) as image:
+            self.size = image.size
+        self.rows = None
+        self.image = None
+
+    def crop(self, box):
+        if self.rows is None and self.image is None:
+            with Image.open(self.path) as image:
+                self.rows = _mapped_rows(image)
+            if self.rows is None:
+                self.image = decode_layer_image(self.path, self.size)
+        if self.image is not None:
+            return self.image.crop(box)
+        x0, y0, x1, y1 = box
+        band = self.rows[y0:y1, x0:x1]
+        return Image.fromarray(np.ascontiguousarray(band[:, :, :3] if band.ndim == 3 else band))
+
+    def release(self):
+        self.rows = None
+        self.image = None
+
+class LayerStack:
+    """
+    Further scans of the wafer on screen (darkfield, IR, ...), registered pixel for pixel with it, so
+    they share its circle, grid, mask and die table. A layer is only checked (header size) when added
+    and decoded on first use; Pillow memory-maps single-strip uncompressed files instead of reading
+    them. The first layer is the analysed image itself.
+    """
+    def __init__(self, primary_path, primary_pyramid, full_size):
+        self.full_size = tuple(full_size)
+        self.size = primary_pyramid[0].size
+        self.primary = os.path.splitext(os.path.basename(primary_path))[0]
+        self.layers = OrderedDict([(self.primary, {'path': primary_path, 'pyramid': primary_pyramid})])
+
+    def names(self):
+        return list(self.layers)
+
+    def paths(self):
+        """Files of the added layers (all but the first)."""
+        return [layer['path'] for layer in list(self.layers.values())[1:]]
+
+    def add(self, path):
+        """Adds a layer without decoding it and returns its name. Raises ValueError if its size differs."""
+        for name, layer in self.layers.items():
+            if os.path.abspath(layer['path']) == os.path.abspath(path):
+                return name
+        with Image.open(path) as image:
+            size = image.size
+        if size != self.full_size:
+            raise ValueError(f"{os.path.basename(path)} is {size[0]} x {size[1]} px, "
+                             f"the wafer image is {self.full_size[0]} x {self.full_size[1]} px")
+        base = name = os.path.splitext(os.path.basename(path))[0]
+        suffix = 2
+        while name in self.layers:
+            name = f"{base}_{suffix}"
+            suffix += 1
+        self.layers[name] = {'path': path, 'pyramid': None}
+        return name
+
+    def pyramid(self, name):
+        """Display pyramid of a layer; the first call decodes it and builds the halved copies in the background."""
+        layer = self.layers[name]
+        if layer['pyramid'] is None:
+            pyramid = [decode_layer_image(layer['path'], self.size)]
+            threading.Thread(target=build_display_pyramid, args=(pyramid[0], pyramid), daemon=True).start()
+            layer['pyramid'] = pyramid
+        return layer['pyramid']
+
+    def full_resolution_layers(self):
+        """
+        The added layers at full resolution by name, for per-die statistics: the decoded display copy
+        when it is full resolution, else a LayerBands that is only read during its own pass.
+        """
+        layers = {}
+        for name, layer in list(self.layers.items())[1:]:
+            if self.size == self.full_size and layer['pyramid'] is not None:
+                layers[name] = layer['pyramid'][0]
+            else:
+                layers[name] = LayerBands(layer['path'])
+        return layers
+
+
+# --- Sessions and Template Registration ---
+
+def registration_thumbnail(image, size=REGISTRATION_SIZE):
+    """Grayscale float32 copy with longest side <= size, and its scale (thumbnail px per image px)."""
+    scale = min(1.0, size / max(image.size))
+    thumb_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    thumb = image.resize(thumb_size, Image.BILINEAR, reducing_gap=2.0).convert('L')
+    return np.asarray(thumb, dtype=np.float32), thumb_size[0] / image.width
+
+def _pad_square(a, N):
+    out = np.full((N, N), a.mean(), dtype=np.float32)
+    out[:a.shape[0], :a.shape[1]] = a
+    return out
+
+def _phase_correlate(a, b):
+    """
+    Shift (dy, dx) with b(p) ~ a(p - shift), to subpixel precision (parabolic peak fit), and the
+    height of the normalized cross-power peak (1.0 for a perfect match).
+    """
+    cross = np.conj(np.fft.rfft2(a)) * np.fft.rfft2(b)
+    cross /= np.abs(cross) + 1e-12
+    corr = np.fft.irfft2(cross, s=a.shape)
+    peak = np.unravel_index(np.argmax(corr), corr.shape)
+    shift = []
+    for axis, p in enumerate(peak):
+        n = corr.shape[axis]
+        before, after = list(peak), list(peak)
+        before[axis], after[axis] = (p - 1) % n, (p + 1) % n
+        c_m, c_0, c_p = corr[tuple(before)], corr[peak], corr[tuple(after)]
+        denom = c_m - 2 * c_0 + c_p
+        d = p + (0.5 * (c_m - c_p) / denom if denom != 0 else 0.0)
+        shift.append(d - n if d > n / 2 else d)
+    return tuple(shift), float(corr[peak])
+
+def _sample_bilinear(img, xs, ys):
+    h, w = img.shape
+    x0 = np.clip(np.floor(xs).astype(np.int64), 0, w - 2)
+    y0 = np.clip(np.floor(ys).astype(np.int64), 0, h - 2)
+    fx, fy = xs - x0, ys - y0
+    return ((img[y0, x0] * (1 - fx) + img[y0, x0 + 1] * fx) * (1 - fy) 
+            + (img[y0 + 1, x0] * (1 - fx) + img[y0 + 1, x0 + 1] * fx) * fy)
+
+def _log_polar_spectrum(a):
+    """
+    High-pass filtered FFT magnitude of a square image resampled to log-polar coordinates:
+    rows are N angles over [0, pi), columns N log-spaced radii. Returns (spectrum, log radius step).
+    """
+    N = a.shape[0]
+    window = np.outer(np.hanning(N), np.hanning(N))
+    magnitude = np.abs(np.fft.fftshift(np.fft.fft2((a - a.mean()) * window)))
+    freq_cos = np.cos(np.pi * np.fft.fftshift(np.fft.fftfreq(N)))
+    X = np.outer(freq_cos, freq_cos)
+    magnitude *= (1.0 - X) * (2.0 - X)
+    
+    log_step = np.log(N / 2) / N
+    radii = np.exp(np.arange(N) * log_step)
+    angles = np.arange(N) * np.pi / N
+    xs = N / 2 + np.cos(angles)[:, None] * radii[None, :]
+    ys = N / 2 + np.sin(angles)[:, None] * radii[None, :]
+    return _sample_bilinear(magnitude, xs, ys), log_step
+
+def _warp_similarity(a, scale, angle, center):
+    """a warped by the similarity p -> scale * R(angle) (p - center) + center (bilinear)."""
+    cos_a, sin_a = math.cos(angle) / scale, math.sin(angle) / scale
+    cx, cy = center
+    # PIL maps output to input pixels, i.e. takes the inverse transform
+    data = (cos_a, sin_a, cx - cos_a * cx - sin_a * cy, -sin_a, cos_a, cy + sin_a * cx - cos_a * cy)
+    img = Image.fromarray(a, mode='F').transform(a.shape[::-1], Image.AFFINE, data, 
+                                                   resample=Image.BILINEAR, fillcolor=float(a.mean()))
+    return np.asarray(img)
+
+def estimate_similarity(ref, mov):
+    """
+    Fourier-Mellin registration of two grayscale arrays. Rotation and scale come from phase
+    correlation of the log-polar magnitude spectra (translation invariant), the translation
+    from phase correlation after undoing them. The magnitude spectrum leaves a 180 degree
+    ambiguity, and on a periodic street grid both candidates correlate about equally well, so
+    the rotation within +-90 degrees is kept unless the other one is REGISTRATION_FLIP_MARGIN
+    times stronger (a notch, flat or asymmetric die layout).
+    Returns (scale, angle, center, (tx, ty), response, flip_response) with
+    p_mov = scale * R(angle) (p_ref - center) + center + (tx, ty); flip_response is the peak
+    of the candidate rotated by 180 degrees against the returned one.
+    """
+    N = 1 << int(math.ceil(math.log2(max(ref.shape + mov.shape))))
+    a, b = _pad_square(ref, N), _pad_square(mov, N)
+    lp_a, log_step = _log_polar_spectrum(a)
+    lp_b, _ = _log_polar_spectrum(b)
+    (d_angle, d_radius), _ = _phase_correlate(lp_a, lp_b)
+    scale = math.exp(-d_radius * log_step)
+    angle = d_angle * math.pi / N
+    center = (N / 2, N / 2)
+    
+    # The angle shift is wrapped to +-N/2 rows, so angle is the candidate within +-90 degrees
+    candidates = []
+    for candidate in (angle, angle + math.pi):
+        warped = _warp_similarity(a, scale, candidate, center)
+        (ty, tx), response = _phase_correlate(warped, b)
+        candidates.append((scale, math.atan2(math.sin(candidate), math.cos(candidate)), center, (tx, ty), response))
+    near, far = candidates
+    if far[4] > REGISTRATION_FLIP_MARGIN * near[4]:
+        return far + (near[4],)
+    return near + (far[4],)
+
+def register_to_reference(reference, reference_scale, image):
+    """
+    Similarity transform from a reference image (given as its registration thumbnail) to image,
+    in full-resolution pixels: {'scale', 'angle', 'offset', 'response', 'flip_response'} with
+    p_image = scale * R(angle) p_reference + offset (see estimate_similarity).
+    """
+    thumb, thumb_scale = registration_thumbnail(image)
+    s, angle, (cx, cy), (tx, ty), response, flip_response = estimate_similarity(reference, thumb)
+    cos_a, sin_a = math.cos(angle), math.sin(angle)
+    # p_thumb = s R (p_ref_thumb - c) + c + t, with p_ref_thumb = reference_scale * p_ref and p = p_thumb / thumb_scale
+    ox = (cx + tx - s * (cos_a * cx - sin_a * cy)) / thumb_scale
+    oy = (cy + ty - s * (sin_a * cx + cos_a * cy)) / thumb_scale
+    return {'scale': s * reference_scale / thumb_scale, 'angle': angle, 'offset': (ox, oy), 'response': response, 
+            'flip_response': flip_response}
+
+def transform_point(point, transform):
+    s, cos_a, sin_a = transform['scale'], math.cos(transform['angle']), math.sin(transform['angle'])
+    x, y = point
+    return (s * (cos_a * x - sin_a * y) + transform['offset'][0], s * (sin_a * x + cos_a * y) + transform['offset'][1])
+
+def transform_session_geometry(session, transform):
+    """Circle, die rectangle, SCP lattice and edge exclusion of a session mapped through a similarity transform."""
+    s = transform['scale']
+    geometry = dict(session)
+    if session['circle'] is not None:
+        geometry['circle'] = {'center': transform_point(session['circle']['center'], transform), 
+                              'radius': session['circle']['radius'] * s}
+    if session['rectangle'] is not None:
+        # The die rectangle only carries the nominal die size, so it stays axis-aligned
+        x1, y1, x2, y2 = session['rectangle']
+        cx, cy = transform_point(((x1 + x2) / 2, (y1 + y2) / 2), transform)
+        hw, hh = (x2 - x1) * s / 2, (y2 - y1) * s / 2
+        geometry['rectangle'] = (int(round(cx - hw)), int(round(cy - hh)), int(round(cx + hw)), int(round(cy + hh)))
+    geometry['super_control_points'] = {key: transform_point(p, transform) for key, p in session['super_control_points'].items()}
+    geometry['edge_exclusion'] = session['edge_exclusion'] * s
+    return geometry
+
+def scale_geometry(geometry, scale):
+    """Circle, die rectangle and SCP lattice of a session-like dict with image coordinates multiplied by scale (sx, sy)."""
+    sx, sy = scale
+    scaled = dict(geometry)
+    if geometry['circle'] is not None:
+        ux, uy = geometry['circle']['center']
+        scaled['circle'] = {'center': (ux * sx, uy * sy), 'radius': geometry['circle']['radius'] * (sx + sy) / 2}
+    if geometry['rectangle'] is not None:
+        x1, y1, x2, y2 = geometry['rectangle']
+        scaled['rectangle'] = (x1 * sx, y1 * sy, x2 * sx, y2 * sy)
+    scaled['super_control_points'] = {key: (x * sx, y * sy) for key, (x, y) in geometry['super_control_points'].items()}
+    return scaled
+
+def write_session(filename, session):
+    """Writes a session (geometry plus registration thumbnail) as JSON."""
+    png = io.BytesIO()
+    Image.fromarray(np.clip(session['reference'], 0, 255).astype(np.uint8)).save(png, format='PNG')
+    data = {
+        'version': SESSION_VERSION,
+        'image': session['image'],
+        'image_size': list(session['image_size']),
+        'circle': None if session['circle'] is None else 
+                  {'center': list(session['circle']['center']), 'radius': session['circle']['radius']},
+        'rectangle': None if session['rectangle'] is None else list(session['rectangle']),
+        'max_c': session['max_c'],
+        'max_r': session['max_r'],
+        'super_control_points': [[C, R, x, y] for (C, R), (x, y) in sorted(session['super_control_points'].items())],
+        'die_origin_shift': list(session['die_origin_shift']),
+        'edge_exclusion': session['edge_exclusion'],
+        'reference_scale': session['reference_scale'],
+        'reference_png': base64.b64encode(png.getvalue()).decode('ascii'),
+    }
+    if session.get('die_status') is not None:
+        status = session['die_status']
+        data['die_status'] = {
+            'keys': base64.b64encode(zlib.compress(status['keys'].astype('<i4').tobytes(), 6)).decode('ascii'),
+            'status': base64.b64encode(zlib.compress(status['status'].astype(np.int8).tobytes(), 6)).decode('ascii'),
+        }
+    with open(filename, 'w') as f:
+        json.dump(data, f, indent=1)
+
+def read_session(filename):
+    """Reads a session written by write_session. Raises ValueError for unsupported files."""
+    with open(filename) as f:
+        data = json.load(f)
+    if data.get('version') != SESSION_VERSION:
+        raise ValueError(f"unsupported session version {data.get('version')}")
+    circle = data['circle']
+    die_status = None
+    if data.get('die_status'):
+        keys = np.frombuffer(zlib.decompress(base64.b64decode(data['die_status']['keys'])), dtype='<i4')
+        die_status = {
+            'keys': keys.reshape(-1, 2).astype(np.int64),
+            'status': np.frombuffer(zlib.decompress(base64.b64decode(data['die_status']['status'])), dtype=np.int8),
+            'die_origin_shift': tuple(data['die_origin_shift']),
+        }
+    return {
+        'image': data['image'],
+        'image_size': tuple(data['image_size']),
+        'circle': None if circle is None else {'center': tuple(circle['center']), 'radius': circle['radius']},
+        'rectangle': None if data['rectangle'] is None else tuple(data['rectangle']),
+        'max_c': data['max_c'],
+        'max_r': data['max_r'],
+        'super_control_points': {(C, R): (x, y) for C, R, x, y in data['super_control_points']},
+        'die_origin_shift': tuple(data['die_origin_shift']),
+        'edge_exclusion': data['edge_exclusion'],
+        'reference_scale': data['reference_scale'],
+        'reference': np.asarray(Image.open(io.BytesIO(base64.b64decode(data['reference_png']))), dtype=np.float32),
+        'die_status': die_status,
+    }
+
+
+# --- Session Diff ---
+
+def die_status_codes(classes, masked):
+    """Per-die DIE_STATUS_* code: counted (full) dies are clean or masked, everything else is not counted."""
+    return np.where(classes == DIE_FULL, np.where(masked, DIE_STATUS_MASKED, DIE_STATUS_CLEAN), 
+                    DIE_STATUS_NOT_COUNTED).astype(np.int8)
+
+def _die_key_codes(keys, origin_shift):
+    """One sortable int64 per die from its origin-relative (C, R)."""
+    C = keys[:, 0].astype(np.int64) - origin_shift[0] + (1 << 20)
+    R = keys[:, 1].astype(np.int64) - origin_shift[1] + (1 << 20)
+    return (C << 21) | R
+
+def diff_die_status(before, after):
+    """
+    Aligns two die status tables ({'keys', 'status', 'die_origin_shift'}) on their origin-relative
+    (C, R) and diffs them in one vectorized pass. Returns the DIFF_* change of every die of after
+    (DIFF_NEW for counted dies before has no match for), the matching before index (-1 if none),
+    the 3x3 before/after status transition counts and the number of counted before dies missing
+    from after.
+    """
+    codes_before = _die_key_codes(before['keys'], before['die_origin_shift'])
+    codes_after = _die_key_codes(after['keys'], after['die_origin_shift'])
+    _, idx_before, idx_after = np.intersect1d(codes_before, codes_after, assume_unique=True, return_indices=True)
+    
+    status_before = before['status'][idx_before].astype(np.int64)
+    status_after = after['status'][idx_after].astype(np.int64)
+    change = np.full(len(codes_after), DIFF_NEW, dtype=np.int8)
+    change[idx_after] = _DIFF_TRANSITIONS[status_before, status_after]
+    change[(change == DIFF_NEW) & (after['status'] == DIE_STATUS_NOT_COUNTED)] = DIFF_NONE
+    matched = np.full(len(codes_after), -1, dtype=np.int64)
+    matched[idx_after] = idx_before
+    transitions = np.bincount(status_before * 3 + status_after, minlength=9).reshape(3, 3)
+    missing = before['status'] != DIE_STATUS_NOT_COUNTED
+    missing[idx_before] = False
+    return {'change': change, 'matched': matched, 'transitions': transitions, 'missing': int(missing.sum())}
+
+def diff_summary(diff):
+    """JSON-friendly change counts of a diff_die_status result."""
+    counts = np.bincount(diff['change'], minlength=len(DIFF_CHANGE_NAMES))
+    summary = {DIFF_CHANGE_NAMES[code]: int(counts[code]) for code in DIFF_CHANGE_NAMES if code != DIFF_NONE}
+    summary['missing'] = int(diff['missing'])
+    summary['transitions'] = diff['transitions'].tolist()
+    return summary
+
+def write_die_diff_csv(filename, before, after, diff):
+    """Writes one row per changed die of after, with its before and after status."""
+    C_shift, R_shift = after['die_origin_shift']
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['C', 'R', 'Die', 'Before', 'After', 'Change'])
+        for idx in np.flatnonzero(diff['change'] != DIFF_NONE):
+            C, R = after['keys'][idx]
+            matched = diff['matched'][idx]
+            before_name = DIE_STATUS_NAMES[int(before['status'][matched])] if matched >= 0 else ''
+            writer.writerow([C - C_shift, R - R_shift, get_die_name(C, R, after['die_origin_shift']), before_name, 
+                             DIE_STATUS_NAMES[int(after['status'][idx])], DIFF_CHANGE_NAMES[int(diff['change'][idx])]])
+
 
 class ImageAnnotator:
     def __init__(self, root):
+        _load_gui()
         self.root = root
         self.root.title("Wafer Annotation Tool")
         self.root.geometry("800x600")
@@ -61,8 +2484,7 @@ class ImageAnnotator:
         self.circle_points = []
         self.rect_start = None
         
-        self.mask_paint_layer = None    
-        self.annotation_layer = None    
+        self.mask_paint_layer = None    # BitMask, the authoritative (bit-packed) mask
         self.brush_size = 20
         
         # Stored Geometry Variables
@@ -82,21 +2504,77 @@ class ImageAnnotator:
         # New variable to store the C, R coordinates of the die selected as the new (0, 0)
         self.die_origin_shift = (0, 0) 
         
-        self.circle_stencil = None 
-        self.live_mask_draw = None 
+        # Per-die appearance statistics of the last report
+        self.die_stats = None 
+        
+        # DIFF_* change of every die against a compared session, aligned with die_table (change map overlay)
+        self.die_diff = None
+        
+        # Vectorized die table (keys, polygons, centers, classes) aligned with die_info_cache
+        self.die_table = None 
+        self.edge_exclusion = 0.0 
+        
+        # Die counts and masked area maintained incrementally for the live statistics panel
+        self.live_counts = LiveDieCounts()
+        
+        self.circle_stencil = None      # BitMask of the circle interior
+        self.work_scale = (1.0, 1.0)    # Full-resolution px per working-copy px (x, y); geometry and mask are in working px
         self.temp_items = []
         self.committed_grid_items = [] 
         self.last_mask_pos = None 
+        self.stroke_bbox = None 
+        
+        # Undo/Redo of mask edits and SCP moves
+        self.history = MaskHistory(UNDO_MEMORY_LIMIT_MB * 1024 * 1024)
+        self.scp_drag_start = None 
+        
+        # Append-only journal of mask operations ('<image>_MaskJournal.jsonl') for crash recovery
+        self.mask_journal = _NullJournal()
         
         self.mask_dirty = False     
-        self.combined_image = None 
         self.resize_job_id = None 
         self.RESIZE_DEBOUNCE_MS = 33 
         
+        # Halved copies of the image for fast interactive frames, filled in by a background thread
+        self.display_pyramid = []
+        self.refine_job_id = None 
+        
+        # Display-only enhancement filters with their per-tile cache
+        self.enhancer = DisplayEnhancer()
+        
+        # Further scans of the same wafer sharing its geometry; display_pyramid and enhancer follow the shown layer
+        self.layer_stack = None
+        self.layer_name = None
+        self.layer_enhancers = {}
+        
+        # Lot navigation: images of the current folder, decoded ahead and cached with their state
+        self.image_cache = DecodedImageCache(IMAGE_CACHE_LIMIT_MB * 1024 * 1024, WORKING_COPY_BUDGET_MB * 1024 * 1024)
+        self.lot_files = []
+        self.lot_index = None
+        
+        # Drag events are coalesced and processed at most once per frame
+        self.FRAME_MS = 16 
+        self.drag_flush_job = None 
+        self.pending_mask_points = [] 
+        self.pending_scp_pos = None 
+        self.stroke_preview_item = None 
+        self.stroke_preview_coords = [] 
+        self.brush_cursor_item = None 
+        
+        # Lasso polygon being drawn (image coords) and its single preview item
+        self.lasso_points = []
+        self.lasso_item = None
+        
         self.create_ui()
         self.load_image(initial=True) 
         
         self.canvas.bind('<Configure>', self.on_canvas_configure)
+        self.root.bind('<Control-z>', lambda event: self.undo())
+        self.root.bind('<Control-y>', lambda event: self.redo())
+        self.root.bind('<Prior>', lambda event: self.show_adjacent_image(-1))
+        self.root.bind('<Next>', lambda event: self.show_adjacent_image(1))
+        for index in range(9):
+            self.root.bind(f'<Control-Key-{index + 1}>', lambda event, index=index: self.show_layer(index))
 
 
     # --- UI Creation and Setup ---
@@ -106,18 +2584,29 @@ class ImageAnnotator:
         toolbar.pack(side=tk.TOP, fill=tk.X)
         
         tk.Button(toolbar, text="Load Image", command=lambda: self.load_image(initial=False)).pack(side=tk.LEFT, padx=2, pady=2)
+        tk.Button(toolbar, text="< Prev", command=lambda: self.show_adjacent_image(-1)).pack(side=tk.LEFT, padx=2, pady=2)
+        tk.Button(toolbar, text="Next >", command=lambda: self.show_adjacent_image(1)).pack(side=tk.LEFT, padx=2, pady=2)
         tk.Button(toolbar, text="Save Image", command=self.save_image, bg='lightgreen').pack(side=tk.LEFT, padx=10, pady=2) 
+        tk.Button(toolbar, text="Save Session", command=self.save_session).pack(side=tk.LEFT, padx=2, pady=2)
+        tk.Button(toolbar, text="Apply Template", command=self.apply_template).pack(side=tk.LEFT, padx=2, pady=2)
+        tk.Button(toolbar, text="Compare Session", command=self.compare_session).pack(side=tk.LEFT, padx=2, pady=2)
         
         tk.Label(toolbar, text=" | Mode:").pack(side=tk.LEFT, padx=5)
         tk.Button(toolbar, text="Circle (3 pts)", command=lambda: self.set_mode('circle')).pack(side=tk.LEFT, padx=2)
         tk.Button(toolbar, text="Die Dimension", command=lambda: self.set_mode('rectangle')).pack(side=tk.LEFT, padx=2)
         tk.Button(toolbar, text="Mask", command=lambda: self.set_mode('mask')).pack(side=tk.LEFT, padx=2)
+        tk.Button(toolbar, text="Lasso", command=lambda: self.set_mode('lasso')).pack(side=tk.LEFT, padx=2)
+        tk.Button(toolbar, text="Fill", command=lambda: self.set_mode('fill')).pack(side=tk.LEFT, padx=2)
+        tk.Button(toolbar, text="Auto Mask", command=self.open_auto_mask_dialog).pack(side=tk.LEFT, padx=2)
+        tk.Button(toolbar, text="Import Mask", command=self.import_mask_journal).pack(side=tk.LEFT, padx=2)
         
         self.ffd_mode_button = tk.Button(toolbar, text="Edit Grid)", command=lambda: self.toggle_ffd_mode())
         self.ffd_mode_button.pack(side=tk.LEFT, padx=2)
 
         self.apply_ffd_button = tk.Button(toolbar, text="APPLY GRID", command=self._commit_ffd_changes, state=tk.DISABLED, bg='orange')
         self.apply_ffd_button.pack(side=tk.LEFT, padx=5)
+        self.snap_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(toolbar, text="Snap to Street", variable=self.snap_var).pack(side=tk.LEFT, padx=2)
         
         tk.Button(toolbar, text="Set Die", command=lambda: self.set_mode('set_naming_origin')).pack(side=tk.LEFT, padx=5)
         
@@ -127,16 +2616,55 @@ class ImageAnnotator:
         self.brush_slider.set(20)
         self.brush_slider.pack(side=tk.LEFT, padx=2)
         
+        tk.Label(toolbar, text="Fill Tol.:").pack(side=tk.LEFT, padx=2)
+        self.fill_tolerance_var = tk.StringVar(value=str(FILL_TOLERANCE))
+        tk.Spinbox(toolbar, from_=0, to=255, increment=5, width=4, textvariable=self.fill_tolerance_var).pack(side=tk.LEFT, padx=2)
+        
         tk.Button(toolbar, text="Clear Mask", command=self.clear_mask).pack(side=tk.LEFT, padx=2)
+        tk.Button(toolbar, text="Undo", command=self.undo).pack(side=tk.LEFT, padx=2)
+        tk.Button(toolbar, text="Redo", command=self.redo).pack(side=tk.LEFT, padx=2)
+        
+        tk.Label(toolbar, text=" | Edge Excl. (px):").pack(side=tk.LEFT, padx=5)
+        self.edge_exclusion_var = tk.StringVar(value="0")
+        tk.Spinbox(toolbar, from_=0, to=10000, increment=10, width=6, textvariable=self.edge_exclusion_var, 
+                   command=self.update_edge_exclusion).pack(side=tk.LEFT, padx=2)
+        self.edge_exclusion_var.trace_add('write', lambda *_: self.update_edge_exclusion())
         
         tk.Button(toolbar, text="Generate Report", 
                   command=self.count_valid_dies_and_generate_report, 
                   bg='lightgreen').pack(side=tk.LEFT, padx=10, pady=2)
+        tk.Button(toolbar, text="Extract Dies", command=self.extract_clean_dies).pack(side=tk.LEFT, padx=2, pady=2)
+        tk.Button(toolbar, text="Rectify", command=self.save_rectified_image).pack(side=tk.LEFT, padx=2, pady=2)
+
+        # View enhancement bar (display only, the analysed pixels are untouched)
+        view_bar = tk.Frame(self.root, relief=tk.RAISED, borderwidth=1)
+        view_bar.pack(side=tk.TOP, fill=tk.X)
+        tk.Label(view_bar, text="Layer:").pack(side=tk.LEFT, padx=5)
+        self.layer_var = tk.StringVar(value='')
+        self.layer_menu = tk.OptionMenu(view_bar, self.layer_var, '')
+        self.layer_menu.pack(side=tk.LEFT, padx=2)
+        tk.Button(view_bar, text="Add Layers", command=self.add_layers).pack(side=tk.LEFT, padx=2)
+        tk.Label(view_bar, text="View Channel:").pack(side=tk.LEFT, padx=5)
+        self.view_channel_var = tk.StringVar(value='RGB')
+        tk.OptionMenu(view_bar, self.view_channel_var, *DisplayEnhancer.CHANNELS).pack(side=tk.LEFT, padx=2)
+        self.stretch_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(view_bar, text="Contrast Stretch", variable=self.stretch_var).pack(side=tk.LEFT, padx=2)
+        self.clahe_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(view_bar, text="CLAHE", variable=self.clahe_var).pack(side=tk.LEFT, padx=2)
+        tk.Label(view_bar, text="Gamma:").pack(side=tk.LEFT, padx=2)
+        self.gamma_var = tk.StringVar(value="1.0")
+        tk.Spinbox(view_bar, from_=0.2, to=5.0, increment=0.1, width=4, textvariable=self.gamma_var).pack(side=tk.LEFT, padx=2)
+        for var in (self.view_channel_var, self.stretch_var, self.clahe_var, self.gamma_var):
+            var.trace_add('write', lambda *_: self.update_enhancement())
 
         # Status label
         self.status_label = tk.Label(toolbar, text="Mode: Idle (Pan with Middle Click)", fg="blue")
         self.status_label.pack(side=tk.LEFT, padx=10)
         
+        # Live statistics panel
+        self.stats_label = tk.Label(self.root, text="", anchor=tk.W, relief=tk.SUNKEN)
+        self.stats_label.pack(side=tk.BOTTOM, fill=tk.X)
+        
         # Canvas with scrollbars
         canvas_frame = tk.Frame(self.root)
         canvas_frame.pack(fill=tk.BOTH, expand=True)
@@ -169,26 +2697,134 @@ class ImageAnnotator:
             )
             if not filepath:
                 return
+            self.open_image(filepath)
+            return
         elif self.original_image_path is None:
             W, H = 800, 600
             self.original_image = Image.new('RGB', (W, H), 'darkgrey')
             self.original_image_path = "Placeholder_Image"
             logger.info("Loaded placeholder image.")
             
-        if not initial and filepath:
+        if self.original_image is not None:
+            self._reset_image_state()
+            
+    def open_image(self, filepath):
+        """Shows an image of a lot, from the decoded-image cache when possible, and prefetches its neighbours."""
+        self.set_mode(None)
+        start = time.perf_counter()
+        try:
+            entry = self.image_cache.load(filepath)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load image: {e}")
+            return False
+        
+        self.image_cache.current = filepath
+        self._stash_image_state()
+        self.original_image = entry['image']
+        self.original_image_path = filepath
+        self._reset_image_state(entry)
+        logger.info(f"Image loaded: {os.path.basename(filepath)} ({time.perf_counter() - start:.2f} s)")
+        if self.work_scale != (1.0, 1.0):
+            logger.info(f"Working copy {self.original_image.width} x {self.original_image.height} of "
+                        f"{entry['full_size'][0]} x {entry['full_size'][1]}; report, extraction and save run at full resolution.")
+        
+        journal_path = self._output_path("_MaskJournal.jsonl")
+        keep_journal = entry['state'] is not None
+        if not keep_journal and journal_has_mask_ops(journal_path):
+            if messagebox.askyesno("Recover Mask", "A mask journal from a previous session was found for this image.\n"
+                                   "Recover the painted mask from it?"):
+                keep_journal = self.recover_mask_journal(journal_path)
+        if os.access(os.path.dirname(journal_path) or '.', os.W_OK):
+            self.mask_journal = MaskJournal(journal_path, os.path.basename(filepath), self.original_image.size, 
+                                            append=keep_journal)
+        else:
+            logger.warning(f"{os.path.dirname(journal_path)} is not writable: no mask journal, crash recovery is off.")
+        
+        folder = os.path.dirname(filepath)
+        if filepath not in self.lot_files:
+            self.lot_files = sorted(os.path.join(folder, name) for name in os.listdir(folder) 
+                                    if name.lower().endswith(IMAGE_EXTENSIONS))
+        self.lot_index = self.lot_files.index(filepath) if filepath in self.lot_files else None
+        if self.lot_index is not None:
+            neighbours = []
+            for offset in range(1, PREFETCH_RADIUS + 1):
+                neighbours += [i for i in (self.lot_index + offset, self.lot_index - offset) if 0 <= i < len(self.lot_files)]
+            self.image_cache.prefetch([self.lot_files[i] for i in neighbours])
+            self.status_label.config(text=f"Wafer {self.lot_index + 1}/{len(self.lot_files)}: {os.path.basename(filepath)}")
+        return True
+        
+    def show_adjacent_image(self, step):
+        """Steps to the previous (-1) or next (+1) image of the current folder."""
+        if self.lot_index is None or self.last_mask_pos is not None:
+            return
+        index = self.lot_index + step
+        if 0 <= index < len(self.lot_files):
+            self.open_image(self.lot_files[index])
+            
+    def _stash_image_state(self):
+        """Keeps the annotation state of the current image in its cache entry for when it is shown again."""
+        entry = self.image_cache.get_entry(self.original_image_path)
+        if entry is None:
+            return
+        entry['state'] = {
+            'mask': self.mask_paint_layer,
+            'history': self.history,
+            'circle_geom': dict(self.circle_geom),
+            'circle_stencil': self.circle_stencil,
+            'rectangle_geom': self.rectangle_geom,
+            'super_control_points': dict(self.super_control_points),
+            'max_c': self.Max_C,
+            'max_r': self.Max_R,
+            'die_origin_shift': self.die_origin_shift,
+            'view': (self.zoom_level, self.pan_x, self.pan_y),
+            'layers': self.layer_stack.paths() if self.layer_stack is not None else [],
+        }
+        self.image_cache.resize()
+        
+    def _restore_image_state(self, state):
+        self.mask_paint_layer = state['mask']
+        self.history = state['history']
+        self.rectangle_geom = state['rectangle_geom']
+        self.die_origin_shift = state['die_origin_shift']
+        self.zoom_level, self.pan_x, self.pan_y = state['view']
+        for path in state['layers']:
             try:
-                self.original_image = Image.open(filepath).convert("RGB")
-                self.original_image_path = filepath
-                logger.info(f"Image loaded: {os.path.basename(filepath)}")
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to load image: {e}")
-                return
+                self.layer_stack.add(path)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Layer dropped: {e}")
+        self._refresh_layer_menu()
+        if state['circle_geom']['radius'] is not None:
+            self.circle_geom = dict(state['circle_geom'])
+            self.circle_stencil = state['circle_stencil']
+            self.live_counts.attach(self.mask_paint_layer, self.circle_stencil)
+            self._update_die_classification()
+        if state['super_control_points']:
+            self.super_control_points = dict(state['super_control_points'])
+            self.Max_C, self.Max_R = state['max_c'], state['max_r']
+            self._commit_ffd_changes()
             
+    def _reset_image_state(self, entry=None):
+        """Fresh layers and geometry for the current image (or its cached state, if it has one)."""
+        self.mask_journal.close()
+        self.mask_journal = _NullJournal()
         if self.original_image is not None:
             W, H = self.original_image.size
-            self.mask_paint_layer = Image.new('RGBA', (W, H), (0, 0, 0, 0))
-            self.live_mask_draw = ImageDraw.Draw(self.mask_paint_layer) 
-            self.annotation_layer = Image.new('RGBA', (W, H), (0, 0, 0, 0))
+            full_W, full_H = entry['full_size'] if entry is not None else (W, H)
+            self.work_scale = (full_W / W, full_H / H)
+            self.mask_paint_layer = BitMask(W, H)
+            if entry is not None and entry['pyramid'] is not None:
+                self.display_pyramid = entry['pyramid']
+            else:
+                self.display_pyramid = [self.original_image]
+                threading.Thread(target=build_display_pyramid, args=(self.original_image, self.display_pyramid), 
+                                 daemon=True).start()
+                if entry is not None:
+                    entry['pyramid'] = self.display_pyramid
+            self.enhancer.set_image(self.original_image)
+            self.layer_stack = LayerStack(self.original_image_path, self.display_pyramid, (full_W, full_H))
+            self.layer_name = self.layer_stack.primary
+            self.layer_enhancers = {self.layer_name: self.enhancer}
+            self._refresh_layer_menu()
 
             self.circle_geom = {'center': None, 'radius': None}
             self.rectangle_geom = None
@@ -196,9 +2832,17 @@ class ImageAnnotator:
             self.super_control_points = {}
             self.die_info_cache = {} 
             self.die_origin_shift = (0, 0)
+            self.die_stats = None
+            self.die_table = None
+            self.die_diff = None
+            self.live_counts = LiveDieCounts()
+            self.live_counts.attach(self.mask_paint_layer, None)
+            self.history = MaskHistory(UNDO_MEMORY_LIMIT_MB * 1024 * 1024)
             self.zoom_level = 1.0
             self.pan_x = 0
             self.pan_y = 0
+            if entry is not None and entry['state'] is not None:
+                self._restore_image_state(entry['state'])
 
             self._rebuild_annotation_layer()
             self.schedule_image_resize()
@@ -221,23 +2865,11 @@ class ImageAnnotator:
 
         self._calculate_all_interpolated_points()
         
-        self.die_info_cache = {}
-        for C in range(self.Max_C):
-            for R in range(self.Max_R):
-                polygon = self._get_die_polygon_by_index(C, R)
-                if polygon is None: 
-                    continue
-                
-                P_LL, P_LR, P_UR, P_UL = polygon
-                center_x = (P_LL[0] + P_LR[0] + P_UR[0] + P_UL[0]) / 4.0
-                center_y = (P_LL[1] + P_LR[1] + P_UR[1] + P_UL[1]) / 4.0
-
-                self.die_info_cache[(C, R)] = {
-                    'center': (center_x, center_y),
-                    'polygon': polygon
-                }
+        self.die_info_cache = build_die_info_cache(self.interpolated_points, self.Max_C, self.Max_R)
+        self.die_diff = None
         
         logger.info(f"FFD mesh geometric data successfully COMMITTED. {len(self.die_info_cache)} dies.")
+        self._update_die_classification()
         
         self._rebuild_annotation_layer()
         
@@ -256,6 +2888,9 @@ class ImageAnnotator:
         self.circle_points = []
         self.rect_start = None
         self.clear_temp_items()
+        self._clear_stroke_preview()
+        self._hide_brush_cursor()
+        self._clear_lasso()
         self.active_scp = None
         
         status_c, status_r = self.die_origin_shift
@@ -264,6 +2899,8 @@ class ImageAnnotator:
             'circle': 'Circle - Click 3 points',
             'rectangle': 'Die Dimension - Click and drag',
             'mask': 'Mask - Paint over image (Square Brush)',
+            'lasso': 'Lasso - Drag around a region to mask it',
+            'fill': 'Fill - Click a region to mask all connected pixels of similar color (bounded by circle and view)',
             'ffd_grid': f'FFD Mesh - Drag the {SCP_SIZE}x{SCP_SIZE} blue Super-Control Points (SCPs). **Press APPLY FFD Changes (Fast) when done.**',
             'set_naming_origin': f'Set Naming Origin - Click the die you want to name Die ({status_c}, {status_r})',
             None: 'Idle (Pan with Middle Click)' 
@@ -291,24 +2928,53 @@ class ImageAnnotator:
             logger.info(f"Mode set to: {mode}")
 
     def _rebuild_annotation_layer(self):
+        """Annotations are drawn per displayed region (_draw_annotations); this only invalidates the view."""
         if self.original_image is None: 
             return
-            
-        W, H = self.original_image.size
-        self.annotation_layer = Image.new('RGBA', (W, H), (0, 0, 0, 0))
-        draw = ImageDraw.Draw(self.annotation_layer)
+        self.mask_dirty = True
+        self.schedule_image_resize()
         
+    def _draw_annotations(self, draw, offset=(0, 0), scale=1.0):
+        """Draws the circle, exclusion ring and die rectangle on an RGBA draw whose origin is at offset (image px)."""
+        ox, oy = offset
         if self.circle_geom['radius'] is not None:
-            R = self.circle_geom['radius']
+            R = self.circle_geom['radius'] * scale
             ux, uy = self.circle_geom['center']
+            ux, uy = (ux - ox) * scale, (uy - oy) * scale
             bbox = [ux - R, uy - R, ux + R, uy + R]
             draw.ellipse(bbox, outline=(255, 0, 0, 50), width=3) 
             
+            R_usable = R - self.edge_exclusion / self._work_scale_mean() * scale
+            if self.edge_exclusion > 0 and R_usable > 0:
+                bbox = [ux - R_usable, uy - R_usable, ux + R_usable, uy + R_usable]
+                draw.ellipse(bbox, outline=(255, 165, 0, 80), width=2) 
+            
         if self.rectangle_geom is not None:
-             draw.rectangle(self.rectangle_geom, outline=(0, 0, 255, 50), width=3)
+             x1, y1, x2, y2 = self.rectangle_geom
+             draw.rectangle(((x1 - ox) * scale, (y1 - oy) * scale, (x2 - ox) * scale, (y2 - oy) * scale), 
+                            outline=(0, 0, 255, 50), width=3)
              
-        self.mask_dirty = True
-        self.update_combined_image()
+    def compose_region(self, box, level=0):
+        """
+        Original pixels of box with the green mask overlay and annotations, generated on demand.
+        At level k the result comes from the 1/2**k display copy (box must be aligned to 2**k).
+        """
+        if level == 0:
+            source, level_box = self.display_pyramid[0], box
+            mask_alpha = self.mask_paint_layer.to_image(box, on_value=MASK_COLOR[3])
+        else:
+            step = 2 ** level
+            x0, y0, x1, y1 = box
+            source, level_box = self.display_pyramid[level], (x0 // step, y0 // step, -(-x1 // step), -(-y1 // step))
+            sampled = self.mask_paint_layer.region_sampled(box, step)
+            mask_alpha = Image.fromarray(sampled.astype(np.uint8) * np.uint8(MASK_COLOR[3]))
+        if self.enhancer.active:
+            region = self.enhancer.region(source, level, level_box).convert("RGBA")
+        else:
+            region = source.crop(level_box).convert("RGBA")
+        region.paste(Image.new("RGBA", region.size, MASK_COLOR[:3] + (255,)), (0, 0), mask_alpha)
+        self._draw_annotations(ImageDraw.Draw(region, "RGBA"), offset=box[:2], scale=1.0 / 2 ** level)
+        return region
 
 
     # --- FFD Interpolation and Drawing ---
@@ -319,51 +2985,7 @@ class ImageAnnotator:
             return
 
         W_img, H_img = self.original_image.size
-        self.interpolated_points = {}
-        
-        num_patches_c = SCP_SIZE - 1
-        num_patches_r = SCP_SIZE - 1
-        
-        for C in range(self.Max_C + 1):
-            for R in range(self.Max_R + 1):
-                
-                u = C / self.Max_C if self.Max_C > 0 else 0
-                v = R / self.Max_R if self.Max_R > 0 else 0
-                
-                C_s_float = u * num_patches_c 
-                R_s_float = v * num_patches_r
-
-                C_s = min(num_patches_c - 1, int(C_s_float)) 
-                R_s = min(num_patches_r - 1, int(R_s_float)) 
-
-                if C == self.Max_C and self.Max_C > 0: 
-                    C_s = num_patches_c - 1
-                if R == self.Max_R and self.Max_R > 0: 
-                    R_s = num_patches_r - 1
-                
-                u_local = C_s_float - C_s
-                v_local = R_s_float - R_s
-                
-                if C == self.Max_C and self.Max_C > 0: 
-                    u_local = 1.0
-                if R == self.Max_R and self.Max_R > 0: 
-                    v_local = 1.0
-                
-                P00 = self.super_control_points.get((C_s, R_s), (0, 0)) 
-                P10 = self.super_control_points.get((C_s + 1, R_s), (W_img, 0)) 
-                P01 = self.super_control_points.get((C_s, R_s + 1), (0, H_img)) 
-                P11 = self.super_control_points.get((C_s + 1, R_s + 1), (W_img, H_img)) 
-                
-                P_u_top_x = (1 - u_local) * P00[0] + u_local * P10[0]
-                P_u_bottom_x = (1 - u_local) * P01[0] + u_local * P11[0]
-                
-                P_u_top_y = (1 - u_local) * P00[1] + u_local * P10[1]
-                P_u_bottom_y = (1 - u_local) * P01[1] + u_local * P11[1]
-                
-                x_interp = (1 - v_local) * P_u_top_x + v_local * P_u_bottom_x
-                y_interp = (1 - v_local) * P_u_top_y + v_local * P_u_bottom_y
-                
-                self.interpolated_points[(C, R)] = (x_interp, y_interp)
+        self.interpolated_points = interpolate_ffd_mesh(self.super_control_points, self.Max_C, self.Max_R, W_img, H_img)
 
     def _draw_committed_mesh_on_canvas(self):
         """
@@ -376,27 +2998,28 @@ class ImageAnnotator:
         if not self.die_info_cache: 
              return
 
-        if self.circle_geom['radius'] is None:
-             ux, uy, radius_sq = 0, 0, float('inf')
-        else:
-             ux, uy = self.circle_geom['center']
-             radius_sq = self.circle_geom['radius'] ** 2
+        if self.die_table is None or len(self.die_table['classes']) != len(self.die_info_cache):
+             self._update_die_classification()
         
         PINK_COLOR = '#FF69B4' 
+        EDGE_DIE_COLOR = '#A0A0A0' # Partial / edge-excluded dies
         TEXT_COLOR_CLEAN = '#00FFFF' 
         TEXT_COLOR_MASKED = '#0000FF'
         LINE_WIDTH = 1 
         
         canvas_w = self.canvas.winfo_width()
         canvas_h = self.canvas.winfo_height()
+        
+        if self.die_diff is not None and len(self.die_diff) == len(self.die_info_cache):
+            changes = self.die_diff
+        else:
+            changes = np.zeros(len(self.die_info_cache), dtype=np.int8)
 
-        for (C, R), info in self.die_info_cache.items():
+        for ((C, R), info), die_class, change in zip(self.die_info_cache.items(), self.die_table['classes'], changes):
             polygon = info['polygon']
             center_x, center_y = info['center']
             
-            dist_sq = (center_x - ux)**2 + (center_y - uy)**2
-            
-            if dist_sq < radius_sq:
+            if die_class != DIE_OUTSIDE:
                 # 1. Check visibility 
                 s_poly = [self.image_to_screen_coords(p[0], p[1]) for p in polygon]
                 
@@ -407,6 +3030,11 @@ class ImageAnnotator:
                 
                 if screen_max_x < 0 or screen_min_x > canvas_w or screen_max_y < 0 or screen_min_y > canvas_h:
                      continue 
+                
+                if change != DIFF_NONE:
+                    item = self.canvas.create_polygon([c for p in s_poly for c in p], outline='', fill=DIFF_COLORS[int(change)], 
+                                                      stipple='gray25', tags="committed_grid")
+                    self.committed_grid_items.append(item)
 
                 # 2. Draw the Die Boundary (Polygon)
                 line_coords = []
@@ -414,8 +3042,12 @@ class ImageAnnotator:
                     line_coords.extend(p)
                 line_coords.extend(s_poly[0]) 
                 
-                item = self.canvas.create_polygon(line_coords, outline=PINK_COLOR, fill='', width=LINE_WIDTH, tags="committed_grid")
+                outline = PINK_COLOR if die_class == DIE_FULL else EDGE_DIE_COLOR
+                item = self.canvas.create_polygon(line_coords, outline=outline, fill='', width=LINE_WIDTH, tags="committed_grid")
                 self.committed_grid_items.append(item)
+                
+                if die_class != DIE_FULL:
+                    continue
         
                 # 3. Draw the Die Name with Dynamic Indexing
                 die_name = self._get_die_name(C, R)
@@ -510,9 +3142,22 @@ class ImageAnnotator:
                 return 
             img_x, img_y = self.screen_to_image_coords(event.x, event.y)
             self.last_mask_pos = (img_x, img_y)
+            self.stroke_bbox = None
+            self.pending_mask_points = []
+            self.history.begin_mask_action()
             self.paint_mask_stroke(int(img_x), int(img_y), int(img_x), int(img_y)) 
             self.draw_live_brush_stroke(self.image_to_screen_coords(img_x, img_y), self.image_to_screen_coords(img_x, img_y))
 
+        elif self.mode in ('lasso', 'fill'):
+            if self.circle_stencil is None:
+                messagebox.showwarning("Mask Error", "Please define a circle before masking.")
+                return 
+            img_x, img_y = self.screen_to_image_coords(event.x, event.y)
+            if self.mode == 'fill':
+                self.flood_fill_mask(int(img_x), int(img_y))
+            else:
+                self.lasso_points = [(img_x, img_y)]
+
         elif self.mode == 'ffd_grid': 
             if not self.super_control_points:
                 messagebox.showerror("Error", "Please define the Blue Die Dimension Rectangle first.")
@@ -529,6 +3174,7 @@ class ImageAnnotator:
                 dist_sq = (click_point[0] - anchor[0])**2 + (click_point[1] - anchor[1])**2
                 if dist_sq < r_image**2:
                     self.active_scp = (C_s, R_s)
+                    self.scp_drag_start = dict(self.super_control_points)
                     drag_point_found = True
                     self._draw_live_ffd_grid() 
                     break
@@ -545,6 +3191,7 @@ class ImageAnnotator:
                 C_clicked, R_clicked = clicked_die_CR
                 
                 self.die_origin_shift = (C_clicked, R_clicked)
+                self.live_counts.set_origin(self.die_origin_shift)
                 
                 logger.info(f"Die Naming Origin set to Die ({C_clicked}, {R_clicked}).")
                 self.status_label.config(text=f"Die Naming Origin set. New Naming Origin is Die ({C_clicked}, {R_clicked}).")
@@ -569,21 +3216,45 @@ class ImageAnnotator:
         elif self.mode == 'mask' and self.last_mask_pos:
             if self.circle_stencil is None: 
                 return
-            img_x, img_y = self.screen_to_image_coords(event.x, event.y)
-            self.paint_mask_stroke(int(self.last_mask_pos[0]), int(self.last_mask_pos[1]), 
-                                   int(img_x), int(img_y))
-            self.draw_live_brush_stroke(self.image_to_screen_coords(*self.last_mask_pos), (event.x, event.y))
-            self.last_mask_pos = (img_x, img_y)
+            self.pending_mask_points.append(self.screen_to_image_coords(event.x, event.y))
+            self._move_brush_cursor(event.x, event.y)
+            self._schedule_drag_flush()
+            
+        elif self.mode == 'lasso' and self.lasso_points:
+            self.lasso_points.append(self.screen_to_image_coords(event.x, event.y))
+            self._draw_lasso_preview()
             
         elif self.mode == 'ffd_grid' and self.active_scp is not None:
-            img_x, img_y = self.screen_to_image_coords(event.x, event.y)
+            self.pending_scp_pos = self.screen_to_image_coords(event.x, event.y)
+            self._schedule_drag_flush()
+
+    def _schedule_drag_flush(self):
+        if self.drag_flush_job is None:
+            self.drag_flush_job = self.root.after(self.FRAME_MS, self._flush_drag)
+
+    def _flush_drag(self):
+        """Processes all drag motion collected since the last frame in a single update."""
+        if self.drag_flush_job is not None:
+            self.root.after_cancel(self.drag_flush_job)
+            self.drag_flush_job = None
+        
+        if self.pending_mask_points and self.last_mask_pos:
+            points = [self.last_mask_pos] + self.pending_mask_points
+            self.pending_mask_points = []
+            self.paint_mask_polyline([(int(x), int(y)) for x, y in points])
+            self.draw_live_brush_stroke(*[self.image_to_screen_coords(x, y) for x, y in points[1:]])
+            self.last_mask_pos = points[-1]
+            self._refresh_live_stats()
+            
+        if self.pending_scp_pos is not None and self.active_scp is not None:
+            img_x, img_y = self.pending_scp_pos
             W_img, H_img = self.original_image.size
             img_x = max(0, min(W_img, img_x))
             img_y = max(0, min(H_img, img_y))
-            C_s, R_s = self.active_scp
-            self.super_control_points[(C_s, R_s)] = (img_x, img_y)
+            self.super_control_points[self.active_scp] = (img_x, img_y)
             self._draw_live_ffd_grid() 
             self.apply_ffd_button.config(state=tk.NORMAL)
+        self.pending_scp_pos = None
 
 
     def on_mouse_up(self, event):
@@ -605,16 +3276,63 @@ class ImageAnnotator:
             self.clear_temp_items()
             
         elif self.mode == 'mask' and self.last_mask_pos:
+            self._flush_drag()
             self.last_mask_pos = None
-            self.clear_temp_items()
+            self._clear_stroke_preview()
+            self.history.end_mask_action()
+            self.mask_journal.flush()
             if self.mask_dirty:
-                self.update_combined_image() 
                 self.schedule_image_resize()
                 self.mask_dirty = False
+            self.stroke_bbox = None
+            
+        elif self.mode == 'lasso' and self.lasso_points:
+            points = self.lasso_points
+            self._clear_lasso()
+            self.fill_mask_polygon(points)
                 
         elif self.mode == 'ffd_grid':
+            self._flush_drag()
+            if self.scp_drag_start is not None and self.scp_drag_start != self.super_control_points:
+                if self.snap_var.get():
+                    self._snap_scp_to_street(self.active_scp)
+                self.history.push_scp_action(self.scp_drag_start, self.Max_C, self.Max_R)
+            self.scp_drag_start = None
             self.active_scp = None
-            pass 
+
+    def _snap_scp_to_street(self, key):
+        """
+        Moves a dropped SCP so that the die corner nearest to it lies on the street intersection found
+        around that corner in the shown layer. The corner follows the SCP with its bilinear weight.
+        """
+        C_s, R_s = key
+        n = SCP_SIZE - 1
+        C, R = round(C_s * self.Max_C / n), round(R_s * self.Max_R / n)
+        weight = max(0.0, 1 - abs(C * n / self.Max_C - C_s)) * max(0.0, 1 - abs(R * n / self.Max_R - R_s))
+        if weight < 0.5:
+            return
+        points = self.interpolated_points
+        corner = np.array(points[(C, R)])
+        edge_x = np.subtract(points[(C + 1, R)], corner) if C < self.Max_C else corner - points[(C - 1, R)]
+        edge_y = np.subtract(points[(C, R + 1)], corner) if R < self.Max_R else corner - points[(C, R - 1)]
+        radius = min(SNAP_RADIUS_SCREEN / self.zoom_level, 
+                     SNAP_MAX_PITCH_FRACTION * min(np.hypot(*edge_x), np.hypot(*edge_y)))
+        
+        start = time.perf_counter()
+        found = snap_to_street_intersection(self.display_pyramid[0], corner, edge_x, edge_y, radius)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if found is None:
+            logger.debug(f"No street intersection found around die corner ({C}, {R}) ({elapsed_ms:.1f} ms).")
+            self.status_label.config(text="Snap: no street intersection found near the SCP.")
+            return
+        
+        dx, dy = (np.array(found) - corner) / weight
+        W_img, H_img = self.original_image.size
+        x, y = self.super_control_points[key]
+        self.super_control_points[key] = (max(0, min(W_img, x + dx)), max(0, min(H_img, y + dy)))
+        self._draw_live_ffd_grid()
+        logger.debug(f"SCP {key} snapped by ({dx:+.2f}, {dy:+.2f}) px in {elapsed_ms:.1f} ms.")
+        self.status_label.config(text=f"Snapped to street intersection ({dx:+.2f}, {dy:+.2f} px).")
 
     # --- count_valid_dies_and_generate_report ---
     def count_valid_dies_and_generate_report(self):
@@ -633,76 +3351,32 @@ class ImageAnnotator:
              return
 
 
-        x1, y1, x2, y2 = self.rectangle_geom
-        W_die_nominal, H_die_nominal = x2 - x1, y2 - y1
-        Area_Die_Nominal = W_die_nominal * H_die_nominal
-        
-        R_circ = self.circle_geom['radius']
-        Area_Circle = math.pi * R_circ**2
-        
-        Area_Mask_inside_Circle = self.calculate_mask_area_inside_circle()
-        Area_Clean = Area_Circle - Area_Mask_inside_Circle
-        Ratio_Estimation = Area_Clean / Area_Die_Nominal 
-        
-        die_counts_clean = {name: 0 for name in DIE_NAMES} 
-        total_dies_in_circle = 0
-        total_clean_dies = 0     
-        total_masked_dies = 0    
-        
-        ux, uy = self.circle_geom['center']
-        radius_sq = self.circle_geom['radius'] ** 2
-        
-        for (C, R), info in self.die_info_cache.items():
-            center_x, center_y = info['center']
-
-            dist_sq = (center_x - ux)**2 + (center_y - uy)**2
-        
-            if dist_sq < radius_sq:
-                total_dies_in_circle += 1
-                is_painted_green = self._is_die_masked(center_x, center_y)
-                
-                if not is_painted_green:
-                    total_clean_dies += 1 
-
-                    die_name = self._get_die_name(C, R)
-                    
-                    die_counts_clean[die_name] += 1
-                else:
-                    total_masked_dies += 1 
-                            
-        report_lines = []
-        report_lines.append("--- Die Count Report ---")
-        report_lines.append(f"Original Image: {os.path.basename(self.original_image_path)}")
-        report_lines.append("------------------------------------------------------")
-        report_lines.append("\n--- Area Ratio Estimation ---")
-        report_lines.append(f"Circle Area: {Area_Circle:,.2f} px²")
-        report_lines.append(f"Mask Area (No dies, inside Circle): {Area_Mask_inside_Circle:,.0f} px²") 
-        report_lines.append(f"Non-masked Area (Dies, inside Circle): {Area_Clean:,.2f} px²")
-        report_lines.append(f"Nominal Die Area (User selected): {Area_Die_Nominal:,.2f} px²")
-        report_lines.append(f"Estimated Total Dies: {Ratio_Estimation:.0f} dies") 
-        report_lines.append("------------------------------------------------------")
-        report_lines.append("\n--- Grid Die Counts ---")
-        report_lines.append(f"Total Dies Defined by Mesh in Circle: {total_dies_in_circle}")
-        report_lines.append(f"Total Dies in Masked Area (Removed dies): {total_masked_dies}") 
-        report_lines.append(f"Total Dies in Non-masked Area (Avilaable dies): {total_clean_dies}") 
-        report_lines.append("------------------------------------------------------")
-        report_lines.append("\n--- Detailed Die Counts (Clean/Unpainted Dies Only) ---")
-        report_lines.append("Die Type\t\tCount")
-        report_lines.append("-" * 49)
-        for name, count in die_counts_clean.items():
-            report_lines.append(f"{name}:\t{count}")
-        report_content = "\n".join(report_lines)
+        try:
+            layers = self.layer_stack.full_resolution_layers()
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load layer: {e}")
+            return
+        full = self._full_resolution_state()
+        try:
+            report = compute_die_report(full['image'], full['mask'].region, full['die_table'], full['masked'], 
+                                        full['circle'], full['rectangle'], self.die_origin_shift, self.edge_exclusion,
+                                        mask_area=full['mask_area'], layers=layers)
+        except OSError as e:
+            messagebox.showerror("Error", f"Failed to read layer: {e}")
+            return
+        self.die_stats = {'keys': full['die_table']['keys'], 'stats': report['die_stats'], 'flagged': report['flagged']}
         
         try:
-            if self.original_image_path:
-                img_dir = os.path.dirname(self.original_image_path)
-                base_name = os.path.splitext(os.path.basename(self.original_image_path))[0]
-                report_filename = os.path.join(img_dir, f"{base_name}_Report.txt")
-            else:
-                report_filename = "Report.txt"
+            report_filename = self._output_path("_Report.txt")
+            stats_filename = self._output_path("_DieStats.csv")
+            report_content = format_die_report(report, os.path.basename(self.original_image_path), 
+                                               os.path.basename(stats_filename))
 
             with open(report_filename, 'w') as f:
                 f.write(report_content)
+            
+            write_die_statistics_csv(stats_filename, report)
+            logger.info(f"Per-die statistics exported: {stats_filename}")
 
             messagebox.showinfo("Report Exported", 
                                 f"Full die count report successfully generated and saved to:\n{report_filename}")
@@ -710,39 +3384,154 @@ class ImageAnnotator:
         except Exception as e:
             messagebox.showerror("Export Error", f"Failed to save report: {e}")
 
+    def extract_clean_dies(self):
+        """Writes every clean full die as a crop into atlas PNGs with an index CSV, for downstream ML."""
+        if self.mode == 'ffd_grid' and self.apply_ffd_button.cget('state') == tk.NORMAL:
+            messagebox.showwarning("Pending Changes", "Please click 'APPLY GRID' to save the current grid before extracting dies.")
+            return
+        if not self.die_info_cache or not self.original_image_path:
+            messagebox.showerror("Error", "Load an image and APPLY an FFD grid before extracting dies.")
+            return
+        
+        out_dir = filedialog.askdirectory(title="Die Atlas Output Folder", 
+                                          initialdir=os.path.dirname(self.original_image_path))
+        if not out_dir:
+            return
+        base_name = os.path.splitext(os.path.basename(self.original_image_path))[0]
+        self.status_label.config(text="Extracting dies...")
+        self.root.update_idletasks()
+        try:
+            full = self._full_resolution_state()
+            clean = (full['die_table']['classes'] == DIE_FULL) & ~full['masked']
+            index_filename = extract_die_atlases(full['image'], full['die_table'], clean, self.die_origin_shift, 
+                                                 out_dir, base_name)
+        except Exception as e:
+            messagebox.showerror("Export Error", f"Failed to extract dies: {e}")
+            logger.error(f"Failed to extract dies: {e}")
+            return
+        self.status_label.config(text=f"Extracted {int(clean.sum())} dies.")
+        messagebox.showinfo("Dies Extracted", f"{int(clean.sum())} die crops written, indexed in:\n{index_filename}")
+
+    def save_rectified_image(self):
+        """Exports the full-resolution image dewarped by the committed mesh, every die on the nominal die pitch."""
+        if self.mode == 'ffd_grid' and self.apply_ffd_button.cget('state') == tk.NORMAL:
+            messagebox.showwarning("Pending Changes", "Please click 'APPLY GRID' to save the current grid before rectifying.")
+            return
+        if not self.die_info_cache or self.rectangle_geom is None:
+            messagebox.showerror("Error", "Define the die dimension and APPLY an FFD grid before rectifying.")
+            return
+        filename = filedialog.asksaveasfilename(
+            defaultextension=".png",
+            initialfile=os.path.basename(self._output_path("_Rectified.png")),
+            filetypes=[("PNG files", "*.png"), ("TIFF files", "*.tif"), ("All files", "*.*")],
+            title="Save Rectified Image"
+        )
+        if not filename:
+            return
+        
+        self.status_label.config(text="Rectifying...")
+        self.root.update_idletasks()
+        try:
+            start = time.perf_counter()
+            full = self._full_resolution_state()
+            x1, y1, x2, y2 = full['rectangle']
+            pitch = (max(1, int(round(abs(x2 - x1)))), max(1, int(round(abs(y2 - y1)))))
+            corners = mesh_corner_array(self.interpolated_points, self.Max_C, self.Max_R) * self.work_scale
+            size = write_rectified_image(filename, full['image'], corners, pitch, self.die_origin_shift)
+        except Exception as e:
+            messagebox.showerror("Export Error", f"Failed to save rectified image: {e}")
+            logger.error(f"Failed to save rectified image: {e}")
+            return
+        logger.info(f"Rectified image {size[0]} x {size[1]} saved in {time.perf_counter() - start:.2f} s: {filename}")
+        self.status_label.config(text=f"Rectified image saved ({pitch[0]} x {pitch[1]} px per die).")
+        messagebox.showinfo("Rectified Image", f"Die (C, R) occupies x {pitch[0]}*C, y {pitch[1]}*R "
+                                               f"({pitch[0]} x {pitch[1]} px) in:\n{filename}")
+
+    def _work_scale_mean(self):
+        return (self.work_scale[0] + self.work_scale[1]) / 2
+
+    def _full_resolution_state(self):
+        """
+        Image, mask, circle, die rectangle and die table (with classes and masked state) at full
+        resolution, for the report, die extraction and image export. With a working copy the source
+        is decoded again and the mask is replayed from the journal, so brush and lasso strokes are
+        rasterized exactly instead of being upsampled (the working mask is only upsampled when
+        there is no journal).
+        """
+        table = self.die_table if self.die_table is not None else self._update_die_classification()
+        if self.work_scale == (1.0, 1.0):
+            return {'image': self.original_image, 'mask': self.mask_paint_layer, 'circle': dict(self.circle_geom), 
+                    'rectangle': self.rectangle_geom, 'die_table': table, 'masked': self.live_counts.masked, 
+                    'mask_area': self.calculate_mask_area_inside_circle()}
+        
+        start = time.perf_counter()
+        image = Image.open(self.original_image_path).convert("RGB")
+        W, H = image.size
+        ops = self.mask_journal.ops()
+        if ops is not None:
+            mask, _ = replay_mask_journal(ops, (W, H))
+        else:
+            logger.warning("No mask journal for this image: the working-copy mask is upsampled.")
+            mask = self.mask_paint_layer.resized(W, H)
+        geometry = scale_geometry({'circle': self.circle_geom if self.circle_geom['radius'] is not None else None, 
+                                   'rectangle': self.rectangle_geom, 'super_control_points': {}}, self.work_scale)
+        full_table = dict(table, polygons=table['polygons'] * self.work_scale, centers=table['centers'] * self.work_scale)
+        circle = geometry['circle'] or {'center': None, 'radius': None}
+        if circle['radius'] is not None:
+            full_table['classes'] = classify_dies(full_table['polygons'], circle['center'], circle['radius'], self.edge_exclusion)
+        logger.info(f"Full-resolution state rebuilt in {time.perf_counter() - start:.2f} s.")
+        return {'image': image, 'mask': mask, 'circle': circle, 'rectangle': geometry['rectangle'], 'die_table': full_table,
+                'masked': sample_mask_at_points(mask.region, full_table['centers'], W, H), 'mask_area': None}
+
+    def _output_path(self, suffix):
+        """Path next to the original image, e.g. '<image>_Report.txt' for suffix '_Report.txt'."""
+        if self.original_image_path:
+            img_dir = os.path.dirname(self.original_image_path)
+            base_name = os.path.splitext(os.path.basename(self.original_image_path))[0]
+            return os.path.join(img_dir, f"{base_name}{suffix}")
+        return suffix.lstrip('_')
+    
     # --- Display Update ---
-    def update_display(self):
-        if self.combined_image is None: 
+    def update_display(self, fast=False):
+        """
+        Redraws the visible region. A fast frame (while zooming or panning) is composed from the
+        nearest halved display copy and resampled with NEAREST/BILINEAR; the default is full LANCZOS.
+        """
+        if self.original_image is None or self.mask_paint_layer is None: 
             return
             
-        canvas_w = self.canvas.winfo_width()
-        canvas_h = self.canvas.winfo_height()
-        
-        x_img_start = -self.pan_x / self.zoom_level
-        y_img_start = -self.pan_y / self.zoom_level
-        
-        w_img_crop = canvas_w / self.zoom_level
-        h_img_crop = canvas_h / self.zoom_level
-        
-        x0 = max(0, int(x_img_start))
-        y0 = max(0, int(y_img_start))
-        x1 = min(self.combined_image.width, int(x_img_start + w_img_crop))
-        y1 = min(self.combined_image.height, int(y_img_start + h_img_crop))
-        
-        if x1 <= x0 or y1 <= y0:
+        view = self._visible_image_box()
+        if view is None:
             if self.canvas_image: 
                 self.canvas.delete(self.canvas_image)
             self.canvas_image = None
             return 
+        x0, y0, x1, y1 = view
+        
+        level = 0
+        if fast and self.zoom_level < 1.0:
+            level = min(len(self.display_pyramid) - 1, int(math.log2(1.0 / self.zoom_level)))
+        if level > 0:
+            # Align the crop to the level's pixel grid
+            step = 2 ** level
+            W, H = self.original_image.size
+            x0, y0 = x0 // step * step, y0 // step * step
+            x1, y1 = min(W, -(-x1 // step) * step), min(H, -(-y1 // step) * step)
             
-        cropped_img = self.combined_image.crop((x0, y0, x1, y1))
+        cropped_img = self.compose_region((x0, y0, x1, y1), level)
         actual_crop_width = x1 - x0
         actual_crop_height = y1 - y0
         new_size_w = int(actual_crop_width * self.zoom_level)
         new_size_h = int(actual_crop_height * self.zoom_level)
         
         if new_size_w > 0 and new_size_h > 0:
-            display_img = cropped_img.resize((new_size_w, new_size_h), Image.LANCZOS) 
+            if not fast:
+                resample = Image.LANCZOS
+            elif self.zoom_level >= 1.0:
+                resample = Image.NEAREST
+            else:
+                resample = Image.BILINEAR
+            display_img = cropped_img.resize((new_size_w, new_size_h), resample) 
             self.photo = ImageTk.PhotoImage(display_img)
         else:
             return
@@ -778,6 +3567,25 @@ class ImageAnnotator:
         
         self.canvas.tag_raise("all")
         self.mask_dirty = False 
+        self._refresh_live_stats()
+
+
+    def _visible_image_box(self):
+        """The (x0, y0, x1, y1) image region currently shown on the canvas, or None if off-screen."""
+        x_img_start = -self.pan_x / self.zoom_level
+        y_img_start = -self.pan_y / self.zoom_level
+        
+        w_img_crop = self.canvas.winfo_width() / self.zoom_level
+        h_img_crop = self.canvas.winfo_height() / self.zoom_level
+        
+        x0 = max(0, int(x_img_start))
+        y0 = max(0, int(y_img_start))
+        x1 = min(self.original_image.width, int(x_img_start + w_img_crop))
+        y1 = min(self.original_image.height, int(y_img_start + h_img_crop))
+        
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return (x0, y0, x1, y1)
 
 
 # --- Helper Methods ---
@@ -787,20 +3595,18 @@ class ImageAnnotator:
         logger.debug(f"Brush size updated to: {self.brush_size}")
 
     def _is_die_masked(self, x, y):
-        """Checks the alpha channel of the mask_paint_layer at the given image coordinates (x, y)."""
+        """Checks the mask_paint_layer bit at the given image coordinates (x, y)."""
         if self.mask_paint_layer is None: 
             return False
             
         W, H = self.mask_paint_layer.size
         ix = max(0, min(W - 1, int(x)))
         iy = max(0, min(H - 1, int(y)))
+        return self.mask_paint_layer.get(ix, iy)
         
-        try:
-            pixel = self.mask_paint_layer.getpixel((ix, iy))
-            alpha_value = pixel[3]
-            return alpha_value >= 120
-        except IndexError:
-            return False
+    def _masked_region(self, box):
+        """Boolean mask for an (x0, y0, x1, y1) box of the mask layer."""
+        return self.mask_paint_layer.region(box)
         
     def _find_clicked_die(self, img_x, img_y):
         """Finds the (C, R) of the die whose center is closest to the click."""
@@ -823,30 +3629,10 @@ class ImageAnnotator:
         return self.interpolated_points.get((C, R), (0, 0)) 
         
     def _get_die_polygon_by_index(self, C, R):
-        if C < 0 or C >= self.Max_C or R < 0 or R >= self.Max_R: 
-            return None
-        P_UL = self._get_interpolated_point(C, R)         
-        P_UR = self._get_interpolated_point(C + 1, R)     
-        P_LR = self._get_interpolated_point(C + 1, R + 1) 
-        P_LL = self._get_interpolated_point(C, R + 1)     
-        die_polygon = [P_LL, P_LR, P_UR, P_UL] 
-        return die_polygon
+        return die_polygon_from_points(self.interpolated_points, C, R, self.Max_C, self.Max_R)
     
     def _get_die_name(self, C, R):
-        C_shift, R_shift = self.die_origin_shift
-        C_new = C - C_shift
-        R_new = R - R_shift
-
-        Die_C = C_new % NUM_COLS
-        
-        # Die_R: Reverse the vertical direction of the repeating pattern
-        Die_R_raw = R_new % NUM_ROWS
-        Die_R = NUM_ROWS - 1 - Die_R_raw 
-        
-        die_index = Die_C * NUM_ROWS + Die_R 
-        die_name = DIE_NAMES[die_index % len(DIE_NAMES)]
-
-        return die_name
+        return get_die_name(C, R, self.die_origin_shift)
 
     def screen_to_image_coords(self, x, y):
         img_x = (x - self.pan_x) / self.zoom_level
@@ -865,86 +3651,437 @@ class ImageAnnotator:
         
     def clear_mask(self):
         if self.original_image:
-             W, H = self.original_image.size
-             self.mask_paint_layer = Image.new('RGBA', (W, H), (0, 0, 0, 0))
-             self.live_mask_draw = ImageDraw.Draw(self.mask_paint_layer) 
+             # Only the painted part of the layer has to go into the history
+             painted_bbox = self.mask_paint_layer.getbbox()
+             area_before = self.live_counts.area_in(painted_bbox)
+             if painted_bbox is not None:
+                 self.history.begin_mask_action()
+                 self.history.capture_tiles(self.mask_paint_layer, painted_bbox)
+                 self.history.end_mask_action()
+             self.mask_paint_layer.clear()
+             self.live_counts.mask_changed(painted_bbox, area_before)
+             self.mask_journal.record({'op': 'clear'})
+             self.mask_journal.flush()
              logger.info("Mask layer cleared.")
+             self.schedule_image_resize()
              self._rebuild_annotation_layer()
              
     def calculate_mask_area_inside_circle(self):
-        if self.mask_paint_layer is None: 
-            return 0 
-        mask_alpha = np.array(self.mask_paint_layer.getchannel('A'))
-        W, H = self.original_image.size
-        
-        x_min, x_max, y_min, y_max = 0, W, 0, H
+        """Masked pixel count clipped exactly to the circle (kept current by live_counts)."""
+        return self.live_counts.mask_area
+    
+    def _update_die_classification(self):
+        """Re-classifies all committed dies against the circle and edge exclusion. Returns the die table."""
+        keys, polygons, centers = die_table_arrays(self.die_info_cache)
+        if self.circle_geom['radius'] is None:
+            classes = np.full(len(keys), DIE_FULL, dtype=np.int8)
+        else:
+            classes = classify_dies(polygons, self.circle_geom['center'], self.circle_geom['radius'], 
+                                    self.edge_exclusion / self._work_scale_mean())
+        self.die_table = {'keys': keys, 'polygons': polygons, 'centers': centers, 'classes': classes}
+        self.live_counts.set_dies(self.die_table, self.die_origin_shift)
+        return self.die_table
+    
+    def _refresh_live_stats(self):
+        counts = self.live_counts.snapshot()
+        text = f"Masked Area: {round(counts['area_mask'] * self.work_scale[0] * self.work_scale[1]):,} px"
         if self.circle_geom['radius'] is not None:
-             ux, uy = self.circle_geom['center']
-             R = self.circle_geom['radius']
-             x_min = max(0, int(ux - R))
-             x_max = min(W, int(ux + R))
-             y_min = max(0, int(uy - R))
-             y_max = min(H, int(uy + R))
-             
-        mask_pixels = (mask_alpha[y_min:y_max, x_min:x_max] >= 120) 
-        mask_area_pixels = np.sum(mask_pixels)
-        return mask_area_pixels
+            text += f" ({100.0 * counts['area_mask'] / (math.pi * self.circle_geom['radius'] ** 2):.2f}% of circle)"
+        if self.live_counts.die_table is not None:
+            text += (f"  |  Dies in Circle: {counts['total_in_circle']}  Clean: {counts['total_clean']}  "
+                     f"Masked: {counts['total_masked']}  Partial: {counts['total_partial']}  "
+                     f"Excluded: {counts['total_excluded']}")
+            text += "  |  " + "  ".join(f"{name.strip()}={count}" for name, count in counts['die_counts_clean'].items() if count)
+        self.stats_label.config(text=text)
         
-    def draw_circle_from_points(self):
-        p1, p2, p3 = self.circle_points
-        ax, ay = p1
-        bx, by = p2 
-        cx, cy = p3
+    def update_enhancement(self):
+        """Applies the view bar's display filters; the tile cache is only dropped when a value changed."""
+        try:
+            gamma = min(5.0, max(0.2, float(self.gamma_var.get())))
+        except ValueError:
+            return
+        params = {'channel': self.view_channel_var.get(), 'stretch': bool(self.stretch_var.get()), 
+                  'clahe': bool(self.clahe_var.get()), 'gamma': gamma}
+        for enhancer in self.layer_enhancers.values():
+            if enhancer is not self.enhancer:
+                enhancer.set_params(**params)
+        if self.enhancer.set_params(**params):
+            self.schedule_image_resize()
+
+    # --- Layer Stack ---
+    def _refresh_layer_menu(self):
+        menu = self.layer_menu['menu']
+        menu.delete(0, 'end')
+        for index, name in enumerate(self.layer_stack.names()):
+            menu.add_command(label=f"{name} (Ctrl+{index + 1})" if index < 9 else name, 
+                             command=lambda name=name: self.show_layer(name))
+        self.layer_var.set(self.layer_name)
+
+    def add_layers(self):
+        """Adds further scans of the current wafer (same pixel size) as layers; they are decoded when first shown."""
+        if self.layer_stack is None:
+            return
+        paths = filedialog.askopenfilenames(title="Select Layer Images", 
+                                            initialdir=os.path.dirname(self.original_image_path),
+                                            filetypes=[("Image Files", "*.png;*.jpg;*.jpeg;*.tif;*.tiff")])
+        errors = []
+        for path in paths:
+            try:
+                name = self.layer_stack.add(path)
+                logger.info(f"Layer added: {name}")
+            except (OSError, ValueError) as e:
+                errors.append(str(e))
+        self._refresh_layer_menu()
+        if errors:
+            messagebox.showerror("Layer Error", "Not added:\n" + "\n".join(errors))
+
+    def show_layer(self, layer):
+        """Shows a layer (by name or index); the mask, grid and annotations stay as they are."""
+        if self.layer_stack is None:
+            return
+        names = self.layer_stack.names()
+        if isinstance(layer, int):
+            if layer >= len(names):
+                return
+            layer = names[layer]
+        if layer == self.layer_name:
+            return
+        try:
+            pyramid = self.layer_stack.pyramid(layer)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to load layer: {e}")
+            return
+        if layer not in self.layer_enhancers:
+            enhancer = DisplayEnhancer()
+            enhancer.set_params(**self.enhancer.params)
+            enhancer.set_image(pyramid[0])
+            self.layer_enhancers[layer] = enhancer
+        self.display_pyramid = pyramid
+        self.enhancer = self.layer_enhancers[layer]
+        self.layer_name = layer
+        self.layer_var.set(layer)
+        self.update_display()
+
+    def update_edge_exclusion(self):
+        try:
+            value = max(0.0, float(self.edge_exclusion_var.get()))
+        except ValueError:
+            return
+        if value == self.edge_exclusion:
+            return
+        self.edge_exclusion = value
+        logger.debug(f"Edge exclusion updated to: {self.edge_exclusion} px")
+        self._update_die_classification()
+        self._rebuild_annotation_layer()
+        self.schedule_image_resize()
         
-        d = 2 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
-        if abs(d) < 1e-10:
+    def draw_circle_from_points(self):
+        circle = circle_from_points(*self.circle_points)
+        if circle is None:
             messagebox.showerror("Error", "Points are collinear. Cannot define a circle.")
             self.clear_temp_items()
             return
-            
-        ux = ((ax**2 + ay**2) * (by - cy) + (bx**2 + by**2) * (cy - ay) + (cx**2 + cy**2) * (ay - by)) / d
-        uy = ((ax**2 + ay**2) * (cx - bx) + (bx**2 + by**2) * (ax - cx) + (cx**2 + cy**2) * (bx - ax)) / d
-        radius = math.sqrt((ax - ux)**2 + (ay - uy)**2)
+        self._set_circle(*circle)
+        self.clear_temp_items()
         
-        self.circle_geom['center'] = (ux, uy)
+    def _set_circle(self, center, radius):
+        self.circle_geom['center'] = center
         self.circle_geom['radius'] = radius
+        self._update_die_classification()
         
-        bbox = [ux - radius, uy - radius, ux + radius, uy + radius]
         W, H = self.original_image.size
-        self.circle_stencil = Image.new('1', (W, H), 0)
-        stencil_draw = ImageDraw.Draw(self.circle_stencil)
-        stencil_draw.ellipse(bbox, fill=1)
+        self.circle_stencil = BitMask.from_disk(W, H, center, radius)
+        self.live_counts.attach(self.mask_paint_layer, self.circle_stencil)
+        self.mask_journal.record({'op': 'circle', 'center': [float(center[0]), float(center[1])], 'radius': float(radius)})
+        self.mask_journal.flush()
         
         self._rebuild_annotation_layer()
-        self.clear_temp_items()
         
     def paint_mask_stroke(self, x1, y1, x2, y2):
+        self.paint_mask_polyline([(x1, y1), (x2, y2)])
+        
+    def paint_mask_polyline(self, points):
+        """Paints a square-brush stroke through all points, then clips once to the circle."""
         if self.circle_stencil is None: 
             return
-        mask_color = (0, 255, 0, 128) 
-        self.live_mask_draw.line([(x1, y1), (x2, y2)], fill=mask_color, width=self.brush_size, joint='bevel')
-        r = self.brush_size / 2
-        bbox_cap = [x2 - r, y2 - r, x2 + r, y2 + r]
-        self.live_mask_draw.rectangle(bbox_cap, fill=mask_color)
-        
-        mask_alpha = np.array(self.mask_paint_layer.getchannel('A'))
-        stencil_array = np.array(self.circle_stencil)
+        W, H = self.mask_paint_layer.size
+        bbox = brush_stroke_bbox(points, self.brush_size, W, H)
+        if bbox is None:
+            return
+        self.history.capture_tiles(self.mask_paint_layer, bbox)
+        self.mask_journal.record({'op': 'brush', 'size': self.brush_size, 'points': [list(p) for p in points]})
         
-        if mask_alpha.shape == stencil_array.shape:
-            clipped_alpha = mask_alpha * stencil_array 
-            self.mask_paint_layer.putalpha(Image.fromarray(clipped_alpha.astype(np.uint8)))
-            self.live_mask_draw = ImageDraw.Draw(self.mask_paint_layer) 
+        # Rasterize the stroke into a bbox-sized scratch image, clip it to the circle, OR it into the bits
+        stroke = brush_stroke_region(bbox, points, self.brush_size)
+        stroke &= self.circle_stencil.region(bbox)
+        area_before = self.live_counts.area_in(bbox)
+        self.mask_paint_layer.or_region(bbox, stroke)
+        self.live_counts.mask_changed(bbox, area_before)
             
+        self.stroke_bbox = _union_bbox(self.stroke_bbox, bbox)
         self.mask_dirty = True
         
-    def draw_live_brush_stroke(self, start_screen_pos, end_screen_pos):
-        r = self.brush_size * self.zoom_level / 2
+    # --- Lasso and Flood Fill ---
+    def _add_mask_region(self, bbox, region, label, journal_op=None):
+        """
+        ORs a boolean region (already clipped to the circle) into the mask as one undoable action.
+        It is journaled as journal_op if given (vector form), else as the region itself.
+        """
+        if not region.any():
+            self.status_label.config(text=f"{label}: nothing to mask inside the circle.")
+            return
+        if journal_op is not None:
+            self.mask_journal.record(journal_op)
+        else:
+            self.mask_journal.record_region(bbox, region)
+        self.mask_journal.flush()
+        self.history.begin_mask_action()
+        self.history.capture_tiles(self.mask_paint_layer, bbox)
+        area_before = self.live_counts.area_in(bbox)
+        self.mask_paint_layer.or_region(bbox, region)
+        self.live_counts.mask_changed(bbox, area_before)
+        self.history.end_mask_action()
+        self.schedule_image_resize()
+        logger.info(f"{label} masked {int(region.sum())} px in {bbox}.")
+        
+    def fill_mask_polygon(self, points):
+        """Masks the interior of a closed lasso polygon (image coords) in one scanline pass."""
+        if self.circle_stencil is None or len(points) < 3:
+            return
+        W, H = self.mask_paint_layer.size
+        xs = [p[0] for p in points]
+        ys = [p[1] for p in points]
+        bbox = _clip_bbox((min(xs), min(ys), max(xs) + 1, max(ys) + 1), W, H)
+        if bbox is None:
+            return
+        region = polygon_region(bbox, points) & self.circle_stencil.region(bbox)
+        self._add_mask_region(bbox, region, "Lasso", {'op': 'lasso', 'points': [[float(x), float(y)] for x, y in points]})
+        
+    def flood_fill_mask(self, x, y):
+        """Masks the 4-connected region of similar color around (x, y), bounded by the circle and the visible view."""
+        if self.circle_stencil is None:
+            return
+        try:
+            tolerance = max(0, int(self.fill_tolerance_var.get()))
+        except ValueError:
+            tolerance = FILL_TOLERANCE
+        W, H = self.mask_paint_layer.size
+        view = self._visible_image_box()
+        circle_bbox = self.circle_stencil.getbbox()
+        if view is None or circle_bbox is None or not (0 <= x < W and 0 <= y < H):
+            return
+        bbox = _clip_bbox((max(view[0], circle_bbox[0]), max(view[1], circle_bbox[1]), 
+                           min(view[2], circle_bbox[2]), min(view[3], circle_bbox[3])), W, H)
+        if bbox is None or not (bbox[0] <= x < bbox[2] and bbox[1] <= y < bbox[3]):
+            return
+        
+        rgb = np.asarray(self.display_pyramid[0].crop(bbox).convert("RGB")).astype(np.int16)
+        seed_color = rgb[y - bbox[1], x - bbox[0]]
+        candidate = np.abs(rgb - seed_color).max(axis=2) <= tolerance
+        candidate &= self.circle_stencil.region(bbox)
+        region = flood_fill_region(candidate, (x - bbox[0], y - bbox[1]))
+        self._add_mask_region(bbox, region, "Fill")
+        
+    # --- Mask Journal ---
+    def recover_mask_journal(self, filename):
+        """Rebuilds the mask (and circle) of the current image from its journal. Returns True on success."""
+        try:
+            ops = read_mask_journal(filename)
+            mask, circle = replay_mask_journal(ops, self.original_image.size)
+        except Exception as e:
+            messagebox.showerror("Recovery Error", f"Failed to replay mask journal: {e}")
+            return False
+        self.mask_paint_layer = mask
+        self.live_counts.attach(mask, None)
+        if circle is not None:
+            self._set_circle(circle['center'], circle['radius'])
+        self.schedule_image_resize()
+        logger.info(f"Mask recovered from {os.path.basename(filename)} ({len(ops) - 1} operations).")
+        return True
+        
+    def import_mask_journal(self):
+        """Replays another image's mask journal (e.g. a sibling scan of the same wafer) at this image's resolution."""
+        if self.original_image is None:
+            return
+        filename = filedialog.askopenfilename(title="Select Mask Journal", 
+                                              filetypes=[("Mask Journals", "*_MaskJournal.jsonl")])
+        if not filename:
+            return
+        try:
+            mask, circle = replay_mask_journal(read_mask_journal(filename), self.original_image.size)
+        except Exception as e:
+            messagebox.showerror("Import Error", f"Failed to replay mask journal: {e}")
+            return
+        if self.circle_stencil is None:
+            if circle is None:
+                messagebox.showwarning("Mask Error", "Please define a circle before importing a mask.")
+                return
+            self._set_circle(circle['center'], circle['radius'])
+        bbox = mask.getbbox()
+        if bbox is None:
+            self.status_label.config(text="Journal import: the journal has no mask.")
+            return
+        self._add_mask_region(bbox, mask.region(bbox) & self.circle_stencil.region(bbox), "Journal import")
+        
+    def _draw_lasso_preview(self):
+        coords = [c for point in self.lasso_points for c in self.image_to_screen_coords(*point)]
+        if len(coords) < 4:
+            return
+        coords += coords[:2] # Show the closing edge
+        if self.lasso_item is None:
+            self.lasso_item = self.canvas.create_line(*coords, fill='yellow', width=2)
+        else:
+            self.canvas.coords(self.lasso_item, *coords)
+            
+    def _clear_lasso(self):
+        if self.lasso_item is not None:
+            self.canvas.delete(self.lasso_item)
+        self.lasso_item = None
+        self.lasso_points = []
+        
+    # --- Auto Mask ---
+    def open_auto_mask_dialog(self):
+        """Opens the auto-mask dialog with a live threshold preview on a downsampled copy."""
+        if self.original_image is None:
+            return
+        if self.circle_stencil is None:
+            messagebox.showwarning("Mask Error", "Please define a circle before generating a mask.")
+            return
+        
+        W, H = self.original_image.size
+        scale = min(1.0, AUTO_MASK_PREVIEW_SIZE / max(W, H))
+        preview_size = (max(1, int(W * scale)), max(1, int(H * scale)))
+        preview_image = self.original_image.resize(preview_size, Image.BILINEAR)
+        preview_rgb = np.asarray(preview_image)
+        ux, uy = self.circle_geom['center']
+        preview_stencil = disk_region((0, 0) + preview_size, (ux * scale, uy * scale), self.circle_geom['radius'] * scale)
+        reference_color = estimate_wafer_color(preview_rgb, preview_stencil)
+        
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Auto Mask")
+        dialog.transient(self.root)
+        
+        controls = tk.Frame(dialog)
+        controls.pack(side=tk.TOP, fill=tk.X)
+        method_var = tk.StringVar(value='color')
+        tk.Radiobutton(controls, text="Color Distance", variable=method_var, value='color').pack(side=tk.LEFT)
+        tk.Radiobutton(controls, text="Local Contrast", variable=method_var, value='contrast').pack(side=tk.LEFT)
+        tk.Label(controls, text=" | Threshold:").pack(side=tk.LEFT)
+        threshold_slider = tk.Scale(controls, from_=1, to=255, orient=tk.HORIZONTAL, length=200)
+        threshold_slider.set(60)
+        threshold_slider.pack(side=tk.LEFT)
+        tk.Label(controls, text=" | Cleanup (px):").pack(side=tk.LEFT)
+        morph_slider = tk.Scale(controls, from_=0, to=51, orient=tk.HORIZONTAL, length=120)
+        morph_slider.set(9)
+        morph_slider.pack(side=tk.LEFT)
+        
+        preview_canvas = tk.Canvas(dialog, width=preview_size[0], height=preview_size[1], bg='gray')
+        preview_canvas.pack(side=tk.TOP)
+        info_label = tk.Label(dialog, text="", fg="blue")
+        info_label.pack(side=tk.TOP, fill=tk.X)
+        
+        state = {'job': None, 'photo': None}
+        
+        def current_params(scale_factor):
+            return {'method': method_var.get(), 
+                    'threshold': threshold_slider.get(), 
+                    'morph_size': max(0, int(round(morph_slider.get() * scale_factor))),
+                    'reference_color': reference_color,
+                    'contrast_radius': max(1, int(round(8 * scale_factor)))}
+        
+        def render_preview():
+            state['job'] = None
+            anomaly = compute_anomaly_mask(preview_rgb, preview_stencil, **current_params(scale))
+            overlay = preview_image.convert("RGBA")
+            tint = Image.new("RGBA", preview_size, MASK_COLOR)
+            overlay.paste(tint, (0, 0), Image.fromarray(anomaly.astype(np.uint8) * 255))
+            state['photo'] = ImageTk.PhotoImage(overlay)
+            preview_canvas.delete("all")
+            preview_canvas.create_image(0, 0, anchor=tk.NW, image=state['photo'])
+            covered = anomaly.sum() / max(1, preview_stencil.sum())
+            info_label.config(text=f"Preview: {covered:.1%} of the circle would be masked.")
+        
+        def schedule_preview(*_):
+            if state['job']:
+                dialog.after_cancel(state['job'])
+            state['job'] = dialog.after(self.RESIZE_DEBOUNCE_MS, render_preview)
+        
+        def apply_and_close():
+            params = current_params(1.0)
+            dialog.destroy()
+            self.apply_auto_mask(params)
+        
+        threshold_slider.config(command=schedule_preview)
+        morph_slider.config(command=schedule_preview)
+        method_var.trace_add('write', schedule_preview)
+        
+        buttons = tk.Frame(dialog)
+        buttons.pack(side=tk.TOP, fill=tk.X)
+        tk.Button(buttons, text="Apply (Full Resolution)", command=apply_and_close, bg='lightgreen').pack(side=tk.LEFT, padx=5, pady=2)
+        tk.Button(buttons, text="Cancel", command=dialog.destroy).pack(side=tk.LEFT, padx=5, pady=2)
+        
+        render_preview()
+        
+    def apply_auto_mask(self, params):
+        """Segments the full-resolution image tile-parallel and adds the result to the mask layer."""
+        if self.original_image is None or self.circle_stencil is None:
+            return
+        logger.info(f"Running auto mask ({params['method']}, threshold {params['threshold']}, cleanup {params['morph_size']} px)...")
+        
+        changed_bbox = None
+        self.history.begin_mask_action()
+        for tile_box, core in compute_anomaly_mask_tiled(self.original_image, self.circle_stencil, params):
+            self.history.capture_tiles(self.mask_paint_layer, tile_box)
+            self.mask_journal.record_region(tile_box, core)
+            area_before = self.live_counts.area_in(tile_box)
+            self.mask_paint_layer.or_region(tile_box, core)
+            self.live_counts.mask_changed(tile_box, area_before)
+            changed_bbox = _union_bbox(changed_bbox, tile_box)
+        self.history.end_mask_action()
+        self.mask_journal.flush()
+        
+        if changed_bbox is None:
+            self.status_label.config(text="Auto Mask: no anomalous regions found.")
+            return
+        
+        self.schedule_image_resize()
+        self.status_label.config(text="Auto Mask applied. Use Undo to revert.")
+        logger.info(f"Auto mask applied over region {changed_bbox}.")
+
+    def draw_live_brush_stroke(self, *screen_points):
+        """Extends the live stroke preview, a single growing polyline canvas item."""
         temp_color = 'yellow' 
+        for x, y in screen_points:
+            self.stroke_preview_coords.extend((x, y))
+        
+        coords = self.stroke_preview_coords
+        if len(coords) == 2: 
+            coords = coords * 2 # A line item needs two points; a projecting cap makes it a square
+        if self.stroke_preview_item is None:
+            self.stroke_preview_item = self.canvas.create_line(*coords, fill=temp_color, width=self.brush_size * self.zoom_level, 
+                                                               capstyle=tk.PROJECTING, joinstyle=tk.BEVEL)
+        else:
+            self.canvas.coords(self.stroke_preview_item, *coords)
+    
+    def _clear_stroke_preview(self):
+        if self.stroke_preview_item is not None:
+            self.canvas.delete(self.stroke_preview_item)
+        self.stroke_preview_item = None
+        self.stroke_preview_coords = []
         
-        item = self.canvas.create_line(start_screen_pos[0], start_screen_pos[1], end_screen_pos[0], end_screen_pos[1], fill=temp_color, width=r*2, capstyle=tk.BUTT)
-        self.temp_items.append(item)
-        item = self.canvas.create_rectangle(end_screen_pos[0]-r, end_screen_pos[1]-r, end_screen_pos[0]+r, end_screen_pos[1]+r, fill=temp_color, outline='')
-        self.temp_items.append(item)
+    def _move_brush_cursor(self, x, y):
+        """Moves the single reusable brush cursor item instead of recreating it."""
+        r = self.brush_size * self.zoom_level / 2
+        if self.brush_cursor_item is None:
+            self.brush_cursor_item = self.canvas.create_rectangle(x-r, y-r, x+r, y+r, outline='yellow', width=2)
+        else:
+            self.canvas.coords(self.brush_cursor_item, x-r, y-r, x+r, y+r)
+            self.canvas.tag_raise(self.brush_cursor_item)
+            
+    def _hide_brush_cursor(self):
+        if self.brush_cursor_item is not None:
+            self.canvas.delete(self.brush_cursor_item)
+        self.brush_cursor_item = None
         
     def on_middle_mouse_down(self, event):
         if self.original_image is None: 
@@ -968,7 +4105,7 @@ class ImageAnnotator:
         for item in self.committed_grid_items: 
             self.canvas.move(item, dx, dy)
         
-        self.schedule_image_resize() 
+        self.schedule_image_resize(interactive=True) 
         
     def on_middle_mouse_up(self, event):
         if self.original_image is None or not self.is_panning: 
@@ -992,34 +4129,63 @@ class ImageAnnotator:
         self.pan_x = x - (x - self.pan_x) * (self.zoom_level / old_zoom)
         self.pan_y = y - (y - self.pan_y) * (self.zoom_level / old_zoom)
         
-        self.schedule_image_resize() 
+        self.schedule_image_resize(interactive=True) 
         
     def on_mouse_move(self, event):
         if self.mode == 'mask' and self.original_image is not None:
-            self.clear_temp_items()
-            r = self.brush_size * self.zoom_level / 2
-            item = self.canvas.create_rectangle(event.x-r, event.y-r, event.x+r, event.y+r, outline='yellow', width=2)
-            self.temp_items.append(item)
+            self._move_brush_cursor(event.x, event.y)
             
     def on_canvas_configure(self, event):
         self.schedule_image_resize()
         
-    def update_combined_image(self):
-        if self.original_image is None: 
+    def undo(self):
+        self._apply_history_step(self.history.undo, "Undo")
+
+    def redo(self):
+        self._apply_history_step(self.history.redo, "Redo")
+
+    def _apply_history_step(self, step, label):
+        if self.original_image is None or self.last_mask_pos is not None or self.active_scp is not None:
+            return
+        action = step(self)
+        if action is None:
+            self.status_label.config(text=f"{label}: nothing to {label.lower()}.")
             return
         
-        self.combined_image = self.original_image.copy().convert("RGBA")
-        self.combined_image.paste(self.mask_paint_layer, (0, 0), self.mask_paint_layer) 
-        self.combined_image.paste(self.annotation_layer, (0, 0), self.annotation_layer) 
+        if action['kind'] == 'mask':
+            self.mask_dirty = True
+            self.mask_journal.record_region(action['bbox'], self.mask_paint_layer.region(action['bbox']), mode='set')
+            self.mask_journal.flush()
+        elif self.mode == 'ffd_grid':
+            self.apply_ffd_button.config(state=tk.NORMAL)
+        else:
+            # Outside of grid editing the committed die data must follow the SCPs
+            self._commit_ffd_changes()
+        
+        logger.info(f"{label} of {action['kind']} action. History: {self.history.memory_used / 2**20:.1f} MB.")
+        self.schedule_image_resize()
         
-    def schedule_image_resize(self):
+    def schedule_image_resize(self, interactive=False):
+        """
+        Debounced redraw. Interactive redraws (zoom, pan) draw a fast frame and schedule the
+        LANCZOS refinement for when the view has been idle for DISPLAY_REFINE_IDLE_MS.
+        """
         if self.resize_job_id: 
             self.root.after_cancel(self.resize_job_id)
-        self.resize_job_id = self.root.after(self.RESIZE_DEBOUNCE_MS, self.do_image_resize) 
+        if self.refine_job_id: 
+            self.root.after_cancel(self.refine_job_id)
+            self.refine_job_id = None
+        if interactive:
+            self.resize_job_id = self.root.after(self.RESIZE_DEBOUNCE_MS, lambda: self.do_image_resize(fast=True))
+            self.refine_job_id = self.root.after(DISPLAY_REFINE_IDLE_MS, self.do_image_resize)
+        else:
+            self.resize_job_id = self.root.after(self.RESIZE_DEBOUNCE_MS, self.do_image_resize) 
         
-    def do_image_resize(self):
-        self.update_display() 
+    def do_image_resize(self, fast=False):
+        self.update_display(fast) 
         self.resize_job_id = None 
+        if not fast:
+            self.refine_job_id = None 
 
     def _initialize_ffd_mesh(self):
         if self.original_image is None:
@@ -1036,79 +4202,162 @@ class ImageAnnotator:
                                    "Please define the Blue Die Dimension Rectangle first.")
             return False
             
-        # --- 1. Define Constants and Image Size ---
         W_img, H_img = self.original_image.size
-        #SCP_SIZE = 4 
-        
-        # --- 2. Calculate Dynamic Margin based on Circle ---
-        R_circ = self.circle_geom['radius']
-        ux, uy = self.circle_geom['center']
-        
-        # Calculate the four distances from the circle's edge to the image edge
-        D_left = ux - R_circ
-        D_right = W_img - (ux + R_circ)
-        D_top = uy - R_circ
-        D_bottom = H_img - (uy + R_circ)
-        
-        # The FFD grid's outer boundary is offset by D_x, D_y
-        X_offset = max(0.0, D_left)
-        W_FFD_max = W_img - max(0.0, D_left) - max(0.0, D_right) 
-
-        Y_offset = max(0.0, D_top)
-        H_FFD_max = H_img - max(0.0, D_top) - max(0.0, D_bottom)
-        
-        # Fallback: Ensure minimum working area
-        DEFAULT_MARGIN = 0.05
-        if W_FFD_max < W_img * DEFAULT_MARGIN: 
-            W_FFD_max = W_img * (1.0 - 2*DEFAULT_MARGIN)
-        if H_FFD_max < H_img * DEFAULT_MARGIN: 
-            H_FFD_max = H_img * (1.0 - 2*DEFAULT_MARGIN)
-        
-        # --- 3. Calculate Die Grid Size for Interpolated Mesh (based on FFD Area) ---
-        x1, y1, x2, y2 = self.rectangle_geom
-        W_die, H_die = x2 - x1, y2 - y1
-        
-        # Use W_FFD_max/H_FFD_max instead of W_img/H_img ***
-        N_c = math.ceil(W_FFD_max / W_die) 
-        N_r = math.ceil(H_FFD_max / H_die) 
-        self.Max_C = N_c
-        self.Max_R = N_r
-        
-        # Ensure a minimum grid size of 1x1 if die is very large (Max_C/R should be >= 1)
-        if self.Max_C == 0: 
-            self.Max_C = 1
-        if self.Max_R == 0: 
-            self.Max_R = 1
-        
-        # --- 4. Place SCPs within the Dynamic Working Area (W_FFD_max x H_FFD_max) ---
-        self.super_control_points = {}
-        self.initial_scp_points = {} 
-
-        for C_s in range(SCP_SIZE):
-            for R_s in range(SCP_SIZE):
-                
-                # Normalized position (0.0 to 1.0) across the grid intervals
-                u_norm_grid = C_s / (SCP_SIZE - 1.0)
-                v_norm_grid = R_s / (SCP_SIZE - 1.0)
-
-                # Map to the dynamic working area
-                x_relative = u_norm_grid * W_FFD_max
-                y_relative = v_norm_grid * H_FFD_max
-
-                # Add the offset (D_left, D_top) to shift the entire grid inward
-                x = x_relative + X_offset
-                y = y_relative + Y_offset
-                
-                self.super_control_points[(C_s, R_s)] = (x, y)
-                self.initial_scp_points[(C_s, R_s)] = (x, y)
+        angle, strength = estimate_street_angle(self.original_image, self.circle_geom)
+        if strength < STREET_ANGLE_MIN_STRENGTH:
+            logger.info(f"No dominant street orientation found (strength {strength:.1f}), using an axis-aligned lattice.")
+            angle = 0.0
+        else:
+            logger.info(f"Street orientation {math.degrees(angle):.2f} deg (strength {strength:.1f}), rotating the lattice.")
+        self.super_control_points, self.Max_C, self.Max_R = initial_scp_lattice(
+            W_img, H_img, self.circle_geom, self.rectangle_geom, angle)
+        self.initial_scp_points = dict(self.super_control_points)
                 
-        # --- 5. Commit Changes ---
+        # --- Commit Changes ---
         self._calculate_all_interpolated_points()
         self._commit_ffd_changes()
         return True
     
+    # --- Sessions and Templates ---
+    def _session_dict(self):
+        """Current session, with its geometry in full-resolution pixels (also when working on a copy)."""
+        reference, reference_scale = registration_thumbnail(self.original_image)
+        geometry = scale_geometry({'circle': None if self.circle_geom['radius'] is None else dict(self.circle_geom),
+                                   'rectangle': self.rectangle_geom, 
+                                   'super_control_points': dict(self.super_control_points)}, self.work_scale)
+        return {
+            'image': os.path.basename(self.original_image_path or ''),
+            'image_size': (round(self.original_image.width * self.work_scale[0]), 
+                           round(self.original_image.height * self.work_scale[1])),
+            'circle': geometry['circle'],
+            'rectangle': geometry['rectangle'],
+            'max_c': self.Max_C,
+            'max_r': self.Max_R,
+            'super_control_points': geometry['super_control_points'],
+            'die_origin_shift': self.die_origin_shift,
+            'edge_exclusion': self.edge_exclusion,
+            'reference': reference,
+            'reference_scale': reference_scale / self.work_scale[0],
+            'die_status': self._die_status(),
+        }
+    
+    def _die_status(self):
+        """Current per-die status table for session diffs, or None without a committed grid."""
+        if not self.die_info_cache:
+            return None
+        table = self.die_table if self.die_table is not None else self._update_die_classification()
+        return {'keys': table['keys'], 'status': die_status_codes(table['classes'], self.live_counts.masked),
+                'die_origin_shift': self.die_origin_shift}
+        
+    def save_session(self):
+        """Saves the circle, die rectangle, grid and naming origin, usable as a template for other wafers."""
+        if self.original_image is None:
+            return
+        if self.mode == 'ffd_grid' and self.apply_ffd_button.cget('state') == tk.NORMAL:
+            self._commit_ffd_changes()
+        filename = filedialog.asksaveasfilename(
+            defaultextension=".json",
+            initialfile=os.path.basename(self._output_path("_Session.json")),
+            filetypes=[("Session Files", "*.json")]
+        )
+        if not filename:
+            return
+        try:
+            write_session(filename, self._session_dict())
+            logger.info(f"Session saved: {filename}")
+            self.status_label.config(text=f"Session saved: {os.path.basename(filename)}")
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to save session: {e}")
+            
+    def apply_template(self, filename=None):
+        """Registers the current image to a saved session's reference and transfers its geometry."""
+        if self.original_image is None:
+            return
+        if filename is None:
+            filename = filedialog.askopenfilename(title="Select Template Session", 
+                                                  filetypes=[("Session Files", "*.json")])
+            if not filename:
+                return
+        try:
+            session = read_session(filename)
+        except Exception as e:
+            messagebox.showerror("Template Error", f"Failed to read session: {e}")
+            return
+        
+        start = time.perf_counter()
+        transform = register_to_reference(session['reference'], session['reference_scale'], self.original_image)
+        geometry = transform_session_geometry(session, transform)
+        
+        self.set_mode(None)
+        self.die_origin_shift = geometry['die_origin_shift']
+        self.edge_exclusion = geometry['edge_exclusion'] * self._work_scale_mean()
+        self.rectangle_geom = geometry['rectangle']
+        if geometry['circle'] is not None:
+            self._set_circle(geometry['circle']['center'], geometry['circle']['radius'])
+        if geometry['super_control_points']:
+            self.super_control_points = geometry['super_control_points']
+            self.Max_C, self.Max_R = geometry['max_c'], geometry['max_r']
+            self._commit_ffd_changes()
+        self.edge_exclusion_var.set(f"{self.edge_exclusion:g}")
+        
+        summary = (f"shift ({transform['offset'][0]:.0f}, {transform['offset'][1]:.0f}) px, "
+                   f"rotation {math.degrees(transform['angle']):.2f} deg, scale {transform['scale']:.4f}, "
+                   f"match {transform['response']:.2f}")
+        logger.info(f"Template {os.path.basename(filename)} applied in {time.perf_counter() - start:.2f} s: {summary}")
+        self.status_label.config(text=f"Template applied: {summary}")
+        if transform['response'] < REGISTRATION_MIN_RESPONSE:
+            messagebox.showwarning("Template Match", 
+                                   f"The image matched the template only weakly ({summary}). Check the grid before reporting.")
+        elif transform['flip_response'] * REGISTRATION_FLIP_MARGIN > transform['response']:
+            messagebox.showwarning("Template Match", 
+                                   f"The wafer matched the template about as well rotated by 180 degrees; the rotation "
+                                   f"within +-90 degrees was taken ({summary}). Check the die naming before reporting.")
+
+    def compare_session(self, filename=None):
+        """
+        Diffs the die status of an earlier session of this wafer against the current state and shows
+        the change map overlay; writes the changed dies to '<image>_Diff.csv'. Cancel clears the overlay.
+        """
+        current = self._die_status()
+        if current is None:
+            messagebox.showerror("Error", "APPLY an FFD grid before comparing sessions.")
+            return
+        if filename is None:
+            filename = filedialog.askopenfilename(title="Select Session to Compare Against", 
+                                                  filetypes=[("Session Files", "*.json")])
+            if not filename:
+                self.die_diff = None
+                self._draw_committed_mesh_on_canvas()
+                return
+        try:
+            before = read_session(filename)['die_status']
+        except Exception as e:
+            messagebox.showerror("Compare Error", f"Failed to read session: {e}")
+            return
+        if before is None:
+            messagebox.showerror("Compare Error", "The session was saved without a committed grid.")
+            return
+        
+        start = time.perf_counter()
+        diff = diff_die_status(before, current)
+        logger.info(f"Session diff of {len(current['keys'])} dies in {1000 * (time.perf_counter() - start):.1f} ms.")
+        self.die_diff = diff['change']
+        self._draw_committed_mesh_on_canvas()
+        
+        summary = diff_summary(diff)
+        text = ", ".join(f"{name}: {summary[name]}" for code, name in DIFF_CHANGE_NAMES.items() if code != DIFF_NONE)
+        self.status_label.config(text=f"Compared to {os.path.basename(filename)}: {text}")
+        try:
+            diff_filename = self._output_path("_Diff.csv")
+            write_die_diff_csv(diff_filename, before, current, diff)
+        except Exception as e:
+            messagebox.showerror("Export Error", f"Failed to save diff: {e}")
+            return
+        messagebox.showinfo("Session Diff", f"{text}\nMissing from current grid: {summary['missing']}\n\n"
+                                            f"Changed dies saved to:\n{diff_filename}")
+
     def save_image(self):
-        if self.combined_image is None:
+        if self.original_image is None or self.mask_paint_layer is None:
             messagebox.showerror("Error", "No image loaded or image processing incomplete.")
             return
             
@@ -1119,38 +4368,41 @@ class ImageAnnotator:
         )
         if filename:
             try:
-                temp_annotation = self.annotation_layer.copy().convert("RGBA")
-                temp_draw = ImageDraw.Draw(temp_annotation)
+                full = self._full_resolution_state()
+                W, H = full['image'].size
+                final_image = full['image'].convert("RGBA")
+                final_image.paste(Image.new("RGBA", final_image.size, MASK_COLOR[:3] + (255,)), (0, 0), 
+                                  full['mask'].to_image((0, 0, W, H), on_value=MASK_COLOR[3]))
+                temp_draw = ImageDraw.Draw(final_image, "RGBA") # Blends the translucent die colors
+                self._draw_annotations(temp_draw, scale=self._work_scale_mean())
                 
                 PINK_COLOR = (255, 105, 180, 200) 
+                EDGE_DIE_COLOR = (160, 160, 160, 200) 
                 TEXT_COLOR_CLEAN = (0, 255, 255, 200) 
                 TEXT_COLOR_MASKED = (0, 0, 255, 150) 
                 LINE_THICKNESS = 1 
                 
-                for (C, R), info in self.die_info_cache.items():
-                    polygon = info['polygon']
-                    center_x, center_y = info['center']
-                    
-                    if self.circle_geom['radius'] is not None:
-                        R_circ = self.circle_geom['radius']
-                        ux, uy = self.circle_geom['center']
-                        radius_sq = R_circ**2
-                        dist_sq = (center_x - ux)**2 + (center_y - uy)**2
-                        if dist_sq >= radius_sq:
-                             continue
+                table = full['die_table']
+                for (C, R), polygon, (center_x, center_y), die_class, is_masked in zip(
+                        table['keys'].tolist(), table['polygons'], table['centers'], table['classes'], full['masked']):
+                    if die_class == DIE_OUTSIDE:
+                         continue
 
                     int_points = [(int(p[0]), int(p[1])) for p in polygon]
                     closed_die_line = int_points + [int_points[0]] 
-                    temp_draw.line(closed_die_line, fill=PINK_COLOR, width=LINE_THICKNESS)
+                    temp_draw.line(closed_die_line, fill=PINK_COLOR if die_class == DIE_FULL else EDGE_DIE_COLOR, 
+                                   width=LINE_THICKNESS)
+                    
+                    if die_class != DIE_FULL:
+                         continue
 
                     die_name = self._get_die_name(C, R)
                     
-                    is_masked = self._is_die_masked(center_x, center_y)
                     TEXT_COLOR = TEXT_COLOR_MASKED if is_masked else TEXT_COLOR_CLEAN
                     
                     # Use textbbox instead of textsize ---
                     # The bbox returns (left, top, right, bottom) of the text relative to the origin (0, 0)
-                    bbox = temp_draw.textbbox((0, 0), die_name, font=GLOBAL_FONT)
+                    bbox = temp_draw.textbbox((0, 0), die_name, font=get_global_font())
                     text_w = bbox[2] - bbox[0]
                     text_h = bbox[3] - bbox[1]
                     
@@ -1158,12 +4410,8 @@ class ImageAnnotator:
                     text_x = center_x - text_w / 2
                     text_y = center_y - text_h / 2
                     
-                    temp_draw.text((text_x, text_y), die_name, fill=TEXT_COLOR, font=GLOBAL_FONT)
+                    temp_draw.text((text_x, text_y), die_name, fill=TEXT_COLOR, font=get_global_font())
 
-                final_image = self.original_image.copy().convert("RGBA")
-                final_image.paste(self.mask_paint_layer, (0, 0), self.mask_paint_layer) 
-                final_image.paste(temp_annotation, (0, 0), temp_annotation) 
-                
                 final_image.save(filename)
                 messagebox.showinfo("Success", f"Image saved successfully to:\n{filename}")
             except Exception as e:
@@ -1171,7 +4419,353 @@ class ImageAnnotator:
                 logger.error(f"Failed to save image: {e}")
 
 
-if __name__ == "__main__":
+# --- Job Server ---
+
+def report_summary(report):
+    """JSON-serializable counts of a compute_die_report result."""
+    keys = ('area_circle', 'area_mask', 'area_clean', 'area_die_nominal', 'estimated_dies', 'edge_exclusion',
+            'total_in_circle', 'total_clean', 'total_masked', 'total_partial', 'total_excluded', 'die_counts_clean')
+    summary = {key: report[key] for key in keys}
+    summary['area_mask'] = int(summary['area_mask'])
+    summary['die_origin_shift'] = list(report['die_origin_shift'])
+    summary['total_flagged'] = int(report['flagged'].sum())
+    return summary
+
+class WaferJobServer:
+    """
+    Headless load / commit-grid / report / export operations for repeated calls on the same wafers.
+    Decoded images live in a DecodedImageCache; die tables, masks, masked areas and per-die
+    statistics are memoized (LRU, keyed by file path and modification time, the image's included),
+    so e.g. a re-report after a naming-origin or edge-exclusion change only re-runs the cheap
+    vectorized counting. A wafer image rewritten in place is decoded again.
+    """
+    def __init__(self, memory_limit_bytes=IMAGE_CACHE_LIMIT_MB * 1024 * 1024, cache_entries=SERVER_CACHE_ENTRIES):
+        self.images = DecodedImageCache(memory_limit_bytes)
+        self.cache_entries = cache_entries
+        self.memo = OrderedDict()
+        self.lock = threading.Lock()
+        self.operations = {'load': self.load, 'commit-grid': self.commit_grid, 'report': self.report, 'export': self.export,
+                           'extract-dies': self.extract_dies, 'rectify': self.rectify, 'diff': self.diff}
+
+    def handle(self, operation, params):
+        if operation not in self.operations:
+            raise ValueError(f"unknown operation '{operation}'")
+        return self.operations[operation](params)
+
+    def status(self):
+        images = self.images.cached_paths()
+        with self.lock:
+            return {'images': images, 'memoized': len(self.memo)}
+
+    def _memoized(self, key, compute):
+        with self.lock:
+            if key in self.memo:
+                self.memo.move_to_end(key)
+                return self.memo[key]
+        value = compute()
+        with self.lock:
+            self.memo[key] = value
+            while len(self.memo) > self.cache_entries:
+                self.memo.popitem(last=False)
+        return value
+
+    @staticmethod
+    def _file_key(path):
+        return (os.path.abspath(path), os.path.getmtime(path))
+
+    def _image(self, params):
+        return self.images.load(os.path.abspath(params['image']))['image']
+
+    def _layers(self, image, params):
+        """The further scans of the wafer (params['layers']) by name, checked against the image size."""
+        stack = LayerStack(params['image'], [image], image.size)
+        for path in params.get('layers', []):
+            stack.add(path)
+        return stack.full_resolution_layers()
+
+    def _session(self, params, name='session'):
+        return self._memoized(('session',) + self._file_key(params[name]), lambda: read_session(params[name]))
+
+    def _die_table(self, image, params):
+        session = self._session(params)
+        if not session['super_control_points']:
+            raise ValueError("session has no grid")
+        W, H = image.size
+        
+        def compute():
+            points = interpolate_ffd_mesh(session['super_control_points'], session['max_c'], session['max_r'], W, H)
+            keys, polygons, centers = die_table_arrays(build_die_info_cache(points, session['max_c'], session['max_r']))
+            return {'keys': keys, 'polygons': polygons, 'centers': centers}
+        return self._memoized(('die_table',) + self._file_key(params['session']) + (W, H), compute)
+
+    def _mask(self, image, params):
+        """BitMask from an optional mask image (nonzero pixels are masked), else empty."""
+        W, H = image.size
+        if not params.get('mask'):
+            return self._memoized(('empty_mask', W, H), lambda: BitMask(W, H))
+        
+        def compute():
+            mask_image = Image.open(params['mask'])
+            band = mask_image.getchannel('A') if mask_image.mode in ('RGBA', 'LA') else mask_image.convert('L')
+            if band.size != (W, H):
+                raise ValueError(f"mask size {band.size} does not match image size {(W, H)}")
+            mask = BitMask(W, H)
+            mask.set_region((0, 0, W, H), np.asarray(band) > 0)
+            return mask
+        return self._memoized(('mask',) + self._file_key(params['mask']) + (W, H), compute)
+
+    def load(self, params):
+        image = self._image(params)
+        return {'image': params['image'], 'size': list(image.size)}
+
+    def commit_grid(self, params):
+        table = self._die_table(self._image(params), params)
+        return {'image': params['image'], 'dies': len(table['keys'])}
+
+    def _report(self, params):
+        image = self._image(params)
+        session = self._session(params)
+        if session['circle'] is None or session['rectangle'] is None:
+            raise ValueError("session has no circle or die rectangle")
+        table = dict(self._die_table(image, params))
+        mask = self._mask(image, params)
+        W, H = image.size
+        circle = session['circle']
+        edge_exclusion = float(params.get('edge_exclusion', session['edge_exclusion']))
+        origin_shift = tuple(params.get('die_origin_shift', session['die_origin_shift']))
+        # The image size is part of the key: one mask file may be passed with images of another size
+        mask_key = (self._file_key(params['mask']) if params.get('mask') else ('empty',)) + (W, H)
+        grid_key = self._file_key(params['session'])
+        
+        table['classes'] = classify_dies(table['polygons'], circle['center'], circle['radius'], edge_exclusion)
+        masked = self._memoized(('masked',) + grid_key + mask_key, 
+                                lambda: sample_mask_at_points(mask.region, table['centers'], W, H))
+        mask_area = self._memoized(('mask_area',) + grid_key + mask_key, 
+                                   lambda: circle_mask_area(mask.region, W, H, circle['center'], circle['radius']))
+        layer_keys = tuple(self._file_key(path) for path in params.get('layers', []))
+        die_stats = self._memoized(('die_stats',) + self._file_key(params['image']) + grid_key + mask_key + layer_keys, 
+                                   lambda: compute_die_statistics(image, mask.region, table['polygons'], 
+                                                                  layers=self._layers(image, params)))
+        return compute_die_report(image, mask.region, table, masked, circle, session['rectangle'], origin_shift, 
+                                  edge_exclusion, mask_area=mask_area, die_stats=die_stats)
+
+    def report(self, params):
+        return report_summary(self._report(params))
+
+    def export(self, params):
+        """Writes '<image>_Report.txt' and '<image>_DieStats.csv' (into params['output_dir'] if given)."""
+        report = self._report(params)
+        base_name = os.path.splitext(os.path.basename(params['image']))[0]
+        out_dir = params.get('output_dir') or os.path.dirname(os.path.abspath(params['image']))
+        report_filename = os.path.join(out_dir, f"{base_name}_Report.txt")
+        stats_filename = os.path.join(out_dir, f"{base_name}_DieStats.csv")
+        with open(report_filename, 'w') as f:
+            f.write(format_die_report(report, os.path.basename(params['image']), os.path.basename(stats_filename)))
+        write_die_statistics_csv(stats_filename, report)
+        summary = report_summary(report)
+        summary.update({'report': report_filename, 'die_stats': stats_filename})
+        return summary
+
+    def extract_dies(self, params):
+        """Writes the clean full dies as atlases (see extract_die_atlases); params['tile_size'] 0 keeps native crops."""
+        report = self._report(params)
+        base_name = os.path.splitext(os.path.basename(params['image']))[0]
+        out_dir = params.get('output_dir') or os.path.dirname(os.path.abspath(params['image']))
+        clean = report['in_circle'] & ~report['masked']
+        index_filename = extract_die_atlases(self._image(params), report['die_table'], clean, report['die_origin_shift'], 
+                                             out_dir, base_name, tile_size=int(params.get('tile_size', ATLAS_TILE_SIZE)))
+        return {'image': params['image'], 'dies': int(clean.sum()), 'index': index_filename}
+
+    def rectify(self, params):
+        """Writes the mesh-rectified image to params['output'] (default '<image>_Rectified.png')."""
+        image = self._image(params)
+        session = self._session(params)
+        if not session['super_control_points'] or session['rectangle'] is None:
+            raise ValueError("session has no grid or die rectangle")
+        W, H = image.size
+        points = interpolate_ffd_mesh(session['super_control_points'], session['max_c'], session['max_r'], W, H)
+        x1, y1, x2, y2 = session['rectangle']
+        pitch = (max(1, int(round(abs(x2 - x1)))), max(1, int(round(abs(y2 - y1)))))
+        output = params.get('output') or os.path.splitext(os.path.abspath(params['image']))[0] + '_Rectified.png'
+        size = write_rectified_image(output, image, mesh_corner_array(points, session['max_c'], session['max_r']), 
+                                     pitch, tuple(params.get('die_origin_shift', session['die_origin_shift'])))
+        return {'image': params['image'], 'output': output, 'size': list(size), 'die_pitch': list(pitch)}
+
+    def diff(self, params):
+        """Die status changes from session params['before'] to params['after'], optionally written to params['output']."""
+        before, after = (self._session(params, name)['die_status'] for name in ('before', 'after'))
+        if before is None or after is None:
+            raise ValueError("both sessions need a committed grid")
+        diff = diff_die_status(before, after)
+        if params.get('output'):
+            write_die_diff_csv(params['output'], before, after, diff)
+        return diff_summary(diff)
+
+class _JobRequestHandler(BaseHTTPRequestHandler):
+    """POST /<operation> with a JSON object of parameters; GET /status."""
+    def do_GET(self):
+        if self.path.rstrip('/') == '/status':
+            self._reply(200, self.server.jobs.status())
+        else:
+            self._reply(404, {'error': f"unknown path {self.path}"})
+
+    def do_POST(self):
+        start = time.perf_counter()
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            params = json.loads(self.rfile.read(length) or b'{}')
+            result = self.server.jobs.handle(self.path.strip('/'), params)
+        except (ValueError, KeyError, OSError) as e:
+            self._reply(400, {'error': f"{type(e).__name__}: {e}"})
+            return
+        except Exception as e:
+            logger.exception(f"Job {self.path} failed.")
+            self._reply(500, {'error': f"{type(e).__name__}: {e}"})
+            return
+        result['elapsed_s'] = round(time.perf_counter() - start, 3)
+        self._reply(200, result)
+
+    def _reply(self, code, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.info(f"{self.address_string()} {format % args}")
+
+class JobHTTPServer(HTTPServer):
+    """HTTP server whose requests are handled on a fixed-size worker pool."""
+    def __init__(self, address, jobs, workers=SERVER_WORKERS):
+        super().__init__(address, _JobRequestHandler)
+        self.jobs = jobs
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process_request_worker, request, client_address)
+
+    def _process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+def serve_jobs(host='127.0.0.1', port=SERVER_PORT, workers=SERVER_WORKERS):
+    server = JobHTTPServer((host, port), WaferJobServer(), workers)
+    logger.info(f"Job server listening on http://{host}:{server.server_address[1]} with {workers} workers.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+IMPORT_TIME_S = time.perf_counter() - _IMPORT_START
+
+
+# --- Self Checks ---
+
+def synthetic_wafer_image(size=1024, pitch=(37.3, 29.1), street=4.0, angle=0.0, scale=1.0, shift=(0.0, 0.0), supersample=3):
+    """
+    Anti-aliased wafer of identical dies with a centered feature, so that it looks the same rotated
+    by 180 degrees (the hard case for template registration), as an 'L' image. The wafer is rotated
+    by angle (degrees) and scaled about the image center, then shifted by shift (px).
+    """
+    cos_a, sin_a = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+    total = np.zeros((size, size))
+    ys, xs = np.mgrid[0:size, 0:size].astype(np.float64)
+    for k in range(supersample * supersample):
+        px = xs + (k % supersample + 0.5) / supersample - size / 2 - shift[0]
+        py = ys + (k // supersample + 0.5) / supersample - size / 2 - shift[1]
+        # Wafer frame: undo the rotation and scale
+        u, v = (cos_a * px + sin_a * py) / scale, (-sin_a * px + cos_a * py) / scale
+        du = np.abs((u + pitch[0] / 2) % pitch[0] - pitch[0] / 2)
+        dv = np.abs((v + pitch[1] / 2) % pitch[1] - pitch[1] / 2)
+        value = np.where((du < street / 2) | (dv < street / 2), 60.0, 150.0)
+        value = np.where((np.abs(du - pitch[0] / 2) < pitch[0] / 5) & (np.abs(dv - pitch[1] / 2) < pitch[1] / 6), 220.0, value)
+        total += np.where(np.hypot(u, v) < 0.42 * size, value, 20.0)
+    return Image.fromarray(np.round(total / supersample ** 2).astype(np.uint8))
+
+def check_template_registration(tolerance=2.0):
+    """Registers rotated, scaled and shifted copies of a synthetic grid wafer. Returns a list of failures."""
+    size = 1024
+    reference, reference_scale = registration_thumbnail(synthetic_wafer_image(size))
+    probes = [(size / 2 + 0.35 * size * math.cos(t), size / 2 + 0.35 * size * math.sin(t)) for t in np.arange(8) * math.pi / 4]
+    failures = []
+    for angle, scale, shift in ((1.0, 1.0, (12.0, -20.0)), (-4.0, 1.03, (30.0, 15.0)), (7.0, 0.98, (-25.0, 10.0)), 
+                                (3.0, 1.05, (0.0, 18.0)), (-0.5, 1.0, (4.0, 4.0)), (30.0, 1.0, (0.0, 0.0))):
+        transform = register_to_reference(reference, reference_scale, 
+                                          synthetic_wafer_image(size, angle=angle, scale=scale, shift=shift))
+        cos_a, sin_a = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+        error = 0.0
+        for x, y in probes:
+            dx, dy = x - size / 2, y - size / 2
+            expected = (size / 2 + scale * (cos_a * dx - sin_a * dy) + shift[0], size / 2 + scale * (sin_a * dx + cos_a * dy) + shift[1])
+            mapped = transform_point((x, y), transform)
+            error = max(error, math.hypot(mapped[0] - expected[0], mapped[1] - expected[1]))
+        if error > tolerance:
+            failures.append(f"registration of rotation {angle} deg, scale {scale}: "
+                            f"got {math.degrees(transform['angle']):.2f} deg, {error:.1f} px off")
+    return failures
+
+def check_street_angle(tolerance=0.1):
+    """Detects the street angle of synthetic grid wafers at known small rotations. Returns a list of failures."""
+    size = 1024
+    failures = []
+    for angle in (0.0, 0.5, -0.3, 1.0, 3.0, -5.5, 7.0, -12.0, 20.0, 44.0):
+        image = synthetic_wafer_image(size, pitch=(30.9, 23.7), street=2.5, angle=angle)
+        found, strength = estimate_street_angle(image, {'center': (size / 2, size / 2), 'radius': 0.42 * size})
+        error = (math.degrees(found) - angle + 45) % 90 - 45
+        if strength < STREET_ANGLE_MIN_STRENGTH or abs(error) > tolerance:
+            failures.append(f"street angle of rotation {angle} deg: got {math.degrees(found):.3f} deg (strength {strength:.1f})")
+    return failures
+
+SELF_CHECKS = [check_template_registration, check_street_angle]
+
+def run_self_checks():
+    """Runs the synthetic regression checks; returns True if all pass."""
+    failures = []
+    for check in SELF_CHECKS:
+        start = time.perf_counter()
+        found = check()
+        logger.info(f"{check.__name__}: {'ok' if not found else 'FAILED'} ({time.perf_counter() - start:.1f} s)")
+        failures += found
+    for failure in failures:
+        logger.error(failure)
+    return not failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Wafer annotation tool.")
+    parser.add_argument('--serve', action='store_true', help="run the headless job server instead of the GUI")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS)
+    parser.add_argument('--self-check', action='store_true', help="run the synthetic regression checks and exit")
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT, datefmt='%S')
+    if args.self_check:
+        raise SystemExit(0 if run_self_checks() else 1)
+    if args.serve:
+        serve_jobs(args.host, args.port, args.workers)
+        return
+    gui_start = time.perf_counter()
+    _load_gui()
     root = tk.Tk()
     app = ImageAnnotator(root)
+    logger.info(f"Startup: module import {IMPORT_TIME_S * 1000:.0f} ms, GUI ready in {(time.perf_counter() - gui_start) * 1000:.0f} ms.")
     root.mainloop()
+
+
+if __name__ == "__main__":
+    main()